@@ -7,4 +7,149 @@ c.TerminalManager.cull_interval = 300
 
 # for nbconvert
 c.PDFExporter.latex_command = ['tectonic', '{filename}']
-c.PDFExporter.bib_command = ['/bin/true', '{filename}']
\ No newline at end of file
+c.PDFExporter.bib_command = ['/bin/true', '{filename}']
+
+
+# cull kernels, taking memory into account
+import os  # noqa: E402
+from jupyter_server.services.kernels.kernelmanager import (  # noqa: E402
+    AsyncMappingKernelManager)
+from datetime import datetime, timezone  # noqa: E402
+from traitlets import Float, Integer  # noqa: E402
+
+
+class MemoryCullingKernelManager(AsyncMappingKernelManager):
+    """Kernel manager that also culls idle kernels when memory is short.
+
+    Below memory_cull_threshold (fraction of the cgroup limit, compared
+    with the usage without the clean page cache), kernels are culled
+    after cull_idle_timeout as usual. Above it, the kernels idle for
+    at least memory_cull_idle sec are shut down, the most expensive first
+    (resident memory of the kernel and its children times idle time),
+    until the usage is back below the threshold. This is much cheaper for
+    the user than oom_watch stopping a running process.
+    """
+
+    memory_cull_threshold = Float(
+        0.8, config=True,
+        help='Fraction of the memory limit above which idle kernels are '
+             'culled by memory use')
+    memory_cull_idle = Integer(
+        600, config=True,
+        help='Minimum idle time (sec) of a kernel culled by memory use')
+
+    # where the process and cgroup files are (fake trees in the tests)
+    proc_root = '/proc'
+    cgroup_root = '/sys/fs/cgroup'
+
+    @staticmethod
+    def read_int(paths):
+        """Read the first valid integer from {paths} (cgroup v2 & v1)"""
+        for path in paths:
+            try:
+                with open(path) as fp:
+                    return int(fp.read().strip())
+            except (OSError, ValueError):
+                pass
+        return None
+
+    def get_memory(self):
+        """Return the (limit, working set) of the cgroup in bytes, or
+        (None, None). The working set is the usage without the clean page
+        cache (file pages that are not shmem), which the kernel can
+        reclaim (e.g. after reading large files), as in oom_watch"""
+        cgroup = self.cgroup_root
+        limit = self.read_int([f'{cgroup}/memory.max',
+                               f'{cgroup}/memory/memory.limit_in_bytes'])
+        used = self.read_int([f'{cgroup}/memory.current',
+                              f'{cgroup}/memory/memory.usage_in_bytes'])
+        if not limit or not used:
+            return None, None
+        for path in (f'{cgroup}/memory.stat',
+                     f'{cgroup}/memory/memory.stat'):
+            try:
+                with open(path) as fp:
+                    stat = dict(line.split() for line in fp
+                                if line.count(' ') == 1)
+            except OSError:
+                continue
+            # cgroup v2, or the total_* hierarchical values of v1
+            file = int(stat.get('file', stat.get(
+                'total_cache', stat.get('cache', 0))))
+            shmem = int(stat.get('total_shmem', stat.get('shmem', 0)))
+            return limit, used - max(file - shmem, 0)
+        return limit, used
+
+    def get_tree_rss(self, pids):
+        """Return {pid: resident bytes of pid and its children} for the
+        process trees of {pids}"""
+        page_size = os.sysconf('SC_PAGE_SIZE')
+        children, rss = {}, {}
+        for entry in os.listdir(self.proc_root):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'{self.proc_root}/{entry}/stat') as fp:
+                    fields = fp.read().rsplit(')', 1)[1].split()
+                children.setdefault(int(fields[1]), []).append(int(entry))
+                rss[int(entry)] = int(fields[21]) * page_size
+            except (OSError, IndexError, ValueError):
+                continue
+        result = {}
+        for pid in pids:
+            total, todo = 0, [pid]
+            while todo:
+                child = todo.pop()
+                total += rss.get(child, 0)
+                todo.extend(children.get(child, []))
+            result[pid] = total
+        return result
+
+    def get_idle_kernels(self, min_idle):
+        """Return [(cost, kernel_id, rss bytes, idle sec)] of the kernels
+        idle for at least {min_idle} sec, the most expensive first"""
+        now = datetime.now(timezone.utc)
+        idle = {}
+        for kernel_id, kernel in list(self._kernels.items()):
+            if (getattr(kernel, 'execution_state', None) == 'busy' or
+                    not hasattr(kernel, 'last_activity')):
+                continue
+            seconds = (now - kernel.last_activity).total_seconds()
+            # no provisioner while a kernel starts or after it shut down
+            pid = getattr(getattr(kernel, 'provisioner', None), 'pid', None)
+            if seconds >= min_idle and pid:
+                idle[kernel_id] = (pid, seconds)
+        rss = self.get_tree_rss([pid for pid, _ in idle.values()])
+        ranked = [(rss[pid] * seconds, kernel_id, rss[pid], seconds)
+                  for kernel_id, (pid, seconds) in idle.items()]
+        return sorted(ranked, reverse=True)
+
+    async def cull_kernels(self):
+        """Cull idle kernels by memory use if the working set is above the
+        threshold, then by idle time"""
+        limit, used = self.get_memory()
+        # the kernels are only ranked (a scan of /proc) above the threshold
+        threshold = limit * self.memory_cull_threshold if limit else None
+        if used and threshold and used > threshold:
+            for _, kernel_id, rss, seconds in self.get_idle_kernels(
+                    self.memory_cull_idle):
+                if used <= threshold:
+                    break
+                self.log.warning(
+                    "Culling kernel %s using %d MB, idle for %d sec: memory "
+                    "usage %d MB is above %d MB", kernel_id, rss // 1024**2,
+                    seconds, used // 1024**2, threshold // 1024**2)
+                try:
+                    await self.shutdown_kernel(kernel_id)
+                    used -= rss
+                except Exception as e:
+                    self.log.exception(
+                        "Failed to cull kernel %s: %s", kernel_id, e)
+        await super().cull_kernels()
+
+
+c.ServerApp.kernel_manager_class = MemoryCullingKernelManager
+# idle kernels are culled after 12 hours, or sooner if memory is short;
+# check every minute so the memory culling runs before oom_watch has to
+c.MappingKernelManager.cull_idle_timeout = 12 * 3600
+c.MappingKernelManager.cull_interval = 60
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""Replay recorded memory traces through the oom_watch policies, to
+compare them offline.
+
+A trace is a JSON-lines file with one sample per line:
+    {"t": sec, "limit": bytes, "used": bytes,
+     "procs": {"pid": [rss bytes, "command line"], ...}}
+"limit" is only needed in the first sample. With "file" and "shmem"
+bytes (as written by oom_watch), the policies follow the working set,
+without the clean page cache.
+The samples.jsonl and kill-*.jsonl files written by oom_watch are
+traces of this form.
+
+The replay samples the trace at the times the policy asks for (events
+are not modeled, so it behaves like the polling mode). The memory of a
+stopped process is removed from the rest of the trace.
+"""
+import argparse
+import importlib.util
+import json
+import os
+
+spec = importlib.util.spec_from_file_location(
+    'oom_watch', os.path.join(os.path.dirname(__file__), 'oom_watch.py'))
+oom_watch = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(oom_watch)
+
+
+class LargestPolicy(oom_watch.Policy):
+    """The original policy: sample every 0.5 sec, act when the free memory
+    is below the buffer, and stop the largest process"""
+
+    def interval(self, used):
+        return 0.5, False
+
+    def should_act(self, used):
+        return self.limit - used <= self.buffer_bytes
+
+    def choose(self, candidates):
+        if not candidates:
+            return None
+        return max(candidates, key=lambda x: x[1])
+
+
+POLICIES = {'ewma': oom_watch.Policy, 'largest': LargestPolicy}
+
+
+def load_trace(path):
+    """Return the samples in the trace file {path}, sorted by time"""
+    with open(path) as fp:
+        samples = [json.loads(line) for line in fp if line.strip()]
+    return sorted(samples, key=lambda sample: sample['t'])
+
+
+def replay(samples, policy_class):
+    """Replay {samples} through a policy.
+
+    Returns:
+    --------
+    dict with the number of 'checks', the 'kills' (time, pid, MB, lead
+    time before the OOM of the original trace, command), the time of the
+    'oom' if the limit was still reached (or None), and the 'peak' usage
+
+    """
+    limit = samples[0]['limit']
+    policy = policy_class(limit, oom_watch.get_buffer(limit))
+    start = samples[0]['t']
+    trace_oom = next((sample['t'] for sample in samples
+                      if oom_watch.get_working_set(sample['used'], sample)
+                      >= limit), None)
+
+    killed = set()
+    result = {'checks': 0, 'kills': [], 'oom': None, 'peak': 0}
+    index = 0
+    now = start
+    while now <= samples[-1]['t']:
+        while index + 1 < len(samples) and samples[index + 1]['t'] <= now:
+            index += 1
+        procs = {int(pid): value
+                 for pid, value in samples[index].get('procs', {}).items()}
+        used = oom_watch.get_working_set(
+            samples[index]['used'], samples[index]) - sum(
+            procs.pop(pid)[0] for pid in killed if pid in procs)
+        result['checks'] += 1
+        result['peak'] = max(result['peak'], used)
+        if used >= limit:
+            result['oom'] = now - start
+            break
+
+        policy.update_usage(now, used)
+        if policy.is_near(used):
+            policy.update_processes(
+                now, {pid: rss for pid, (rss, _) in procs.items()})
+        if policy.should_act(used):
+            victim = policy.choose([
+                (pid, rss, cmd) for pid, (rss, cmd) in procs.items()
+                if not oom_watch.is_protected(cmd) and
+                rss >= oom_watch.MIN_KILL_MB * 1024**2])
+            if victim is not None:
+                pid, rss, cmd = victim
+                killed.add(pid)
+                lead = None if trace_oom is None else trace_oom - now
+                result['kills'].append({
+                    't': now - start, 'pid': pid, 'mb': rss // 1024**2,
+                    'lead': lead, 'cmd': cmd})
+                now += oom_watch.KILL_WAIT
+                continue
+        now += policy.interval(used)[0]
+    return result
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('traces', nargs='+', help='trace files (JSON lines)')
+    ap.add_argument('--policy', nargs='+', choices=list(POLICIES),
+                    default=list(POLICIES), help='policies to compare')
+    args = ap.parse_args()
+
+    for path in args.traces:
+        samples = load_trace(path)
+        for name in args.policy:
+            result = replay(samples, POLICIES[name])
+            oom = ('no' if result['oom'] is None
+                   else f"at {result['oom']:.1f}s")
+            print(f"{path} {name}: {result['checks']} checks, "
+                  f"{len(result['kills'])} kills, OOM: {oom}, "
+                  f"peak: {result['peak'] // 1024**2}MB")
+            for kill in result['kills']:
+                lead = ('' if kill['lead'] is None
+                        else f", {kill['lead']:.1f}s before the OOM")
+                print(f"    {kill['t']:.1f}s: PID {kill['pid']} "
+                      f"({kill['mb']}MB{lead}): {kill['cmd'][:80]}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,19 @@
 #!/opt/jupyter/bin/python
 import time
 import os
-import sys
+import re
+import json
+import argparse
+import collections
+import select
 import signal
+import urllib.request
 from pathlib import Path
 
+# Where the process and cgroup files are; they can be replaced by fake
+# trees, e.g. for the tests
+PROC_ROOT = '/proc'
+CGROUP_ROOT = '/sys/fs/cgroup'
 # Processes that must NEVER be killed (Jupyter UI, init system, shells, etc.)
 PROTECTED = [
     'jupyter', 'jupyterhub-singleuser', 'start-singleuser.py', 'oom_watch',
@@ -12,6 +21,40 @@ PROTECTED = [
 ]
 # Do not kill processes using less than this amount of memory
 MIN_KILL_MB = 1024
+# cgroup v2 PSI trigger: wake up after 150ms of memory stall in 2s windows
+# (unprivileged triggers need a window that is a multiple of 2s)
+PSI_TRIGGER = 'some 150000 2000000'
+# With PSI/memory.events, check the usage anyway every IDLE_TIMEOUT sec
+IDLE_TIMEOUT = 30
+# Without them (cgroup v1), poll every MIN_INTERVAL to MAX_INTERVAL sec,
+# faster as the free memory gets closer to the buffer
+MIN_INTERVAL = 0.1
+MAX_INTERVAL = 5
+# When reclaiming page cache, free this much more than the buffer
+RECLAIM_MARGIN = 256 * 1024**2
+# After a failed reclaim, wait RECLAIM_BACKOFF sec before the next one,
+# doubling up to RECLAIM_BACKOFF_MAX sec while it keeps failing
+RECLAIM_BACKOFF = 30
+RECLAIM_BACKOFF_MAX = 600
+# Weight of the newest sample in the growth rates (EWMA)
+EWMA_ALPHA = 0.5
+# Act when the cgroup is predicted to run out of memory within this (sec)
+HORIZON = 5
+# Kill the fastest growing process if it drives this much of the growth
+GROWTH_SHARE = 0.5
+# Wait after a kill for the memory to be released (sec)
+KILL_WAIT = 10
+# Telemetry: samples kept in memory, process trees in each sample, and
+# the minimum time (sec) between updates of the exported files
+TELEMETRY_DIR = '/tmp/oom-watch'
+TELEMETRY_SIZE = 720
+TELEMETRY_TOP = 5
+TELEMETRY_INTERVAL = 30
+# When memory is not short, scan the processes for the telemetry only
+# every TELEMETRY_SCAN_INTERVAL sec, so an idle server stays cheap
+TELEMETRY_SCAN_INTERVAL = 300
+# The connection file in the command line of a jupyter kernel
+KERNEL_PATTERN = re.compile(r'(\S*runtime/kernel-([\w-]+)\.json)')
 
 
 def read_int(paths, default=None):
@@ -26,91 +69,746 @@ def read_int(paths, default=None):
     return default
 
 
-def watchdog():
-    limit = read_int(['/sys/fs/cgroup/memory.max',
-                      '/sys/fs/cgroup/memory/memory.limit_in_bytes'])
+def get_buffer(limit):
+    """Free memory to keep for a cgroup {limit}: 1GB for <16GB limits,
+    2.5GB for larger"""
+    return int((1.0 if (limit / 1024**3) < 16 else 2.5) * 1024**3)
+
+
+def is_protected(cmd):
+    """Return True for empty commands and protected system processes;
+    jupyter kernels are never protected"""
+    return (not cmd or any(x in cmd for x in PROTECTED)
+            ) and 'runtime/kernel' not in cmd
+
+
+def find_notebook(connection_file):
+    """Return the path of the notebook using the kernel of
+    {connection_file}, from the sessions of the jupyter servers that
+    share its runtime folder, or None"""
+    match = KERNEL_PATTERN.search(connection_file)
+    if match is None:
+        return None
+    runtime_dir = os.path.dirname(match[1])
+    for server_file in Path(runtime_dir).glob('jpserver-*.json'):
+        try:
+            server = json.loads(server_file.read_text())
+            request = urllib.request.Request(
+                f"{server['url'].rstrip('/')}/api/sessions",
+                headers={'Authorization': f"token {server.get('token', '')}"})
+            with urllib.request.urlopen(request, timeout=1) as resp:
+                sessions = json.loads(resp.read().decode())
+        except Exception:
+            continue
+        for session in sessions:
+            if session.get('kernel', {}).get('id') == match[2]:
+                return session.get('path')
+    return None
+
+
+def read_psi(cgroup=CGROUP_ROOT):
+    """Return the 'some' avg10 memory pressure (%), or None"""
+    try:
+        line = Path(f'{cgroup}/memory.pressure').read_text().split('\n')[0]
+        return float(line.split('avg10=')[1].split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def read_memory_stat(cgroup=CGROUP_ROOT):
+    """Return the anon, file and shmem bytes of the cgroup from memory.stat
+    (cgroup v2, or the total_* hierarchical values of v1), or None"""
+    for path in (f'{cgroup}/memory.stat', f'{cgroup}/memory/memory.stat'):
+        try:
+            lines = Path(path).read_text().splitlines()
+        except OSError:
+            continue
+        stat = dict(line.split() for line in lines if line.count(' ') == 1)
+        stat = {key: int(val) for key, val in stat.items()}
+        if 'anon' in stat:
+            return {key: stat.get(key, 0) for key in ('anon', 'file', 'shmem')}
+        return {'anon': stat.get('total_rss', stat.get('rss', 0)),
+                'file': stat.get('total_cache', stat.get('cache', 0)),
+                'shmem': stat.get('total_shmem', stat.get('shmem', 0))}
+    return None
+
+
+def get_working_set(used, stat):
+    """Return the memory of the cgroup that the kernel cannot just drop:
+    {used} without the clean page cache (file pages that are not shmem)
+    of {stat}, which fills up to the limit even on an idle server"""
+    if not stat:
+        return used
+    return used - max(stat.get('file', 0) - stat.get('shmem', 0), 0)
+
+
+def reclaim(nbytes, cgroup=CGROUP_ROOT):
+    """Ask the kernel to reclaim {nbytes} from the cgroup (v2 only).
+
+    Returns True if all of it was reclaimed; False if it was only in part,
+    or if memory.reclaim is not available
+    """
+    try:
+        fd = os.open(f'{cgroup}/memory.reclaim', os.O_WRONLY)
+    except OSError:
+        return False
+    try:
+        os.write(fd, f'{int(nbytes)}'.encode())
+        return True
+    except OSError:
+        # EAGAIN: less than nbytes could be reclaimed
+        return False
+    finally:
+        os.close(fd)
+
+
+class PressureWaiter:
+    """Sleep until there is memory pressure.
+
+    On cgroup v2, a PSI trigger on memory.pressure and the memory.events
+    counters (high, max, oom) are watched with poll(), so an idle server
+    does not wake up. Without the PSI trigger (e.g. a read-only cgroupfs),
+    memory.events alone fires too late (high/max), so poll at an interval
+    that shrinks as the free memory gets closer to the buffer, waking up
+    early on memory.events if it is available.
+    """
+
+    def __init__(self, cgroup=CGROUP_ROOT):
+        self.poller = select.poll()
+        self.fds = {}
+        self.events = {}
+        try:
+            fd = os.open(f'{cgroup}/memory.pressure',
+                         os.O_RDWR | os.O_NONBLOCK)
+            try:
+                os.write(fd, f'{PSI_TRIGGER}\0'.encode())
+            except OSError:
+                os.close(fd)
+                raise
+            self.poller.register(fd, select.POLLPRI)
+            self.fds[fd] = 'psi'
+        except OSError:
+            pass
+        try:
+            fd = os.open(f'{cgroup}/memory.events', os.O_RDONLY)
+            self.poller.register(fd, select.POLLPRI | select.POLLERR)
+            self.fds[fd] = 'events'
+            self.events = self.read_events(fd)
+        except OSError:
+            pass
+        self.event_driven = 'psi' in self.fds.values()
+        self.wakeups = 0
+
+    @staticmethod
+    def read_events(fd):
+        """Read the memory.events counters; this also re-arms poll()"""
+        os.lseek(fd, 0, os.SEEK_SET)
+        text = os.read(fd, 4096).decode()
+        return {key: int(val) for key, val in
+                (line.split() for line in text.splitlines() if line)}
+
+    def wait(self, interval, idle):
+        """Wait for pressure, for {interval} sec when polling, or for
+        IDLE_TIMEOUT sec if {idle} and the PSI trigger is registered.
+
+        Returns the reason of the wake up: 'psi', 'events:{counters}',
+        'timeout' or 'poll'
+        """
+        self.wakeups += 1
+        if not self.fds:
+            time.sleep(interval)
+            return 'poll'
+
+        timeout = IDLE_TIMEOUT if idle and self.event_driven else interval
+        reasons = []
+        for fd, _ in self.poller.poll(timeout * 1000):
+            if self.fds[fd] == 'psi':
+                reasons.append('psi')
+            else:
+                events = self.read_events(fd)
+                changed = [key for key, val in events.items()
+                           if val != self.events.get(key)]
+                self.events = events
+                reasons.append(f"events:{','.join(changed)}")
+        return ' '.join(reasons) or (
+            'timeout' if self.event_driven else 'poll')
+
+
+class Telemetry:
+    """A fixed-size ring buffer of memory samples, exported as Prometheus
+    text (metrics.prom) and JSON lines (samples.jsonl) in {folder}, and
+    dumped on every kill (kill-{time}.jsonl).
+
+    Each sample has the time 't', the 'limit', the 'used' memory, the
+    'working' set, the 'anon', 'file' and 'shmem' split, the 'psi' avg10,
+    the 'rate' of growth of the working set, and the top process trees
+    'procs': {pid: [bytes, cmd]}; the JSON lines can be replayed with
+    oom_replay.py.
+    """
+
+    def __init__(self, folder=TELEMETRY_DIR, size=TELEMETRY_SIZE):
+        self.folder = folder
+        self.samples = collections.deque(maxlen=size)
+        self.counters = {'wakeups': 0, 'kills': 0, 'reclaims': 0}
+        self.written = 0
+        try:
+            os.makedirs(folder, exist_ok=True)
+        except OSError:
+            self.folder = None
+
+    def add(self, sample):
+        """Add a sample; the oldest one is dropped when full"""
+        self.samples.append(sample)
+
+    def to_prometheus(self):
+        """Return the last sample and the counters as Prometheus text"""
+        lines = []
+
+        def metric(name, kind, help, values):
+            lines.append(f'# HELP oom_watch_{name} {help}')
+            lines.append(f'# TYPE oom_watch_{name} {kind}')
+            for labels, value in values:
+                if value is not None:
+                    lines.append(f'oom_watch_{name}{labels} {value}')
+
+        for name, value in self.counters.items():
+            metric(f'{name}_total', 'counter', f'Number of {name}',
+                   [('', value)])
+        if self.samples:
+            last = self.samples[-1]
+            metric('memory_bytes', 'gauge', 'Memory of the cgroup',
+                   [(f'{{kind="{kind}"}}', last.get(kind))
+                    for kind in ('limit', 'used', 'working', 'anon', 'file',
+                                 'shmem')])
+            metric('pressure_some_avg10', 'gauge',
+                   'Memory pressure (PSI some avg10, %)',
+                   [('', last.get('psi'))])
+            metric('growth_bytes_per_second', 'gauge',
+                   'Growth of the working set (EWMA)',
+                   [('', last.get('rate'))])
+            top = []
+            for pid, (nbytes, cmd) in last.get('procs', {}).items():
+                cmd = (cmd[:80].replace('\\', '\\\\').replace('"', '\\"')
+                       .replace('\n', '\\n'))
+                top.append((f'{{pid="{pid}",cmd="{cmd}"}}', nbytes))
+            metric('process_tree_bytes', 'gauge',
+                   'RSS of the largest process trees', top)
+        return '\n'.join(lines) + '\n'
+
+    def write_file(self, name, text):
+        """Write {name} in the folder atomically"""
+        path = os.path.join(self.folder, name)
+        with open(f'{path}.tmp', 'w') as fp:
+            fp.write(text)
+        os.replace(f'{path}.tmp', path)
+
+    def to_jsonl(self):
+        """Return the samples as JSON lines"""
+        return ''.join(json.dumps(sample) + '\n' for sample in self.samples)
+
+    def write(self, force=False):
+        """Update the exported files, at most every TELEMETRY_INTERVAL sec
+        unless {force}"""
+        now = time.monotonic()
+        if self.folder is None or (
+                not force and now - self.written < TELEMETRY_INTERVAL):
+            return
+        self.written = now
+        try:
+            self.write_file('metrics.prom', self.to_prometheus())
+            self.write_file('samples.jsonl', self.to_jsonl())
+        except OSError:
+            pass
+
+    def dump(self):
+        """Write all the samples for a post-mortem of a kill"""
+        if self.folder is None:
+            return None
+        name = f"kill-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+        try:
+            self.write_file(name, self.to_jsonl())
+        except OSError:
+            return None
+        return os.path.join(self.folder, name)
+
+
+class Policy:
+    """When to act, how often to sample, and which process to stop.
+
+    The growth rates of the cgroup usage (its working set, see
+    get_working_set) and of each process are tracked with an EWMA of
+    bytes/sec. The policy acts when the free memory is below the buffer,
+    or when the cgroup is predicted to run out of memory within HORIZON
+    sec, and it samples faster as that time gets shorter.
+    """
+
+    def __init__(self, limit, buffer_bytes):
+        self.limit = limit
+        self.buffer_bytes = buffer_bytes
+        # EWMA growth of the cgroup usage, and the last (time, used)
+        self.rate = 0.0
+        self.last = None
+        # {pid: (time, rss, rate)}
+        self.procs = {}
+
+    @staticmethod
+    def ewma(rate, last, now, value):
+        """Update the growth {rate} with a new sample {value} at {now}"""
+        if last is None or now <= last[0]:
+            return rate
+        current = (value - last[1]) / (now - last[0])
+        return EWMA_ALPHA * current + (1 - EWMA_ALPHA) * rate
+
+    def update_usage(self, now, used):
+        """Add a sample of the cgroup usage"""
+        self.rate = self.ewma(self.rate, self.last, now, used)
+        self.last = (now, used)
+
+    def update_processes(self, now, rss):
+        """Add a sample of the memory of each process, {pid: bytes}"""
+        self.procs = {
+            pid: (now, value, self.ewma(
+                self.procs[pid][2] if pid in self.procs else 0.0,
+                self.procs.get(pid), now, value))
+            for pid, value in rss.items()
+        }
+
+    def time_left(self, used):
+        """Predicted time (sec) until the cgroup runs out of memory"""
+        if self.rate <= 0:
+            return float('inf')
+        return max(self.limit - used, 0) / self.rate
+
+    def interval(self, used):
+        """Return the time (sec) until the next sample, and whether it is
+        safe to wait for pressure events only"""
+        # a ratio of 1 means the free memory is twice the buffer
+        ratio = (self.limit - used - self.buffer_bytes) / self.buffer_bytes
+        interval = min(max(MIN_INTERVAL, ratio / 2), MAX_INTERVAL)
+        time_left = self.time_left(used)
+        interval = max(MIN_INTERVAL, min(interval, time_left / 4))
+        return interval, ratio > 1 and time_left > 4 * IDLE_TIMEOUT
+
+    def is_near(self, used):
+        """Return True if processes should be sampled for their growth"""
+        return (self.limit - used < 2 * self.buffer_bytes or
+                self.time_left(used) < 4 * HORIZON)
+
+    def should_act(self, used):
+        """Return True if memory has to be freed now"""
+        return (self.limit - used <= self.buffer_bytes or
+                self.time_left(used) < HORIZON)
+
+    def choose(self, candidates):
+        """Return the (pid, bytes, cmd) to stop from {candidates}: the one
+        driving the growth of the cgroup if any, else the largest one"""
+        if not candidates:
+            return None
+        if self.rate > 0:
+            rate, victim = max(
+                (self.procs.get(cand[0], (0, 0, 0.0))[2], cand)
+                for cand in candidates)
+            if rate >= GROWTH_SHARE * self.rate:
+                return victim
+        return max(candidates, key=lambda x: x[1])
+
+
+class ProcessTable:
+    """The processes of our cgroup.
+
+    The command line and protected status of each process are read once,
+    and only the memory is refreshed on each scan. Exited processes are
+    dropped, and a reused pid is detected from its start time before a
+    process is stopped.
+    """
+
+    def __init__(self, proc=PROC_ROOT, cgroup=CGROUP_ROOT):
+        self.proc = proc
+        self.cgroup_dir = self.find_cgroup_dir(proc, cgroup)
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.me = os.getpid()
+        # pid 1 (tini, which stops its whole process group) and our own
+        # ancestors are never stopped
+        self.ancestors = self.get_ancestors(proc, self.me) | {1}
+        # {pid: {'start', 'cmd', 'ppid', 'rss', 'protected', 'kernel'}},
+        # with the connection file of a kernel, or None, as 'kernel'
+        self.entries = {}
+        # the process trees, until a process starts or exits
+        self.tree_cache = None
+
+    @staticmethod
+    def get_ancestors(proc, pid):
+        """Return the pids of the ancestors of {pid}"""
+        ancestors = set()
+        while pid > 1 and pid not in ancestors:
+            try:
+                stat = Path(f'{proc}/{pid}/stat').read_text()
+                pid = int(stat[stat.rindex(')') + 2:].split()[1])
+            except (OSError, ValueError, IndexError):
+                break
+            ancestors.add(pid)
+        return ancestors
+
+    @staticmethod
+    def find_cgroup_dir(proc, cgroup):
+        """Return the cgroup folder of this process (v2 or v1 memory), or
+        None if it cannot be found"""
+        try:
+            lines = Path(f'{proc}/self/cgroup').read_text().splitlines()
+        except OSError:
+            return None
+        for line in lines:
+            hier, controllers, path = line.split(':', 2)
+            if hier == '0':
+                base = cgroup
+            elif 'memory' in controllers.split(','):
+                base = f'{cgroup}/memory'
+            else:
+                continue
+            # with a cgroup namespace, our cgroup is the mounted root
+            for folder in (f'{base}{path}', base):
+                if os.path.exists(f'{folder}/cgroup.procs'):
+                    return folder
+        return None
+
+    def get_pids(self):
+        """Return the pids in our cgroup and its children, or all the
+        pids if the cgroup is not known"""
+        if self.cgroup_dir is not None:
+            pids = set()
+            for folder, _, files in os.walk(self.cgroup_dir):
+                if 'cgroup.procs' in files:
+                    try:
+                        text = Path(f'{folder}/cgroup.procs').read_text()
+                        pids.update(int(pid) for pid in text.split())
+                    except OSError:
+                        pass
+            if pids:
+                return pids
+        return {int(pid) for pid in os.listdir(self.proc) if pid.isdigit()}
+
+    def read(self, pid, name):
+        """Return the file {name} of process {pid}"""
+        fd = os.open(f'{self.proc}/{pid}/{name}', os.O_RDONLY)
+        try:
+            return os.read(fd, 65536).decode(errors='replace')
+        finally:
+            os.close(fd)
+
+    def add_entry(self, pid):
+        """Read the stat and command line of a new process {pid}"""
+        # the fields after the command name (which may have spaces)
+        stat = self.read(pid, 'stat')
+        fields = stat[stat.rindex(')') + 2:].split()
+        cmd = self.read(pid, 'cmdline').replace('\0', ' ').strip()
+        kernel = KERNEL_PATTERN.search(cmd)
+        # Skip protected processes, the watchdog itself, and its ancestors
+        protected = (is_protected(cmd) or pid == self.me or
+                     pid in self.ancestors)
+        self.entries[pid] = {
+            'start': fields[19], 'cmd': cmd, 'ppid': int(fields[1]),
+            'rss': int(fields[21]) * self.page_size, 'protected': protected,
+            'kernel': kernel[1] if kernel else None}
+
+    def refresh(self):
+        """Update the memory of all processes; return the scan time (sec).
+
+        Only statm is read for the known processes: their command line,
+        protected status and parent are kept (an orphan's parent is then
+        gone from the table, which also makes it a root), and a reused
+        pid is detected by verify() before stopping anything.
+        """
+        start = time.perf_counter()
+        pids = self.get_pids()
+        known = set(self.entries)
+        if pids != known:
+            self.tree_cache = None
+        for pid in known - pids:
+            del self.entries[pid]
+
+        for pid in pids:
+            try:
+                if pid in known:
+                    rss = int(self.read(pid, 'statm').split()[1])
+                    self.entries[pid]['rss'] = rss * self.page_size
+                else:
+                    self.add_entry(pid)
+            except (OSError, ValueError, IndexError):
+                # Process exited while reading
+                if self.entries.pop(pid, None) is not None:
+                    self.tree_cache = None
+        return time.perf_counter() - start
+
+    def verify(self, pids):
+        """Return the pids of {pids} that are still the processes of the
+        table, from their start time; reused pids are dropped from the
+        table, to be read again by the next refresh()"""
+        alive = []
+        for pid in pids:
+            try:
+                stat = self.read(pid, 'stat')
+                started = stat[stat.rindex(')') + 2:].split()[19]
+            except (OSError, ValueError, IndexError):
+                started = None
+            if started is not None and started == self.entries[pid]['start']:
+                alive.append(pid)
+            else:
+                self.entries.pop(pid, None)
+                self.tree_cache = None
+        return alive
+
+    def groups(self):
+        """Group the unprotected processes into trees: each jupyter kernel
+        with its descendants (e.g. dask or multiprocessing workers, even
+        forked ones with the command line of the kernel), and each other
+        unprotected process whose parent is protected, with its
+        descendants. The trees are cached until a process starts or
+        exits.
+
+        Returns:
+        --------
+        {root pid: [pids of the tree]}
+
+        """
+        if self.tree_cache is not None:
+            return self.tree_cache
+
+        children = {}
+        roots = []
+        for pid, entry in self.entries.items():
+            if entry['protected']:
+                continue
+            parent = self.entries.get(entry['ppid'])
+            # workers forked by a kernel keep its command line: they
+            # stay in the tree of the kernel
+            if (parent is None or parent['protected'] or
+                    entry['kernel'] not in (None, parent['kernel'])):
+                roots.append(pid)
+            else:
+                children.setdefault(entry['ppid'], []).append(pid)
+
+        groups = {}
+        for root in roots:
+            pids, todo = [], [root]
+            while todo:
+                pid = todo.pop()
+                pids.append(pid)
+                todo += children.get(pid, [])
+            groups[root] = pids
+        self.tree_cache = groups
+        return groups
+
+    def get_pss(self, pid):
+        """Return the PSS of {pid} from smaps_rollup, so pages shared by
+        the workers of a tree are not counted several times; fall back to
+        the RSS"""
+        try:
+            with open(f'{self.proc}/{pid}/smaps_rollup') as fp:
+                for line in fp:
+                    if line.startswith('Pss:'):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        return self.entries[pid]['rss']
+
+    def candidates(self, min_bytes, groups=None):
+        """Return [(root pid, pss, cmd)] of the process trees using at
+        least {min_bytes}, with the PSS summed over each tree"""
+        if groups is None:
+            groups = self.groups()
+        candidates = []
+        for root, pids in groups.items():
+            # the RSS is an upper limit of the PSS
+            if sum(self.entries[pid]['rss'] for pid in pids) < min_bytes:
+                continue
+            pss = sum(self.get_pss(pid) for pid in pids)
+            if pss >= min_bytes:
+                candidates.append((root, pss, self.entries[root]['cmd']))
+        return candidates
+
+
+def watchdog(telemetry_dir=TELEMETRY_DIR, proc=PROC_ROOT,
+             cgroup=CGROUP_ROOT, home=None, waiter=None, kill=os.kill,
+             stop=None):
+    """Watch the memory of the cgroup, and stop the process tree that
+    would exhaust it.
+
+    Parameters:
+    -----------
+    telemetry_dir: str
+        Folder for the telemetry files
+    proc, cgroup: str
+        Roots of the process and cgroup files
+    home: str
+        Folder of the notification file. Default: $HOME or /tmp
+    waiter: PressureWaiter
+        What to wait with. Default: PressureWaiter(cgroup)
+    kill: callable
+        Called as kill(pid, signal) to stop a process
+    stop: threading.Event
+        If given, return once it is set
+
+    """
+    limit = read_int([f'{cgroup}/memory.max',
+                      f'{cgroup}/memory/memory.limit_in_bytes'])
     if not limit:
         return print("[OOM_WATCH] No memory limit found. Exiting.")
 
-    # Tiered buffer: 1GB for <16GB limits, 2.5GB for larger
-    buffer_bytes = int((1.0 if (limit / 1024**3) < 16 else 2.5) * 1024**3)
+    buffer_bytes = get_buffer(limit)
+    if waiter is None:
+        waiter = PressureWaiter(cgroup)
+    table = ProcessTable(proc, cgroup)
+    if home is None:
+        home = os.environ.get("HOME", "/tmp")
+    policy = Policy(limit, buffer_bytes)
+    telemetry = Telemetry(telemetry_dir)
+    mode = 'PSI/memory.events' if waiter.event_driven else 'polling'
     print((f"[OOM_WATCH] Started. Limit: {limit//1024**2}MB, "
-           f"Buffer: {buffer_bytes//1024**2}MB"))
+           f"Buffer: {buffer_bytes//1024**2}MB, Mode: {mode}"))
+
+    # the policy follows the working set, not memory.current, which
+    # includes the page cache; the first wait is as long as it allows
+    working = get_working_set(
+        read_int([f'{cgroup}/memory.current',
+                  f'{cgroup}/memory/memory.usage_in_bytes']) or 0,
+        read_memory_stat(cgroup))
+    scanned = 0
+    reclaim_after, reclaim_backoff = 0, RECLAIM_BACKOFF
+    while stop is None or not stop.is_set():
+        reason = waiter.wait(*policy.interval(working))
+        woke = time.time()
+        used = read_int([f'{cgroup}/memory.current',
+                         f'{cgroup}/memory/memory.usage_in_bytes'])
+        if not used:
+            working = 0
+            continue
+        stat = read_memory_stat(cgroup)
+        working = get_working_set(used, stat)
+        policy.update_usage(time.monotonic(), working)
+        telemetry.counters['wakeups'] = waiter.wakeups
+        sample = {'t': woke, 'limit': limit, 'used': used,
+                  'working': working, 'psi': read_psi(cgroup),
+                  'rate': round(policy.rate), **(stat or {})}
 
-    while True:
-        time.sleep(0.5)
-        used = read_int(['/sys/fs/cgroup/memory.current',
-                         '/sys/fs/cgroup/memory/memory.usage_in_bytes'])
+        # sample the processes as memory gets short, for their growth,
+        # and for the telemetry every TELEMETRY_SCAN_INTERVAL sec
+        near = policy.is_near(working)
+        if near or time.monotonic() - scanned > TELEMETRY_SCAN_INTERVAL:
+            scanned = time.monotonic()
+            scan_time = table.refresh()
+            groups = table.groups()
+            sizes = {root: sum(table.entries[pid]['rss'] for pid in pids)
+                     for root, pids in groups.items()}
+            if near:
+                policy.update_processes(time.monotonic(), sizes)
+            top = sorted(sizes, key=sizes.get)[-TELEMETRY_TOP:]
+            sample['procs'] = {
+                pid: [sizes[pid], table.entries[pid]['cmd'][:200]]
+                for pid in reversed(top)}
+        telemetry.add(sample)
+        telemetry.write()
 
-        # If memory is safe, do nothing
-        if not used or (limit - used) > buffer_bytes:
+        # If the working set is safe, do nothing. When the page cache
+        # alone brings the usage near the limit, drop clean file pages
+        # ahead of the kernel, backing off while that fails (e.g. cgroup
+        # v1 or a read-only cgroupfs)
+        if not policy.should_act(working):
+            if (stat is None or limit - used > buffer_bytes or
+                    time.monotonic() < reclaim_after):
+                continue
+            target = min(used - working,
+                         RECLAIM_MARGIN + buffer_bytes - (limit - used))
+            start = time.time()
+            done = reclaim(target, cgroup)
+            telemetry.counters['reclaims'] += 1
+            if done:
+                reclaim_backoff = RECLAIM_BACKOFF
+            else:
+                reclaim_after = time.monotonic() + reclaim_backoff
+                reclaim_backoff = min(2 * reclaim_backoff,
+                                      RECLAIM_BACKOFF_MAX)
+            print(f"[OOM_WATCH] Mostly page cache (anon: "
+                  f"{stat['anon']//1024**2}MB, file: "
+                  f"{stat['file']//1024**2}MB); "
+                  f"reclaim of {target//1024**2}MB "
+                  f"{'done' if done else 'partial or unavailable'} in "
+                  f"{(time.time() - start) * 1000:.0f}ms. Not killing.")
             continue
 
         print(("[OOM_WATCH] Low memory! "
-               f"({used//1024**2}MB / {limit//1024**2}MB). Scanning..."))
-        processes = []
-
-        # Scan all numeric directories in /proc
-        for p in Path('/proc').glob('[0-9]*'):
-            try:
-                cmd = p.joinpath(
-                    'cmdline').read_text().replace('\0', ' ').strip()
-                pid = int(p.name)
-
-                # Skip empty commands, protected system processes,
-                # and the watchdog itself
-                if (
-                    not cmd or
-                    any(x in cmd for x in PROTECTED) or
-                    pid == os.getpid()
-                ) and 'runtime/kernel' not in cmd:
-                    print(f"[OOM_WATCH] skipping: {cmd}")
-                    continue
-
-                # statm 2nd column is RSS in 4KB pages
-                mem_bytes = int(
-                    p.joinpath('statm').read_text().split()[1]) * 4096
-
-                # Only add to our list if it's actually large enough to matter
-                if mem_bytes >= (MIN_KILL_MB * 1024 * 1024):
-                    processes.append((pid, mem_bytes, cmd))
+               f"({working//1024**2}MB working set, {used//1024**2}MB / "
+               f"{limit//1024**2}MB used, growing "
+               f"{policy.rate/1024**2:.0f}MB/s, woke by: {reason})."))
 
-            except Exception:
-                pass  # Process exited while reading
+        print(f"[OOM_WATCH] Scanned {len(table.entries)} processes in "
+              f"{scan_time * 1000:.1f}ms")
+        victim = policy.choose(
+            table.candidates(MIN_KILL_MB * 1024 * 1024, groups))
 
-        if processes:
-            # Find the largest non-protected process
-            pid, mem, cmd = max(processes, key=lambda x: x[1])
+        if victim:
+            pid, mem, cmd = victim
             mem_mb = mem // 1024**2
-            print(f"[OOM_WATCH] Killing PID {pid} ({mem_mb}MB): {cmd[:200]}")
+            rate = policy.procs.get(pid, (0, 0, 0.0))[2]
+            tree = table.verify(groups[pid])
+            if pid not in tree:
+                # the pid was reused; look again at the next wake up
+                continue
+            # stop the whole tree, the workers first, before anything slow
+            for tree_pid in reversed(tree):
+                try:
+                    kill(tree_pid, signal.SIGTERM)
+                except Exception:
+                    pass
+            reaction = (time.time() - woke) * 1000
+
+            notebook = find_notebook(cmd)
+            print(f"[OOM_WATCH] Killed PID {pid} and {len(tree) - 1} "
+                  f"children ({mem_mb}MB PSS, growing "
+                  f"{rate/1024**2:.0f}MB/s, notebook: {notebook}): "
+                  f"{cmd[:200]}")
+            print(f"[OOM_WATCH] Reaction time: {reaction:.0f}ms from wake "
+                  f"up to SIGTERM; {waiter.wakeups} wake ups so far")
 
-            # Notify user and kill
+            # Notify user
             msg = ("SYSTEM ALERT: Process terminated to prevent server "
-                   f"crash.\nTime: {time.ctime()}\nProcess: "
-                   f"{cmd}\nMemory: ~{mem_mb} MB")
+                   f"crash.\nTime: {time.ctime()}\n"
+                   + (f"Notebook: {notebook}\n" if notebook else "") +
+                   f"Process: {cmd}\n"
+                   f"Child processes: {len(tree) - 1}\n"
+                   f"Memory: ~{mem_mb} MB")
             try:
                 # write to a notification file
-                notification_file = (Path(os.environ.get("HOME", "/tmp")) /
+                notification_file = (Path(home) /
                                      "_PROCESS_STOPPED_DUE_TO_MEMORY.txt")
                 notification_file.write_text(msg)
                 notification_file.chmod(0o666)
             except Exception:
                 pass
 
-            try:
-                os.kill(pid, signal.SIGTERM)
-            except Exception:
-                pass
+            telemetry.counters['kills'] += 1
+            telemetry.write(force=True)
+            print(f"[OOM_WATCH] Samples saved to {telemetry.dump()}")
 
             # Wait for OS to reclaim memory before checking again
-            time.sleep(10)
+            if stop is None:
+                time.sleep(KILL_WAIT)
+            else:
+                stop.wait(KILL_WAIT)
 
 
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        # if --delay is passed, wait for 3min before starting
-        if sys.argv[1] == '--delay':
-            time.sleep(3 * 60)
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--delay', action='store_true', default=False,
+                    help='Wait for 3min before starting')
+    ap.add_argument('--telemetry-dir', default=TELEMETRY_DIR,
+                    help=('Folder for the memory samples (metrics.prom, '
+                          f'samples.jsonl, kill-*.jsonl). Default: '
+                          f'{TELEMETRY_DIR}'))
+    args = ap.parse_args()
+
+    # if --delay is passed, wait for 3min before starting
+    if args.delay:
+        time.sleep(3 * 60)
 
     # start the watcher
-    watchdog()
+    watchdog(args.telemetry_dir)
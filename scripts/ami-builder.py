@@ -1,9 +1,14 @@
 
 import requests
+import urllib3
 import argparse
 import logging
 import os
 import re
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 # logging
 logging.basicConfig(
@@ -15,6 +20,220 @@ logger = logging.getLogger('::AMI-Builder::')
 logger.setLevel(level=logging.DEBUG)
 
 
+# where the container packages of fornax-images are listed
+PACKAGES_PATH = '/users/nasa-fornax/packages/container/fornax-images%2F{}/versions'  # noqa E501
+# versions per page of the packages API (max 100)
+PER_PAGE = 100
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'fornax-ami-builder')
+
+
+def parse_links(header):
+    """Parse a Link header into {rel: url}"""
+    links = {}
+    for link in header.split(','):
+        parts = link.split(';')
+        if len(parts) < 2:
+            continue
+        match = re.search(r'rel="(\w+)"', parts[1])
+        if match:
+            links[match[1]] = parts[0].strip()[1:-1]
+    return links
+
+
+class DateTagResolver:
+    """Look up the date tags of images from the GitHub packages API.
+
+    All the images are resolved at once; each package is listed once, and
+    its pages are fetched concurrently. The pages are cached on disk with
+    their ETag, and revalidated with If-None-Match, which does not count
+    against the rate limit when nothing changed.
+    """
+
+    def __init__(self, token=None, api_url=None, cache_dir=DEFAULT_CACHE_DIR,
+                 jobs=8, timeout=30):
+        """Create a resolver
+
+        Parameters:
+        ----------
+        token: str
+            GitHub token. Default: GITHUB_TOKEN environment variable
+        api_url: str
+            GitHub API url. Default: GITHUB_API_URL environment variable,
+            or https://api.github.com
+        cache_dir: str
+            Folder for the cached pages of each package; None disables it
+        jobs: int
+            Number of pages fetched at the same time
+        timeout: float
+            Timeout (sec) of each request
+
+        """
+        if token is None:
+            token = os.environ.get('GITHUB_TOKEN', None)
+        if token is None:
+            raise ValueError('GITHUB_TOKEN not defined')
+        if api_url is None:
+            api_url = os.environ.get(
+                'GITHUB_API_URL', 'https://api.github.com')
+        self.api_url = api_url.rstrip('/')
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Accept": "application/vnd.github.v3+json"
+        })
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=jobs, pool_maxsize=jobs)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+
+    def load_cache(self, package):
+        """Return the cached pages of {package}: {url: page}"""
+        if self.cache_dir is None:
+            return {}
+        try:
+            with open(os.path.join(self.cache_dir, f'{package}.json')) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self, package, cache):
+        """Write the cached pages of {package}"""
+        if self.cache_dir is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = os.path.join(self.cache_dir, f'{package}.json')
+        with open(f'{path}.tmp', 'w') as fp:
+            json.dump(cache, fp)
+        os.replace(f'{path}.tmp', path)
+
+    def get_page(self, url, cache):
+        """Get one page of versions, revalidating the cached copy.
+
+        Returns:
+        -------
+        a dict with the list of tags of each version ('tags'), the
+        pagination links ('links') and the 'etag'
+
+        """
+        with self.lock:
+            cached = cache.get(url)
+        headers = {}
+        if cached and cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        resp = self.session.get(url, headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and cached:
+            return cached
+        resp.raise_for_status()
+        page = {
+            'etag': resp.headers.get('ETag'),
+            'links': parse_links(resp.headers.get('Link', '')),
+            'tags': [version.get("metadata", {}).get(
+                "container", {}).get("tags", []) for version in resp.json()],
+        }
+        with self.lock:
+            cache[url] = page
+        return page
+
+    def resolve_package(self, package, tags, pool):
+        """Return {tag: date_tag} for {tags} of {package}
+
+        The first page (the most recent versions) is fetched first; the
+        next pages are fetched concurrently in {pool}, self.jobs at a time,
+        until the newest version of each tag is found (the pages are
+        sorted newest first).
+        """
+        cache = self.load_cache(package)
+        url = (f'{self.api_url}{PACKAGES_PATH.format(package)}'
+               f'?per_page={PER_PAGE}&page=1')
+        pages = [self.get_page(url, cache)]
+
+        def done():
+            return len(find_tags(pages, tags)) == len(tags)
+
+        links = pages[0]['links']
+        if not done() and 'last' in links:
+            last = int(re.search(r'[?&]page=(\d+)', links['last'])[1])
+            urls = [re.sub(r'([?&]page=)\d+', fr'\g<1>{num}', url)
+                    for num in range(2, last + 1)]
+            for start in range(0, len(urls), self.jobs):
+                pages += pool.map(lambda url: self.get_page(url, cache),
+                                  urls[start:start + self.jobs])
+                if done():
+                    break
+        else:
+            while not done() and 'next' in pages[-1]['links']:
+                pages.append(self.get_page(pages[-1]['links']['next'], cache))
+
+        self.save_cache(package, cache)
+        return find_date_tags(pages, tags)
+
+    def resolve(self, images):
+        """Look up the date tags of {images}
+
+        Parameters:
+        ----------
+        images: list
+            images from fornax-images repo of the form: image:tag
+
+        Returns:
+        -------
+        {image: date_image}, where date_image is image:date_tag or None if
+        a unique date tag is not found
+
+        """
+        packages = {}
+        for image in images:
+            parts = image.split(':')
+            if len(parts) != 2:
+                raise ValueError(f'Expected image:tag, but got {image}')
+            packages.setdefault(parts[0], []).append(parts[1])
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool, \
+                ThreadPoolExecutor(max_workers=len(packages) or 1) as outer:
+            futures = {
+                package: outer.submit(
+                    self.resolve_package, package, tags, pool)
+                for package, tags in packages.items()
+            }
+            found = {package: future.result()
+                     for package, future in futures.items()}
+
+        result = {}
+        for image in images:
+            package, tag = image.split(':')
+            date_tag = found[package].get(tag)
+            result[image] = (None if date_tag is None
+                             else f'{package}:{date_tag}')
+        return result
+
+
+def find_tags(pages, tags):
+    """Return {tag: date_tag} for the {tags} found in {pages}, from the
+    most recent version with the tag; date_tag is None if that version
+    does not have a unique date tag"""
+    pattern = re.compile(r"\d{8}_\d{4}")
+    found = {}
+    for page in pages:
+        for version_tags in page['tags']:
+            for tag in tags:
+                if tag in version_tags and tag not in found:
+                    matches = [tg for tg in version_tags if pattern.search(tg)]
+                    found[tag] = matches[0] if len(matches) == 1 else None
+    return found
+
+
+def find_date_tags(pages, tags):
+    """Return {tag: date_tag} for the {tags} found in {pages}; the most
+    recent version with the tag is used"""
+    return {tag: date_tag for tag, date_tag in find_tags(pages, tags).items()
+            if date_tag is not None}
+
+
 def get_image_date_tag(image):
     """Use GH API to look up the data tag give a name tag
 
@@ -24,46 +243,98 @@ def get_image_date_tag(image):
         image from fornax-images repo of the form: image:tag
 
     """
-    parts = image.split(':')
-    if len(parts) != 2:
-        raise ValueError(f'Expected image:tag, but got {image}')
-    image = parts[0]
-    input_tag = parts[1]
-
-    GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN', None)
-    if GITHUB_TOKEN is None:
-        raise ValueError('GITHUB_TOKEN not defined')
-    headers = {
-        "Authorization": f"Bearer {GITHUB_TOKEN}",
-        "Accept": "application/vnd.github.v3+json"
-    }
-    session = requests.Session()
+    date_image = DateTagResolver().resolve([image])[image]
+    return None if date_image is None else date_image.split(':')[1]
 
-    # get all tags
-    url = f'https://api.github.com/users/nasa-fornax/packages/container/fornax-images%2F{image}/versions'  # noqa E501
-    matched_tags = []
-    while url and len(matched_tags) == 0:
-        resp = session.get(url, headers=headers)
-        resp.raise_for_status()
-        data = resp.json()
-        for version in data:
-            tags = version.get(
-                "metadata", {}).get("container", {}).get("tags", [])
-            if input_tag in tags:
-                matched_tags = tags
-                break
-        # pagination
-        url = None
-        if "Link" in resp.headers:
-            links = resp.headers["Link"].split(",")
-            for link in links:
-                if 'rel="next"' in link:
-                    url = link.split(";")[0].strip()[1:-1]
 
-    pattern = re.compile(r"\d{8}_\d{4}")
-    matches = [tag for tag in matched_tags if pattern.search(tag)]
-    date_tag = matches[0] if len(matches) == 1 else None
-    return date_tag
+def load_prefetch(path, images):
+    """Return the ordered files to pre-warm for each of {images}, from
+    the output of startup-profile.py in {path}
+
+    Returns:
+    -------
+    {image name: [path, ...]}
+
+    """
+    with open(path) as fp:
+        profiles = json.load(fp)
+    prefetch = {}
+    for image in images:
+        name = image.split(':')[0]
+        if name not in profiles:
+            logger.warning(f'No startup profile for {name} in {path}')
+            continue
+        prefetch[name] = [file[0] for file in profiles[name]['files']]
+    return prefetch
+
+
+def is_not_sent(err):
+    """Return True if the request of the ConnectionError {err} never
+    reached the server: a connect timeout, or a refused or unresolved
+    connection"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(err.args[0], 'reason', None) if err.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def trigger_endpoint(session, endpoint, params, timeout=300, retries=2,
+                     retry_delay=5):
+    """Post {params} to one builder endpoint.
+
+    Connections that could not be opened and 429/503 responses (the
+    builder did not take the call) are retried with exponential backoff.
+    A read timeout, a connection dropped after the post was sent, or a
+    502/504 response is not, as the build may already be running, and a
+    retry could start a second one.
+
+    Returns:
+    -------
+    dict with the endpoint 'status' (None if no response), 'text',
+    'error' (None for a 200 status), 'attempts' and 'seconds'
+
+    """
+    start = time.time()
+    result = {'status': None, 'text': '', 'error': None}
+    for attempt in range(retries + 1):
+        result['attempts'] = attempt + 1
+        try:
+            resp = session.post(endpoint, json=params, timeout=timeout)
+            result['status'] = resp.status_code
+            result['text'] = resp.text
+            result['error'] = (None if resp.status_code == 200 else
+                               f'status {resp.status_code}')
+            retry = resp.status_code in (429, 503)
+        except requests.exceptions.ConnectionError as err:
+            result['error'] = f'connection error: {err}'
+            retry = is_not_sent(err)
+        except requests.exceptions.RequestException as err:
+            result['error'] = f'{type(err).__name__}: {err}'
+            retry = False
+        if result['error'] is None or not retry or attempt == retries:
+            break
+        time.sleep(retry_delay * 2**attempt)
+    result['seconds'] = time.time() - start
+    return result
+
+
+def trigger_endpoints(endpoints, params, timeout=300, retries=2,
+                      retry_delay=5):
+    """Post {params} to all {endpoints} at the same time.
+
+    Returns:
+    -------
+    list of results of trigger_endpoint, in the order of {endpoints}
+
+    """
+    session = requests.Session()
+    with ThreadPoolExecutor(max_workers=len(endpoints) or 1) as pool:
+        futures = [
+            pool.submit(trigger_endpoint, session, endpoint, params,
+                        timeout, retries, retry_delay)
+            for endpoint in endpoints
+        ]
+    return [future.result() for future in futures]
 
 
 def main():
@@ -100,6 +371,31 @@ def main():
         help='Trigger endpoint'
     )
 
+    ap.add_argument(
+        '--cache-dir',
+        default=DEFAULT_CACHE_DIR,
+        help=("Folder to cache the package versions from the GitHub API. "
+              f"Default: {DEFAULT_CACHE_DIR}")
+    )
+
+    ap.add_argument(
+        '--timeout', type=float, default=300,
+        help='Timeout (sec) of each endpoint call. Default: 300'
+    )
+
+    ap.add_argument(
+        '--retries', type=int, default=2,
+        help=("Number of retries of an endpoint call that could not reach "
+              "the builder. Default: 2")
+    )
+
+    ap.add_argument(
+        '--prefetch',
+        default=None,
+        help=("Output of startup-profile.py; the files read at startup by "
+              "each image are passed to the builder to pre-warm the AMI")
+    )
+
     ap.add_argument(
         '--launch', action='store_true',
         help='Run the builder',
@@ -130,12 +426,12 @@ def main():
 
     # Find the date tag for the passed images
     date_images = []
-    for image in images:
-        name, tag = image.split(':')
-        date_tag = get_image_date_tag(image)
-        if date_tag is None:
-            raise ValueError(f'Cannot find a date tag for {image}')
-        date_images.append(f'{name}:{date_tag}')
+    if images:
+        resolved = DateTagResolver(cache_dir=args.cache_dir).resolve(images)
+        for image in images:
+            if resolved[image] is None:
+                raise ValueError(f'Cannot find a date tag for {image}')
+            date_images.append(resolved[image])
 
     # prepare parameters
     params = {
@@ -146,20 +442,32 @@ def main():
     if src is not None:
         params['dst'] = dst if dst is not None else ssm_path
         params['src'] = src
+    if args.prefetch is not None:
+        params['prefetch'] = load_prefetch(args.prefetch, images)
 
     # params['version'] = 1.33  # eks version
 
-    logger.info(f'Calling the builder with params ... {params}')
-    for ie, ami_endpoint in enumerate(ami_endpoints):
-        logger.info(f'Calling endpoint {ie+1}')
-        req = requests.post(ami_endpoint, json=params)
+    # the prefetch lists are long; only log their length
+    shown = dict(params)
+    if 'prefetch' in shown:
+        shown['prefetch'] = {name: f'{len(files)} files'
+                             for name, files in shown['prefetch'].items()}
+    logger.info(f'Calling the builder with params ... {shown}')
+    results = trigger_endpoints(ami_endpoints, params, timeout=args.timeout,
+                                retries=args.retries)
 
-    logger.info(f'status: {req.status_code}')
-    logger.info(f'text: {req.text}')
+    # the endpoints are secrets; only report their index
+    logger.info('endpoint | status | attempts | seconds | error')
+    for ie, result in enumerate(results):
+        logger.info(f"{ie+1:8d} | {str(result['status']):>6} | "
+                    f"{result['attempts']:8d} | {result['seconds']:7.1f} | "
+                    f"{result['error'] or ''}")
+        logger.info(f"endpoint {ie+1} text: {result['text']}")
 
-    # raise for status != 200
-    if req.status_code != 200:
-        raise ValueError('Call returned with status != 200')
+    # raise if any call failed
+    failed = [ie + 1 for ie, result in enumerate(results) if result['error']]
+    if failed:
+        raise ValueError(f'Calls to endpoints {failed} failed')
 
 
 if __name__ == '__main__':
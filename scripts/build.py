@@ -1,12 +1,23 @@
 import logging
 import sys
 import os
+import re
+import json
+import base64
+import hashlib
+import threading
+import contextlib
 import shutil
+import tarfile
+import urllib.parse
 import urllib.request
 import urllib.error
+import http.client
+import random
 import time
 import argparse
 import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 
 
@@ -30,6 +41,853 @@ SOFTWARE_IMAGES = [
     im for im in IMAGE_ORDER if im.startswith('env-') or '-nb' in im
 ]
 COMMON_FILES = ['introduction.md', 'changes.md']
+# resources that can be limited with --budget. The per-image costs come from
+# the --costs file; 'duration' (sec) is used to order the builds
+RESOURCES = ('memory', 'cpu', 'disk')
+DEFAULT_COST = {'duration': 1, 'memory': 0, 'cpu': 0, 'disk': 0}
+DEFAULT_STATE_FILE = '.build-state.json'
+DEFAULT_BAKE_FILE = 'docker-bake.json'
+DEFAULT_JOURNAL_FILE = '.build-journal.json'
+# first wait (sec) before retrying a failed push; doubled on every retry
+PUSH_RETRY_DELAY = 10
+# ecr notifications: parallel calls, timeout (sec) of each call, and first
+# wait (sec) before a retry, doubled on every retry, with random jitter
+ECR_JOBS = 8
+ECR_TIMEOUT = 60
+ECR_RETRY_DELAY = 1
+# redirects followed by ConnectionPool.request
+MAX_REDIRECTS = 5
+# where the kernel definitions are in the images
+KERNELS_DIR = '/opt/jupyter/share/jupyter/kernels'
+# where they are collected for the fornax-jupyter build; one staging
+# folder per image, outside of the docker build context, merged into
+# KERNELS_BUILD_DIR
+KERNELS_BUILD_DIR = 'fornax-jupyter/kernels'
+KERNELS_STAGING_DIR = '.build/kernels-staging'
+# build caches are looked up for the build tag first, then these
+CACHE_FALLBACK_TAGS = ['develop', 'main']
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# matches: FROM ${REPOSITORY}/image-name:${BASE_TAG} ...
+FROM_PATTERN = re.compile(
+    r'^\s*FROM\s+\$\{?REPOSITORY\}?/([\w.-]+):', re.MULTILINE)
+
+
+# media types of manifests and manifest lists (indexes)
+MANIFEST_TYPES = (
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json',
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+)
+
+
+class ConnectionPool:
+    """Keep-alive http(s) connections, one per host and thread, so
+    repeated calls to the same endpoint reuse their connection"""
+
+    def __init__(self, timeout=ECR_TIMEOUT):
+        """Create an empty pool
+
+        Parameters:
+        -----------
+        timeout: float
+            Timeout (sec) of each call
+
+        """
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get_connection(self, scheme, netloc):
+        """Return the connection of this thread to {scheme}://{netloc}"""
+        conns = self.local.__dict__.setdefault('connections', {})
+        if (scheme, netloc) not in conns:
+            conn_class = (http.client.HTTPSConnection if scheme == 'https'
+                          else http.client.HTTPConnection)
+            conn = conn_class(netloc, timeout=self.timeout)
+            conns[(scheme, netloc)] = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conns[(scheme, netloc)]
+
+    def drop_connection(self, scheme, netloc):
+        """Close the connection of this thread to {scheme}://{netloc}, so
+        the next request opens a new one"""
+        conn = self.local.__dict__.get('connections', {}).pop(
+            (scheme, netloc), None)
+        if conn is not None:
+            conn.close()
+            with self.lock:
+                self.connections.remove(conn)
+
+    def request(self, method, url):
+        """Call {url}, following up to MAX_REDIRECTS redirects like
+        urlopen does (a 303 becomes a GET).
+
+        Returns:
+        --------
+        (status, body)
+
+        """
+        for _ in range(MAX_REDIRECTS):
+            status, headers, body = self.send(method, url)
+            location = headers.get('Location')
+            if status not in (301, 302, 303, 307, 308) or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+            if status == 303:
+                method = 'GET'
+        return status, body
+
+    def send(self, method, url):
+        """Send one request, reconnecting once if the kept-alive
+        connection was closed by the server. After any other error (e.g.
+        a timeout) the connection is dropped before raising, so it is not
+        left half-used for the next requests.
+
+        Returns:
+        --------
+        (status, headers, body)
+
+        """
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += f'?{parts.query}'
+        for attempt in range(2):
+            conn = self.get_connection(parts.scheme, parts.netloc)
+            try:
+                conn.request(method, path)
+                resp = conn.getresponse()
+                return resp.status, resp.headers, resp.read()
+            except (http.client.RemoteDisconnected, BrokenPipeError,
+                    ConnectionResetError):
+                self.drop_connection(parts.scheme, parts.netloc)
+                if attempt == 1:
+                    raise
+            except BaseException:
+                self.drop_connection(parts.scheme, parts.netloc)
+                raise
+
+    def close(self):
+        """Close all the connections"""
+        with self.lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections = []
+
+
+class RegistryClient:
+    """Minimal client for the OCI distribution API of a registry"""
+
+    def __init__(self, repo, timeout=300):
+        """Initialize the client
+
+        Parameters:
+        -----------
+        repo: str
+            Registry and repository, e.g. ghcr.io/nasa-fornax/fornax-images.
+            localhost registries are accessed with http.
+        timeout: int
+            Timeout in sec of each request
+
+        """
+        host, _, path = repo.partition('/')
+        local = host.split(':')[0] in ('localhost', '127.0.0.1')
+        self.host = host
+        self.url = f"{'http' if local else 'https'}://{host}/v2"
+        self.path = f'{path}/' if path else ''
+        self.timeout = timeout
+        # {scope: 'Bearer ...'}
+        self.auth = {}
+
+    def get_credentials(self):
+        """Return 'user:password' for the registry from REGISTRY_USERNAME
+        and REGISTRY_PASSWORD, or from 'docker login', or None"""
+        password = os.environ.get('REGISTRY_PASSWORD')
+        if password is not None:
+            return f"{os.environ.get('REGISTRY_USERNAME', 'user')}:{password}"
+        config = os.path.join(os.environ.get(
+            'DOCKER_CONFIG', os.path.expanduser('~/.docker')), 'config.json')
+        try:
+            with open(config) as fp:
+                auth = json.load(fp)['auths'][self.host]['auth']
+            return base64.b64decode(auth).decode()
+        except Exception:
+            return None
+
+    def authenticate(self, challenge, scope):
+        """Return the Authorization header answering a 401 {challenge}"""
+        scheme, _, params = challenge.partition(' ')
+        params = dict(re.findall(r'(\w+)="([^"]*)"', params))
+        credentials = self.get_credentials()
+        basic = None
+        if credentials is not None:
+            basic = 'Basic ' + base64.b64encode(credentials.encode()).decode()
+        if scheme.lower() == 'basic':
+            return basic
+
+        query = urllib.parse.urlencode(
+            {'service': params.get('service', ''), 'scope': scope})
+        request = urllib.request.Request(f"{params['realm']}?{query}")
+        if basic is not None:
+            request.add_header('Authorization', basic)
+        with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+            token = json.load(resp)
+        return f"Bearer {token.get('token') or token.get('access_token')}"
+
+    def open(self, method, image, endpoint, data=None, headers=None):
+        """Make a request to /v2/{repo}/{image}/{endpoint}, authenticating
+        when the registry asks for it.
+
+        Returns:
+        --------
+        The open response; to be closed by the caller
+
+        """
+        name = f'{self.path}{image}'
+        url = f'{self.url}/{name}/{endpoint}'
+        actions = 'pull' if method in ('GET', 'HEAD') else 'pull,push'
+        scope = f'repository:{name}:{actions}'
+        for attempt in range(2):
+            request = urllib.request.Request(
+                url, data=data, method=method, headers=headers or {})
+            if scope in self.auth:
+                # blobs may redirect to a storage that has its own auth
+                request.add_unredirected_header(
+                    'Authorization', self.auth[scope])
+            try:
+                return urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as err:
+                challenge = err.headers.get('WWW-Authenticate')
+                if err.code != 401 or challenge is None or attempt == 1:
+                    raise
+                self.auth[scope] = self.authenticate(challenge, scope)
+
+    def request(self, method, image, endpoint, data=None, headers=None):
+        """Make a request with self.open and read the response
+
+        Returns:
+        --------
+        (headers, body) of the response
+
+        """
+        with self.open(method, image, endpoint, data, headers) as resp:
+            return resp.headers, resp.read()
+
+    def get_manifest(self, image, reference):
+        """Return (media_type, raw bytes) of the manifest, or manifest
+        list, of {image}:{reference}"""
+        headers, body = self.request(
+            'GET', image, f'manifests/{reference}',
+            headers={'Accept': ', '.join(MANIFEST_TYPES)})
+        return headers.get('Content-Type'), body
+
+    def put_manifest(self, image, reference, media_type, body):
+        """Upload the raw manifest {body} as {image}:{reference}"""
+        self.request('PUT', image, f'manifests/{reference}', data=body,
+                     headers={'Content-Type': media_type})
+
+    def retag(self, image, source_tag, new_tags):
+        """Tag the manifest of {image}:{source_tag} with each of
+        {new_tags}; no layers are transferred.
+
+        Returns:
+        --------
+        The number of manifest bytes transferred
+
+        """
+        media_type, body = self.get_manifest(image, source_tag)
+        for tag in new_tags:
+            self.put_manifest(image, tag, media_type, body)
+        return len(body) * (len(new_tags) + 1)
+
+    def get_image(self, image, tag, platform='linux/amd64'):
+        """Return (config, layers) of {image}:{tag}, where config is the
+        image configuration and layers the list of layer digests, from
+        the bottom layer to the top one. For a manifest list, the
+        manifest of {platform} is used."""
+        _, body = self.get_manifest(image, tag)
+        manifest = json.loads(body)
+        if 'manifests' in manifest:
+            os_name, arch = platform.split('/')
+            digests = [
+                item['digest'] for item in manifest['manifests']
+                if item.get('platform', {}).get('os') == os_name and
+                item.get('platform', {}).get('architecture') == arch
+            ]
+            if len(digests) == 0:
+                raise ValueError(f'No {platform} manifest for {image}:{tag}')
+            _, body = self.get_manifest(image, digests[0])
+            manifest = json.loads(body)
+        _, config = self.request(
+            'GET', image, f"blobs/{manifest['config']['digest']}")
+        layers = [(layer['digest'], layer.get('size', 0))
+                  for layer in manifest['layers']]
+        return json.loads(config), layers
+
+    def open_blob(self, image, digest):
+        """Return an open stream of the blob {digest} of {image}"""
+        return self.open('GET', image, f'blobs/{digest}')
+
+
+def expand_env(path, env):
+    """Expand $VAR and ${VAR} in {path} from the image environment {env};
+    a list of 'VAR=value'"""
+    env = dict(var.split('=', 1) for var in env if '=' in var)
+    return re.sub(r'\$\{?(\w+)\}?',
+                  lambda match: env.get(match[1], match[0]), path)
+
+
+def read_layer(fileobj, prefixes):
+    """Read one layer tarball from the stream {fileobj}.
+
+    Returns:
+    --------
+    dict with: 'files' {path: (TarInfo, data)} for the entries under any of
+    {prefixes}, 'hidden' the paths deleted by whiteout files, 'opaque'
+    the folders whose content in lower layers is hidden, and 'links'
+    {path: (TarInfo, target)} the hardlinks to files outside {prefixes}
+    (see read_link_targets).
+
+    """
+    layer = {'files': {}, 'hidden': [], 'opaque': [], 'links': {}}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            path = os.path.normpath(member.name).lstrip('/')
+            folder, name = os.path.split(path)
+            if name == '.wh..wh..opq':
+                layer['opaque'].append(folder)
+            elif name.startswith('.wh.'):
+                layer['hidden'].append(os.path.join(folder, name[4:]))
+            elif any(path.startswith(prefix) for prefix in prefixes):
+                data = None
+                if member.isfile():
+                    data = tar.extractfile(member).read()
+                elif member.islnk():
+                    target = os.path.normpath(member.linkname).lstrip('/')
+                    if target not in layer['files']:
+                        layer['links'][path] = (member, target)
+                        continue
+                    data = layer['files'][target][1]
+                    member.type = tarfile.REGTYPE
+                layer['files'][path] = (member, data)
+    return layer
+
+
+def read_link_targets(fileobj, layer):
+    """Read the targets of the hardlinks of {layer} (from read_layer)
+    from the layer tarball {fileobj}, read again, and add the links to
+    its files. Links whose target is not found stay in layer['links']."""
+    targets = {target for _, target in layer['links'].values()}
+    data = {}
+    with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+        for member in tar:
+            path = os.path.normpath(member.name).lstrip('/')
+            if path in targets and member.isfile():
+                data[path] = tar.extractfile(member).read()
+    for path, (member, target) in list(layer['links'].items()):
+        if target in data:
+            member.type = tarfile.REGTYPE
+            layer['files'][path] = (member, data[target])
+            del layer['links'][path]
+
+
+class LayerReader:
+    """Collect the files under some folders of an image from its layers,
+    without running a container.
+
+    Layers are merged top-down: the first version of a file found is the
+    one visible in the image, and whiteout files hide the paths in the
+    layers below them.
+    """
+
+    def __init__(self, prefixes):
+        """Initialize the reader
+
+        Parameters:
+        -----------
+        prefixes: list
+            Absolute folders to collect, e.g. /opt/envs/lock
+
+        """
+        self.prefixes = [prefix.strip('/') + '/' for prefix in prefixes]
+        self.files = {}
+        self.hidden = []
+        self.opaque = []
+        # visible hardlinks whose target could not be read
+        self.dropped = []
+        # bytes of the layers read
+        self.nbytes = 0
+
+    def is_hidden(self, path):
+        """Is {path} hidden by a whiteout in the layers merged so far?"""
+        return (
+            any(path == hidden or path.startswith(hidden + '/')
+                for hidden in self.hidden) or
+            any(path.startswith(folder + '/') for folder in self.opaque)
+        )
+
+    @property
+    def done(self):
+        """True when nothing in lower layers can be visible anymore"""
+        return all(self.is_hidden(prefix + '_') for prefix in self.prefixes)
+
+    def merge(self, layer):
+        """Merge a {layer} from read_layer that is below the ones merged
+        so far"""
+        for path, entry in layer['files'].items():
+            if path not in self.files and not self.is_hidden(path):
+                self.files[path] = entry
+        self.dropped += [path for path in layer.get('links', {})
+                         if path not in self.files and
+                         not self.is_hidden(path)]
+        self.hidden += layer['hidden']
+        self.opaque += layer['opaque']
+
+    def add_layer(self, fileobj):
+        """Read a layer from the stream {fileobj} and merge it"""
+        self.merge(read_layer(fileobj, self.prefixes))
+
+    def write(self, prefix, destination):
+        """Write the files under {prefix} to the {destination} folder,
+        like 'cp -r {prefix}/* {destination}/'.
+
+        Symbolic links to paths under {prefix} are made relative, so they
+        point into {destination}; the ones to other paths would point to
+        files of the host, and are skipped.
+
+        Returns:
+        --------
+        list of the paths of the skipped links
+
+        """
+        prefix = prefix.strip('/') + '/'
+        skipped = []
+        for path in sorted(self.files):
+            if not path.startswith(prefix):
+                continue
+            info, data = self.files[path]
+            target = os.path.join(destination, path[len(prefix):])
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            if os.path.lexists(target) and not os.path.isdir(target):
+                os.remove(target)
+            if info.isdir():
+                os.makedirs(target, exist_ok=True)
+            elif info.issym():
+                link = os.path.normpath(os.path.join(
+                    '/', os.path.dirname(path), info.linkname)).lstrip('/')
+                if not (link + '/').startswith(prefix):
+                    skipped.append(path)
+                    continue
+                os.symlink(os.path.relpath(
+                    os.path.join(destination, link[len(prefix):]),
+                    os.path.dirname(target)), target)
+            elif info.isfile():
+                with open(target, 'wb') as fp:
+                    fp.write(data)
+                os.chmod(target, (info.mode & 0o777) | 0o600)
+        return skipped
+
+
+class BuildTrace:
+    """Record the start and end time, exit status and bytes moved of
+    each build phase (build, kernels, push, retag, ecr ...)"""
+
+    def __init__(self):
+        """Initialize the trace"""
+        self.start = time.time()
+        self.phases = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def phase(self, name, image=None, **info):
+        """Context manager that records a phase. It yields the phase
+        record, so the caller can add e.g. the bytes moved.
+
+        Parameters:
+        -----------
+        name: str
+            Phase name, e.g. build, push
+        image: str
+            Image name, if the phase is for one image
+        **info:
+            Other values to record, e.g. the tag
+
+        """
+        record = dict(name=name, image=image, status='ok', bytes=None,
+                      thread=threading.current_thread().name, **info)
+        start = time.time()
+        try:
+            yield record
+        except BaseException as err:
+            record['status'] = 'error'
+            record['error'] = str(err)
+            raise
+        finally:
+            record['start'] = start - self.start
+            record['end'] = time.time() - self.start
+            record['duration'] = record['end'] - record['start']
+            with self.lock:
+                self.phases.append(record)
+
+    def to_chrome(self):
+        """Return the phases in the Chrome trace event format, which can
+        be viewed in chrome://tracing or ui.perfetto.dev"""
+        threads = {}
+        events = []
+        for record in sorted(self.phases, key=lambda rec: rec['start']):
+            tid = threads.setdefault(record['thread'], len(threads) + 1)
+            events.append({
+                'name': ' '.join(
+                    str(val) for val in [record['name'], record['image'],
+                                         record.get('tag')] if val),
+                'cat': record['name'],
+                'ph': 'X',
+                'ts': int(record['start'] * 1e6),
+                'dur': int(record['duration'] * 1e6),
+                'pid': 1,
+                'tid': tid,
+                'args': {key: val for key, val in record.items()
+                         if key in ('status', 'bytes', 'error', 'tag')},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def write(self, path):
+        """Write the trace as JSON to {path}, and in the Chrome trace
+        format to {path without .json}.chrome.json"""
+        with open(path, 'w') as fp:
+            json.dump({'start': self.start, 'phases': self.phases}, fp,
+                      indent=1)
+        with open(f'{os.path.splitext(path)[0]}.chrome.json', 'w') as fp:
+            json.dump(self.to_chrome(), fp)
+
+    @staticmethod
+    def totals(phases):
+        """Return {(name, image): total duration} of {phases}; tags of the
+        same image are summed, so the time tags can be compared"""
+        totals = {}
+        for record in phases:
+            key = (record['name'], record['image'])
+            totals[key] = totals.get(key, 0) + record['duration']
+        return totals
+
+    def compare(self, previous, threshold=0.2, min_seconds=30):
+        """Compare this trace with the {previous} list of phases
+
+        Returns:
+        --------
+        list of (name, image, previous duration, duration) of the phases
+        slower by more than {threshold} (a fraction) and {min_seconds}
+
+        """
+        old = self.totals(previous)
+        regressions = []
+        for (name, image), duration in self.totals(self.phases).items():
+            before = old.get((name, image))
+            if before is None:
+                continue
+            if (duration > before * (1 + threshold) and
+                    duration - before > min_seconds):
+                regressions.append((name, image, before, duration))
+        return regressions
+
+
+# Dockerfile steps in the BuildKit progress, e.g. '[builder 3/12] RUN ...'
+STEP_PATTERN = re.compile(r'^\[(?:[\w.-]+ )?\d+/\d+\] (.*)$', re.DOTALL)
+
+
+def parse_buildkit_time(value):
+    """Return the epoch time of a BuildKit RFC 3339 time string, which
+    may have nanoseconds, or None"""
+    if not value:
+        return None
+    match = re.match(r'(.*T[\d:]+)(\.\d+)?(Z|[+-][\d:]+)$', value)
+    if match is None:
+        return None
+    base, frac, zone = match.groups()
+    zone = '+00:00' if zone == 'Z' else zone
+    stamp = datetime.fromisoformat(base + zone).timestamp()
+    return stamp + (float(frac) if frac else 0)
+
+
+def get_onbuild_steps(image):
+    """Return the ONBUILD instructions of the parents of {image}, e.g.
+    'RUN mkdir -p $HOME/build' from fornax-base"""
+    steps = []
+    for parent in get_image_parents(image):
+        dockerfile = os.path.join(REPO_DIR, parent, 'Dockerfile')
+        with open(dockerfile) as fp:
+            text = fp.read().replace('\\\n', ' ')
+        for line in text.split('\n'):
+            line = line.strip()
+            if line.startswith('ONBUILD '):
+                steps.append(' '.join(line[8:].split()))
+    return steps
+
+
+class StepProfiler:
+    """Collect the duration, cache use and layer size of every Dockerfile
+    step of a build from the BuildKit progress (--progress=rawjson)"""
+
+    def __init__(self, image, onbuild=None, print=None):
+        """Initialize the profiler
+
+        Parameters:
+        -----------
+        image: str
+            Image name
+        onbuild: list
+            ONBUILD instructions inherited by the image
+        print: callable
+            To report each step as it completes
+
+        """
+        self.image = image
+        self.onbuild = onbuild or []
+        self.print = print
+        # {digest: vertex}
+        self.vertexes = {}
+
+    def add_line(self, line):
+        """Parse one line of the rawjson progress"""
+        try:
+            status = json.loads(line)
+        except ValueError:
+            return
+        for vertex in status.get('vertexes') or []:
+            record = self.vertexes.setdefault(vertex['digest'], {})
+            done = 'completed' in record
+            record.update(vertex)
+            if not done and 'completed' in record and self.print:
+                step = self.get_step(record)
+                if step is not None:
+                    self.print(f"{self.image}: {step['step'][:80]} "
+                               f"{step['duration']:.1f}s"
+                               f"{' (cached)' if step['cached'] else ''}")
+
+    def get_step(self, vertex):
+        """Return the step record of a Dockerfile step {vertex}, or None
+        for BuildKit internal vertexes"""
+        match = STEP_PATTERN.match(vertex.get('name', ''))
+        if match is None:
+            return None
+        text = ' '.join(match[1].split())
+        start = parse_buildkit_time(vertex.get('started'))
+        end = parse_buildkit_time(vertex.get('completed'))
+        onbuild = text.startswith('ONBUILD ') or any(
+            text.startswith(step[:60]) for step in self.onbuild)
+        return {
+            'step': text,
+            'duration': (end - start) if start and end else 0.0,
+            'cached': bool(vertex.get('cached')),
+            'onbuild': onbuild,
+            'error': vertex.get('error'),
+            'size': None,
+        }
+
+    def steps(self, history=None):
+        """Return the list of Dockerfile steps, in the order they started.
+
+        Parameters:
+        -----------
+        history: list
+            Output lines of 'docker history --no-trunc --human=false
+            --format {{.Size}}|{{.CreatedBy}}', to add the layer sizes
+
+        """
+        vertexes = sorted(
+            self.vertexes.values(),
+            key=lambda vtx: parse_buildkit_time(vtx.get('started')) or 0)
+        steps = [step for step in map(self.get_step, vertexes) if step]
+
+        layers = []
+        for line in history or []:
+            size, _, created_by = line.partition('|')
+            if size.isdigit():
+                layers.append((int(size), ' '.join(created_by.split())))
+        for step in steps:
+            # e.g. 'RUN cd build ...' in 'RUN |2 A=b /bin/sh -c cd build ...'
+            command = step['step'].split(' ', 1)[-1][:60]
+            for size, created_by in layers:
+                if created_by.startswith(step['step'].split(' ')[0]) and (
+                        command in created_by):
+                    step['size'] = size
+                    break
+        return steps
+
+
+def summarize_step_history(path, top=10):
+    """Summarize the --step-profile history in {path}
+
+    Returns:
+    --------
+    list of dict(image, step, runs, mean duration, cache hit rate, size),
+    the slowest {top} steps of each image first
+
+    """
+    stats = {}
+    with open(path) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            for step in record['steps']:
+                key = (record['image'], step['step'])
+                stat = stats.setdefault(key, {
+                    'image': record['image'], 'step': step['step'],
+                    'runs': 0, 'duration': 0.0, 'cached': 0, 'size': None,
+                    'onbuild': step.get('onbuild', False)})
+                stat['runs'] += 1
+                stat['duration'] += step['duration']
+                stat['cached'] += step['cached']
+                stat['size'] = step.get('size') or stat['size']
+
+    summary = []
+    for image in IMAGE_ORDER:
+        image_stats = [stat for stat in stats.values()
+                       if stat['image'] == image]
+        for stat in image_stats:
+            stat['duration'] /= stat['runs']
+            stat['hit_rate'] = stat.pop('cached') / stat['runs']
+        image_stats.sort(key=lambda stat: -stat['duration'])
+        summary += image_stats[:top]
+    return summary
+
+
+def get_image_parents(image):
+    """Return the images that {image} starts FROM, by parsing the
+    'FROM ${REPOSITORY}/...' lines of its Dockerfile.
+
+    Parameters:
+    -----------
+    image: str
+        Image name (e.g. fornax-main or env-sas)
+
+    """
+    dockerfile = os.path.join(REPO_DIR, image, 'Dockerfile')
+    if not os.path.exists(dockerfile):
+        return []
+    with open(dockerfile) as fp:
+        text = fp.read()
+    parents = []
+    for parent in FROM_PATTERN.findall(text):
+        if parent in IMAGE_ORDER and parent not in parents:
+            parents.append(parent)
+    return parents
+
+
+def get_build_graph(images):
+    """Return the dependency graph {image: set(parents)} of {images}.
+
+    Only parents that are in {images} are kept. fornax-jupyter also depends
+    on SOFTWARE_IMAGES because their kernel files are extracted before it
+    is built.
+
+    Parameters:
+    -----------
+    images: list
+        Image names to include in the graph
+
+    """
+    graph = {}
+    for image in images:
+        parents = set(get_image_parents(image))
+        if image == 'fornax-jupyter':
+            parents.update(SOFTWARE_IMAGES)
+        graph[image] = {im for im in parents if im in images and im != image}
+    return graph
+
+
+def get_changed_images(paths):
+    """Return the images that own the changed {paths}.
+
+    A file belongs to the image of its top folder (e.g.
+    env-ciao/build-ciao.sh -> env-ciao); COMMON_FILES belong to
+    fornax-jupyter. Other files (e.g. scripts/, tests/) do not change
+    any image.
+
+    Parameters:
+    -----------
+    paths: list
+        File paths relative to the root of the repo
+
+    """
+    images = set()
+    for path in paths:
+        top = path.split('/')[0]
+        if top in IMAGE_ORDER:
+            images.add(top)
+        elif path in COMMON_FILES:
+            images.add('fornax-jupyter')
+    return [im for im in IMAGE_ORDER if im in images]
+
+
+def get_downstream_images(images):
+    """Return {images} plus every image that depends on them, directly
+    or through other images, in IMAGE_ORDER.
+
+    Parameters:
+    -----------
+    images: list
+        Image names
+
+    """
+    graph = get_build_graph(IMAGE_ORDER)
+    affected = set(images)
+    for image in IMAGE_ORDER:
+        if graph[image] & affected:
+            affected.add(image)
+    return [im for im in IMAGE_ORDER if im in affected]
+
+
+def get_kernel_precedence(images):
+    """Return {images} in the order their kernels are merged.
+
+    When several images have a kernel with the same name, the one from the
+    image later in this order is used: images follow IMAGE_ORDER, except
+    env-core, which is last because it has the python3 and base kernels.
+
+    Parameters:
+    -----------
+    images: list
+        Image names
+
+    """
+    return sorted(
+        images, key=lambda im: (im == 'env-core', IMAGE_ORDER.index(im)))
+
+
+def get_critical_paths(graph, costs):
+    """Return {image: duration of the longest path from image to the end}.
+
+    Parameters:
+    -----------
+    graph: dict
+        {image: set(parents)} as returned by get_build_graph
+    costs: dict
+        {image: {'duration': sec, ...}}; missing images use DEFAULT_COST
+
+    """
+    children = {image: set() for image in graph}
+    for image, parents in graph.items():
+        for parent in parents:
+            children[parent].add(image)
+
+    paths = {}
+
+    def path(image):
+        if image not in paths:
+            duration = costs.get(image, {}).get(
+                'duration', DEFAULT_COST['duration'])
+            paths[image] = duration + max(
+                [path(child) for child in children[image]], default=0)
+        return paths[image]
+
+    for image in graph:
+        path(image)
+    return paths
 
 
 class Builder:
@@ -48,14 +906,62 @@ class Builder:
 
         self.build = args.build
         self.push = args.push
+        self.push_jobs = args.push_jobs
+        self.push_retries = args.push_retries
+        self.ecr_retries = args.ecr_retries
+        # {image: [futures]} of pushes started while building
+        self.pushes = {}
+        # {image: future} of kernel extractions started while building
+        self.harvests = {}
+        # images requested but not built yet
+        self.pending_builds = set()
         self.retag = args.retag
+        self.retag_method = args.retag_method
         self.ecr = args.ecr
 
         self.extra_args = args.extra_args
 
         self.build_vars = args.build_vars
 
+        self.jobs = args.jobs
+
+        self.trace = None
+        self.trace_file = args.trace
+        if self.trace_file is not None:
+            self.trace = BuildTrace()
+        self.compare = args.compare
+        self.step_profile = args.step_profile
+        self.step_report = args.step_report
+        self.compare_threshold = args.compare_threshold
+        self.costs_file = args.costs
+        self.costs = {}
+        self.budget = args.budget
+        self.lock = threading.Lock()
+
+        self.changed_since = args.changed_since
+
+        self.cache_repo = args.cache_repo
+        self.cache_dir = args.cache_dir
+
+        self.bake = args.bake
+        self.bake_file = args.bake_file
+        if self.bake_file is None:
+            self.bake_file = DEFAULT_BAKE_FILE
+
+        self.skip_unchanged = args.skip_unchanged
+        self.state_file = args.state_file
+        if self.state_file is None:
+            self.state_file = DEFAULT_STATE_FILE
+        self.build_state = {}
+
+        self.journal_file = args.journal
+        self.resume = args.resume
+        if self.resume and self.journal_file is None:
+            self.journal_file = DEFAULT_JOURNAL_FILE
+        self.journal = None
+
         self.export_locks = args.export_locks
+        self.extract_from = args.extract_from
 
         self.repo = args.repo
         if self.repo is None:
@@ -120,8 +1026,19 @@ class Builder:
             'push?': self.push,
             'ecr': self.ecr if self.ecr is None else len(self.ecr),
             'retag': self.retag,
+            'retag-method': self.retag_method,
+            'extract-from': self.extract_from,
             'extra-args': self.extra_args,
             'build-args': self.build_vars,
+            'jobs': self.jobs,
+            'push-jobs': self.push_jobs,
+            'costs': self.costs_file,
+            'budget': self.budget,
+            'skip-unchanged?': self.skip_unchanged,
+            'changed-since': self.changed_since,
+            'bake?': self.bake,
+            'resume?': self.resume,
+            'cache': self.cache_repo or self.cache_dir,
             'debug?': self.debug,
             'dry-run?': self.dryrun,
 
@@ -145,6 +1062,17 @@ class Builder:
         if need_image or self.ecr is not None or self.retag:
             need_tag = True
 
+        if self.changed_since is not None:
+            changed = get_changed_images(
+                self.get_changed_files(self.changed_since))
+            affected = get_downstream_images(changed)
+            self.print(f'Images changed since {self.changed_since}: '
+                       f'{changed}; to process: {affected}', logging.INFO)
+            self.images = [
+                im for im in IMAGE_ORDER
+                if im in affected or im in (self.images or [])
+            ]
+
         if need_image and self.images is None:
             raise ValueError("No images passed")
 
@@ -161,6 +1089,16 @@ class Builder:
             if not isinstance(self.retag, list):
                 raise ValueError(f'--retag expects a list: {self.retag}')
 
+        if self.extract_from not in ('container', 'docker', 'registry'):
+            raise ValueError(
+                f'--extract-from expects container, docker or registry: '
+                f'{self.extract_from}')
+
+        if self.retag_method not in ('docker', 'registry'):
+            raise ValueError(
+                f'--retag-method expects docker or registry: '
+                f'{self.retag_method}')
+
         if self.ecr is not None:
             if not isinstance(self.ecr, list):
                 raise ValueError('--ecr expects a list')
@@ -169,6 +1107,63 @@ class Builder:
                     raise ValueError(
                         f'--ecr expects url endpoints: {ecr[:5]}***')
 
+        if not isinstance(self.jobs, int) or self.jobs < 1:
+            raise ValueError(
+                f'--jobs expects a positive integer: {self.jobs}')
+
+        if not isinstance(self.push_jobs, int) or self.push_jobs < 1:
+            raise ValueError(
+                f'--push-jobs expects a positive integer: {self.push_jobs}')
+
+        if not isinstance(self.push_retries, int) or self.push_retries < 0:
+            raise ValueError(
+                f'--push-retries expects an integer >= 0: {self.push_retries}')
+
+        if not isinstance(self.ecr_retries, int) or self.ecr_retries < 0:
+            raise ValueError(
+                f'--ecr-retries expects an integer >= 0: {self.ecr_retries}')
+
+        if self.cache_repo is not None and self.cache_dir is not None:
+            raise ValueError('Use only one of --cache-repo and --cache-dir')
+
+        # exporting a cache needs a docker-container builder, which pulls
+        # the FROM images from the registry instead of using the parents
+        # just built; only bake passes them (as target: contexts)
+        if (self.cache_repo is not None or
+                self.cache_dir is not None) and not self.bake:
+            raise ValueError('--cache-repo and --cache-dir need --bake')
+
+        if self.budget is None:
+            self.budget = {}
+        elif isinstance(self.budget, str):
+            # we are expecting: 'memory=32 cpu=8' etc.
+            budget = {}
+            for var in self.budget.split():
+                name, _, value = var.partition('=')
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = -1
+                if name not in RESOURCES or value <= 0:
+                    raise ValueError(
+                        f'--budget expects "memory=32 cpu=8 disk=100": {var}')
+                budget[name] = value
+            self.budget = budget
+
+        if self.costs_file is not None and os.path.exists(self.costs_file):
+            with open(self.costs_file) as fp:
+                self.costs = json.load(fp)
+
+        if self.skip_unchanged and os.path.exists(self.state_file):
+            with open(self.state_file) as fp:
+                self.build_state = json.load(fp)
+
+        if self.journal_file is not None:
+            self.load_journal()
+
+        if self.step_report and self.step_profile is None:
+            raise ValueError('--step-report needs --step-profile')
+
         if self.build_vars is None:
             self.build_vars = []
         else:
@@ -188,11 +1183,69 @@ class Builder:
                 clean_vars.append(var)
             self.build_vars = clean_vars
 
+    def get_changed_files(self, ref):
+        """Return the files changed since the common ancestor of {ref}
+        and HEAD, including uncommitted changes.
+
+        This only reads the git tree, so it also runs with --dryrun.
+        """
+        command = f'git diff --name-only $(git merge-base {ref} HEAD)'
+        self.print(command, logging.INFO)
+        out = subprocess.run(command, shell=True, check=True, text=True,
+                             timeout=100, capture_output=True, cwd=REPO_DIR)
+        return [path.strip() for path in out.stdout.split('\n')
+                if path.strip()]
+
+    def run_with_retry(self, command, timeout, **runargs):
+        """Run system command {command} with self.run, and retry up to
+        self.push_retries times with exponential backoff if it fails.
+        """
+        for attempt in range(self.push_retries + 1):
+            try:
+                return self.run(command, timeout, **runargs)
+            except (subprocess.CalledProcessError,
+                    subprocess.TimeoutExpired) as err:
+                if attempt == self.push_retries:
+                    raise
+                delay = PUSH_RETRY_DELAY * 2**attempt
+                self.print(f'{command} failed ({err}); retrying in '
+                           f'{delay} sec ...', logging.WARNING)
+                time.sleep(delay)
+
+    def wait_all(self, futures):
+        """Wait for all {futures} and raise the first error, if any"""
+        error = None
+        for future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                self.print(str(err), logging.ERROR)
+                if error is None:
+                    error = err
+        if error is not None:
+            raise error
+
     def run_with_args(self):
         """Run the requested commands"""
         # check the input
         self.check_input()
 
+        try:
+            self.run_steps()
+        finally:
+            # without phases, keep any existing trace for --compare
+            if self.trace is not None and self.trace.phases:
+                self.print(f'Writing the build trace to {self.trace_file}')
+                self.trace.write(self.trace_file)
+
+        if self.compare is not None:
+            self.do_compare()
+
+        if self.step_report:
+            self.do_step_report()
+
+    def run_steps(self):
+        """Run the build, push, retag and ecr steps"""
         # if we are exporting files; run and exit
         if self.export_locks:
             self.do_export_locks()
@@ -200,12 +1253,24 @@ class Builder:
 
         # do we need to build an image?
         time_tag = None
+        pushed = False
         if self.build:
             time_tag = datetime.now().strftime('%Y%m%d_%H%M')
-            self.do_build(time_tag)
+            if self.journal is not None:
+                # a resumed run keeps the time_tag of the first attempt
+                time_tag = self.journal.setdefault('time_tag', time_tag)
+                self.save_journal()
+            if self.bake:
+                self.do_bake(time_tag)
+            elif self.push:
+                # push each image as soon as it is built
+                self.do_build_and_push(time_tag)
+                pushed = True
+            else:
+                self.do_build(time_tag)
 
         # do we need to push images?
-        if self.push:
+        if self.push and not pushed:
             self.do_push(time_tag)
 
         # do we need a re-tag
@@ -214,7 +1279,90 @@ class Builder:
 
         # do ecr?
         if self.ecr is not None:
-            self.do_ecr()
+            summary = self.do_ecr()
+            failed = [endpoint for endpoint, result in summary.items()
+                      if result['failed']]
+            if failed:
+                raise ValueError(
+                    f'ecr notification failed for {len(failed)} endpoints')
+
+    def load_journal(self):
+        """Start a new journal of completed steps in self.journal_file, or
+        with --resume, load the journal of the previous run"""
+        run = {
+            'images': sorted(self.images or []),
+            'tag': self.tag,
+            'retag': self.retag,
+        }
+        if not self.resume:
+            self.journal = {'run': run, 'done': []}
+            return
+        if not os.path.exists(self.journal_file):
+            raise ValueError(
+                f'--resume needs the journal {self.journal_file}')
+        with open(self.journal_file) as fp:
+            self.journal = json.load(fp)
+        if self.journal['run'] != run:
+            raise ValueError(
+                f'--resume: {self.journal_file} is for a different run: '
+                f"{self.journal['run']}")
+        self.print(f"Resuming from {self.journal_file}; "
+                   f"{len(self.journal['done'])} steps already done",
+                   logging.INFO)
+
+    def save_journal(self):
+        """Write the journal to self.journal_file"""
+        if self.dryrun:
+            return
+        tmp_file = f'{self.journal_file}.tmp'
+        with open(tmp_file, 'w') as fp:
+            json.dump(self.journal, fp, indent=2)
+        os.replace(tmp_file, self.journal_file)
+
+    def is_done(self, step, name):
+        """Return True if {step} (e.g. 'push') of {name} (e.g. a full tag)
+        was completed in the run being resumed"""
+        if self.journal is None:
+            return False
+        done = f'{step} {name}' in self.journal['done']
+        if done:
+            self.print(f'Skipping {step} of {name}; already done',
+                       logging.INFO)
+        return done
+
+    def mark_done(self, step, name):
+        """Record in the journal that {step} of {name} is completed"""
+        if self.journal is None:
+            return
+        with self.lock:
+            self.journal['done'].append(f'{step} {name}')
+            self.save_journal()
+
+    def phase(self, name, image=None, **info):
+        """Return a context manager that records a phase in the build trace
+        (see BuildTrace.phase); it does nothing without --trace"""
+        if self.trace is None:
+            return contextlib.nullcontext({})
+        return self.trace.phase(name, image, **info)
+
+    def do_compare(self):
+        """Report the phases that got slower compared to --compare"""
+        with open(self.compare) as fp:
+            previous = json.load(fp)['phases']
+        trace = self.trace or BuildTrace()
+        if not trace.phases and os.path.exists(self.trace_file or ''):
+            # nothing was run; compare the existing --trace file
+            with open(self.trace_file) as fp:
+                trace.phases = json.load(fp)['phases']
+
+        regressions = trace.compare(previous, self.compare_threshold)
+        for name, image, before, duration in regressions:
+            self.print(f'{name} {image or ""} got slower: {before:.0f} -> '
+                       f'{duration:.0f} sec', logging.WARNING)
+        if not regressions:
+            self.print(f'No phase is slower than in {self.compare}',
+                       logging.INFO)
+        return regressions
 
     def check_tags(self, *args):
         """Check the format of the tag. It should be a string
@@ -260,40 +1408,195 @@ class Builder:
             if not self.dryrun:
                 shutil.copy(file, os.path.join(destination, file))
 
-    def extract_kernel_files(self):
-        """Extract kernel files from the images to be used in fornax-jupyter
+    def read_image_files(self, image, folders):
+        """Read the files under {folders} from the layers of {image}:{tag},
+        from the local docker images or from the registry (--extract-from).
+
+        Args:
+        -----
+        image: str
+            Image name
+        folders: list
+            Absolute folders to read; they can use variables from the image
+            environment, e.g. $LOCK_DIR
+
+        Returns:
+        --------
+        (LayerReader with the files, list of the expanded folders)
+
+        """
+        full_tag = self.get_full_tag(image, self.tag)
+        self.print(f'Reading {folders} from the layers of {full_tag}',
+                   logging.INFO)
+
+        if self.extract_from == 'registry':
+            client = RegistryClient(self.repo)
+            config, layers = client.get_image(image, self.tag)
+            env = config.get('config', {}).get('Env') or []
+            folders = [expand_env(folder, env) for folder in folders]
+            reader = LayerReader(folders)
+            for digest, size in reversed(layers):
+                if reader.done:
+                    break
+                with client.open_blob(image, digest) as blob:
+                    layer = read_layer(blob, reader.prefixes)
+                reader.nbytes += size
+                if layer['links']:
+                    # hardlinks to files outside the folders
+                    with client.open_blob(image, digest) as blob:
+                        read_link_targets(blob, layer)
+                    reader.nbytes += size
+                reader.merge(layer)
+            self.warn_dropped(full_tag, reader)
+            return reader, folders
+
+        # local image: 'docker image save' has the layers in any order,
+        # so read them all, then merge them top-down. This streams the
+        # whole image, which can be slower than starting a container
+        out = self.run(f"docker image inspect --format "
+                       f"'{{{{json .Config.Env}}}}' {full_tag}", 100,
+                       capture_output=True)
+        folders = [expand_env(folder, json.loads(out.stdout) or [])
+                   for folder in folders]
+        reader = LayerReader(folders)
+        layers = {}
+        manifest = None
+        proc = subprocess.Popen(['docker', 'image', 'save', full_tag],
+                                stdout=subprocess.PIPE)
+        with tarfile.open(fileobj=proc.stdout, mode='r|') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                reader.nbytes += member.size
+                fileobj = tar.extractfile(member)
+                if member.name == 'manifest.json':
+                    manifest = json.load(fileobj)
+                    continue
+                try:
+                    layers[member.name] = read_layer(
+                        fileobj, reader.prefixes)
+                except tarfile.ReadError:
+                    # not a layer; e.g. the image config
+                    pass
+        if proc.wait() != 0 or manifest is None:
+            raise ValueError(f'Cannot read the layers of {full_tag}')
+        for name in reversed(manifest[0]['Layers']):
+            reader.merge(layers[name])
+        self.warn_dropped(full_tag, reader)
+        return reader, folders
+
+    def warn_dropped(self, full_tag, reader):
+        """Warn about the hardlinks of {reader} that could not be read"""
+        if reader.dropped:
+            self.print(f'{full_tag}: hardlinks to files outside the folders '
+                       f'were not read: {reader.dropped}', logging.WARNING)
+
+    def warn_skipped(self, image, skipped):
+        """Warn about the links of {image} skipped by LayerReader.write"""
+        if skipped:
+            self.print(f'{image}: links to files outside the folder were '
+                       f'skipped: {skipped}', logging.WARNING)
+
+    def read_images_files(self, images, folders):
+        """Run read_image_files for all {images} at the same time
+
+        Returns:
+        --------
+        {image: (LayerReader, expanded folders)}
+
         """
+        with ThreadPoolExecutor(max_workers=max(len(images), 1)) as pool:
+            futures = {
+                image: pool.submit(self.read_image_files, image, folders)
+                for image in images
+            }
+        self.wait_all(futures.values())
+        return {image: future.result() for image, future in futures.items()}
+
+    def clean_image(self, image):
+        """If we are in github actions, remove the local {image} to save
+        space; once its pushes are done, and if no pending build starts
+        from it"""
+        if os.getenv("GITHUB_ACTIONS", "").lower() != "true":
+            return
+        with self.lock:
+            pending = list(self.pending_builds)
+        if any(image in get_image_parents(im) for im in pending):
+            return
+        wait(self.pushes.get(image, []))
+        self.print(f'Cleaning docker image: {image}')
+        cmd = f'docker rmi -f {self.get_full_tag(image, self.tag)}'
+        self.run(cmd, 1000)
+
+    def harvest_kernels(self, image):
+        """Extract the kernel files of {image} to its own staging folder
+        KERNELS_STAGING_DIR/{image}"""
         extra_args = self.extra_args or ''
+        full_tag = self.get_full_tag(image, self.tag)
+        staging = os.path.join(KERNELS_STAGING_DIR, image)
+        if os.path.exists(staging):
+            shutil.rmtree(staging)
+        self.run(f'mkdir -p {staging}', 100)
+
+        self.print(f'exporting the kernel files for {image}')
+        with self.phase('kernels', image) as record:
+            if self.extract_from != 'container':
+                if not self.dryrun:
+                    reader, _ = self.read_image_files(image, [KERNELS_DIR])
+                    skipped = reader.write(KERNELS_DIR, staging)
+                    self.warn_skipped(image, skipped)
+                    record['bytes'] = reader.nbytes
+            else:
+                cmd = (
+                    'docker run --entrypoint="" --rm '
+                    f'-v $PWD/{staging}:/host '
+                    f'--user `id -u` {extra_args} '
+                    f"{full_tag} bash -c '"
+                    f"cp -r {KERNELS_DIR}/* /host/'"
+                )
+                self.run(cmd, 10000)
 
-        kernels_dir = 'fornax-jupyter/kernels'
-        if os.path.exists(kernels_dir):
-            shutil.rmtree(kernels_dir)
-        self.run(f'mkdir -p {kernels_dir}', 100)
+        self.clean_image(image)
 
-        images = SOFTWARE_IMAGES
-        # ensure env-core is last because it has python3 and base
-        images.remove('env-core')
-        images.append('env-core')
+    def extract_kernel_files(self):
+        """Extract kernel files from the images to be used in fornax-jupyter
 
-        for image in images:
+        The images are extracted at the same time, each to its staging
+        folder; those already harvested while building are reused. The
+        kernels are then merged into KERNELS_BUILD_DIR following
+        get_kernel_precedence.
+        """
+        images = get_kernel_precedence(SOFTWARE_IMAGES)
 
-            full_tag = self.get_full_tag(image, self.tag)
+        with ThreadPoolExecutor(max_workers=len(images)) as pool:
+            futures = [
+                self.harvests.get(image) or
+                pool.submit(self.harvest_kernels, image)
+                for image in images
+            ]
+            self.wait_all(futures)
 
-            self.print(f'exporting the kernel files for {image}')
-            cmd = (
-                'docker run --entrypoint="" --rm '
-                f'-v $PWD/{kernels_dir}:/host '
-                f'--user `id -u` {extra_args} '
-                f"{full_tag} bash -c '"
-                "cp -r /opt/jupyter/share/jupyter/kernels/* /host/'"
-            )
-            self.run(cmd, 10000)
+        if os.path.exists(KERNELS_BUILD_DIR):
+            shutil.rmtree(KERNELS_BUILD_DIR)
+        self.run(f'mkdir -p {KERNELS_BUILD_DIR}', 100)
 
-            # if we are in github actions, always clean the images
-            if os.getenv("GITHUB_ACTIONS", "").lower() == "true":
-                self.print(f'Cleaning docker image: {image}')
-                cmd = f'docker rmi -f {full_tag}'
-                self.run(cmd, 1000)
+        sources = {}
+        for image in images:
+            staging = os.path.join(KERNELS_STAGING_DIR, image)
+            if not os.path.isdir(staging):
+                continue
+            for kernel in sorted(os.listdir(staging)):
+                target = os.path.join(KERNELS_BUILD_DIR, kernel)
+                if kernel in sources:
+                    self.print(f'kernel {kernel} from {image} replaces the '
+                               f'one from {sources[kernel]}')
+                    shutil.rmtree(target)
+                shutil.copytree(os.path.join(staging, kernel), target,
+                                symlinks=True)
+                sources[kernel] = image
+
+        for image in images:
+            self.clean_image(image)
 
     def do_export_locks(self):
         """export the lock files from an image $LOCK_DIR/
@@ -305,6 +1608,19 @@ class Builder:
         tag: str
             image tag, e.g. develop, stable etc.
         """
+        if self.extract_from != 'container':
+            readers = {}
+            if not self.dryrun:
+                readers = self.read_images_files(self.images, ['$LOCK_DIR'])
+            for image in self.images:
+                lock_dir = f'{image}_locks'
+                self.print(f' :: Exporting locks for {image} to ./{lock_dir}')
+                if image in readers:
+                    reader, folders = readers[image]
+                    self.warn_skipped(
+                        image, reader.write(folders[0], lock_dir))
+            return
+
         for image in self.images:
             full_tag = self.get_full_tag(image, self.tag)
 
@@ -316,91 +1632,590 @@ class Builder:
                    f"{full_tag} bash -c 'cp -r $LOCK_DIR/* /host/'")
             self.run(cmd, 1000)
 
-    def do_build(self, time_tag):
-        """Build an image by calling 'docker build ..'"""
-        to_build = [im for im in IMAGE_ORDER if im in self.images]
+    def get_cost(self, image):
+        """Return the cost of building {image}; from --costs or defaults"""
+        cost = DEFAULT_COST.copy()
+        cost.update(self.costs.get(image, {}))
+        return cost
+
+    def get_image_size(self, full_tag):
+        """Return the size in bytes of the local image {full_tag}, or None
+        if it is not known"""
+        try:
+            out = self.run(f"docker image inspect --format '{{{{.Size}}}}' "
+                           f"{full_tag}", 100, capture_output=True)
+            return int(out.stdout.strip())
+        except Exception:
+            return None
+
+    def update_cost(self, image, duration):
+        """Learn the cost of {image} from a successful build and save it
+        to the --costs file.
+
+        The duration is averaged with the previous value, and the disk
+        cost (GB) is the size of the built image.
 
-        build_vars = self.build_vars
+        Args:
+        -----
+        image: str
+            Image name
+        duration: float
+            Build time in sec
 
-        for image in to_build:
+        """
+        size = self.get_image_size(self.get_full_tag(image, self.tag))
+        with self.lock:
+            cost = self.costs.setdefault(image, {})
+            if 'duration' in cost:
+                duration = (cost['duration'] + duration) / 2
+            cost['duration'] = round(duration)
+            if size is not None:
+                cost['disk'] = round(size / 1024**3, 1)
+            with open(self.costs_file, 'w') as fp:
+                json.dump(self.costs, fp, indent=2, sort_keys=True)
+
+    def schedule(self, graph, task):
+        """Run task(image) for every image in graph, parents first.
+
+        Images whose parents are all done run concurrently in a pool
+        of self.jobs workers. Ready images with the longest remaining
+        path (by their 'duration' cost) are started first. Images are
+        started in that order only while the sum of their costs fits
+        in the --budget; an image that does not fit waits until enough
+        running images finish, so a large image on the critical path is
+        not starved by smaller ones. If a task fails, no new tasks are
+        started, the running ones are allowed to finish, and the first
+        error is raised.
 
-            # make a copy so each image has its own set
-            im_build_args = build_vars.copy()
+        Args:
+        -----
+        graph: dict
+            {image: set(parents)} as returned by get_build_graph
+        task: callable
+            Called with the image name
 
-            # add some defaults to build_args. For jupyter-base, the tags
-            # are external and should be updated there
-            if image != 'jupyter-base':
-                mapping = dict(
-                    REPOSITORY=self.repo,
-                    BASE_TAG=self.tag,
-                    BUILD_VERSION=f'{image}:{time_tag}'
-                )
-                for key, val in mapping.items():
-                    exists = any([
-                        arg.startswith(f'{key}=') for arg in im_build_args])
-                    if not exists:
-                        im_build_args.append(f'{key}={val}')
-
-            # serialize the arguments
-            cmd_args = ''
-            for arg in im_build_args:
-                if not arg.count("=") == 1:
-                    raise ValueError(
-                        f"build_args should be of the form 'name=value'. "
-                        f"Got '{arg}'."
+        """
+        budget = self.budget or {}
+        paths = get_critical_paths(graph, self.costs)
+        pending = {image: set(parents) for image, parents in graph.items()}
+        running = {}
+        in_use = dict.fromkeys(budget, 0)
+        done = set()
+        error = None
+
+        def fits(cost):
+            return all(in_use[res] + cost[res] <= limit
+                       for res, limit in budget.items())
+
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while pending or running:
+                if error is None:
+                    ready = sorted(
+                        [im for im, parents in pending.items()
+                         if parents <= done],
+                        key=lambda im: (-paths[im], IMAGE_ORDER.index(im))
                     )
-                name, val = arg.split("=", 1)
-                cmd_args += f" --build-arg {name}={val}"
+                    for image in ready:
+                        cost = self.get_cost(image)
+                        # always allow one build, even if over budget
+                        if len(running) >= self.jobs or (
+                                running and not fits(cost)):
+                            break
+                        for res in in_use:
+                            in_use[res] += cost[res]
+                        del pending[image]
+                        running[pool.submit(task, image)] = image
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    image = running.pop(future)
+                    cost = self.get_cost(image)
+                    for res in in_use:
+                        in_use[res] -= cost[res]
+                    try:
+                        future.result()
+                        done.add(image)
+                    except Exception as err:
+                        self.print(f'{image} failed: {err}', logging.ERROR)
+                        if error is None:
+                            error = err
+
+        if error is not None:
+            raise error
+        if pending:
+            raise ValueError(
+                f'Cannot resolve the dependencies of: {sorted(pending)}')
+
+    def do_build(self, time_tag, on_built=None):
+        """Build the requested images by calling 'docker build ..'
+
+        Images are built following their FROM dependencies. With --jobs > 1,
+        independent images are built at the same time, within --budget.
+        If given, on_built(image) is called after each successful build.
+        """
+        to_build = [im for im in IMAGE_ORDER if im in self.images]
+        graph = get_build_graph(to_build)
+        self.pending_builds = set(to_build)
+
+        # for fornax-jupyter, extract the kernels of each software image
+        # as soon as it is built, while the other images are building
+        harvest = 'fornax-jupyter' in to_build
+        pool = ThreadPoolExecutor(max_workers=len(SOFTWARE_IMAGES))
+
+        def task(image):
+            if not self.is_done('build', image):
+                start = time.time()
+                with self.phase('build', image) as record:
+                    built = self.build_image(image, time_tag)
+                    if self.trace is not None and not self.dryrun:
+                        record['bytes'] = self.get_image_size(
+                            self.get_full_tag(image, self.tag))
+                self.mark_done('build', image)
+                # a retagged image says nothing about the build time
+                if (self.costs_file is not None and not self.dryrun and
+                        built):
+                    self.update_cost(image, time.time() - start)
+            with self.lock:
+                self.pending_builds.discard(image)
+            if on_built is not None:
+                on_built(image)
+            if harvest and image in SOFTWARE_IMAGES:
+                self.harvests[image] = pool.submit(
+                    self.harvest_kernels, image)
+
+        try:
+            self.schedule(graph, task)
+        finally:
+            pool.shutdown()
+
+    def do_build_and_push(self, time_tag):
+        """Build the requested images, and push each one as soon as it is
+        built, while the other images are still building."""
+        with ThreadPoolExecutor(max_workers=self.push_jobs) as pool:
+
+            def on_built(image):
+                self.pushes[image] = [
+                    pool.submit(self.push_tag, tag)
+                    for tag in self.get_push_tags(image, time_tag)
+                ]
+
+            try:
+                self.do_build(time_tag, on_built)
+            finally:
+                # let the pushes of the built images finish
+                futures = [f for fs in self.pushes.values() for f in fs]
+                wait(futures)
+        self.wait_all(futures)
+
+    def get_build_args(self, image, time_tag):
+        """Return the list of 'name=value' build arguments for {image}"""
+        build_vars = self.build_vars
 
-            # add any line arguments
-            # now add any other line parameters
-            if self.extra_args:
-                cmd_args += f" {self.extra_args}"
+        # make a copy so each image has its own set
+        im_build_args = build_vars.copy()
 
-            # now handle tags
-            tags = [self.tag, time_tag]
-            tags = [self.get_full_tag(image, tag) for tag in tags]
-            cmd_args += ' '.join([f' --tag {tag}' for tag in tags])
+        # add some defaults to build_args. For jupyter-base, the tags
+        # are external and should be updated there
+        if image != 'jupyter-base':
+            mapping = dict(
+                REPOSITORY=self.repo,
+                BASE_TAG=self.tag,
+                BUILD_VERSION=f'{image}:{time_tag}'
+            )
+            for key, val in mapping.items():
+                exists = any([
+                    arg.startswith(f'{key}=') for arg in im_build_args])
+                if not exists:
+                    im_build_args.append(f'{key}={val}')
+
+        for arg in im_build_args:
+            if not arg.count("=") == 1:
+                raise ValueError(
+                    f"build_args should be of the form 'name=value'. "
+                    f"Got '{arg}'."
+                )
+        return im_build_args
+
+    def get_image_id(self, full_tag):
+        """Return the local image id of {full_tag}, or None if the image
+        does not exist or this is a dry run"""
+        try:
+            out = self.run(f"docker image inspect --format '{{{{.Id}}}}' "
+                           f"{full_tag}", 100, capture_output=True)
+        except subprocess.CalledProcessError:
+            return None
+        return None if out is None else out.stdout.strip()
+
+    def get_cache_args(self, image):
+        """Return the (cache_from, cache_to) BuildKit cache options of
+        {image}, or ([], None) when no cache is requested.
+
+        The cache is kept per image and tag, either in a registry
+        ({cache_repo}/{image}:buildcache-{tag}) or in a local folder
+        ({cache_dir}/{image}/{tag}). It is read from the build tag, then
+        CACHE_FALLBACK_TAGS, and written to the build tag with mode=max.
+        """
+        tags = [self.tag] + [
+            tag for tag in CACHE_FALLBACK_TAGS if tag != self.tag]
+        cache_from, cache_to = [], None
+        if self.cache_repo is not None:
+            for tag in tags:
+                self.check_tags(tag)
+                ref = f'{self.cache_repo}/{image}:buildcache-{tag}'
+                cache_from.append(f'type=registry,ref={ref}')
+            ref = f'{self.cache_repo}/{image}:buildcache-{self.tag}'
+            cache_to = f'type=registry,ref={ref},mode=max'
+        elif self.cache_dir is not None:
+            for tag in tags:
+                path = os.path.join(self.cache_dir, image, tag)
+                # a missing local cache fails the build
+                if self.dryrun or os.path.exists(path):
+                    cache_from.append(f'type=local,src={path}')
+            path = os.path.join(self.cache_dir, image, self.tag)
+            cache_to = f'type=local,dest={path},mode=max'
+        return cache_from, cache_to
+
+    def get_fingerprint(self, image, build_args):
+        """Return a hash of all the inputs of an image build, or None if
+        some input cannot be resolved.
+
+        The inputs are the files in the image folder, the ids of the
+        parent images, the build arguments (excluding BUILD_VERSION, which
+        changes with every build) and the extra arguments. For
+        fornax-jupyter, COMMON_FILES and the ids of the images the kernels
+        are extracted from are also included.
 
-            self.print(f"Building {tags[0]} ...")
-            build_cmd = (
-                f"docker build --platform=linux/amd64 {cmd_args} {image}")
+        Args:
+        -----
+        image: str
+            Image name
+        build_args: list
+            'name=value' build arguments as returned by get_build_args
 
-            # For fornax-jupyter, extract the kernel files from other images
-            # first. This will create kernels/
-            if image == 'fornax-jupyter':
-                self.extract_kernel_files()
-                # copy common files
-                self.copy_common_files(image)
+        """
+        sha = hashlib.sha256()
+
+        def add_files(folder, files=None):
+            if files is None:
+                files = []
+                for root, dirs, names in os.walk(os.path.join(REPO_DIR,
+                                                              folder)):
+                    # generated during the fornax-jupyter build
+                    dirs[:] = sorted(d for d in dirs if d != 'kernels')
+                    for name in sorted(names):
+                        path = os.path.relpath(
+                            os.path.join(root, name), REPO_DIR)
+                        if not (image == 'fornax-jupyter' and
+                                name in COMMON_FILES and
+                                os.path.dirname(path) == folder):
+                            files.append(path)
+            for path in files:
+                full_path = os.path.join(REPO_DIR, path)
+                sha.update(path.encode())
+                sha.update(str(os.access(full_path, os.X_OK)).encode())
+                with open(full_path, 'rb') as fp:
+                    sha.update(hashlib.sha256(fp.read()).digest())
+
+        add_files(image)
+
+        parents = get_image_parents(image)
+        if image == 'fornax-jupyter':
+            add_files('', COMMON_FILES)
+            parents += [im for im in SOFTWARE_IMAGES if im not in parents]
+        for parent in parents:
+            parent_id = self.get_image_id(self.get_full_tag(parent, self.tag))
+            if parent_id is None:
+                return None
+            sha.update(f'{parent}={parent_id}'.encode())
+
+        for arg in sorted(build_args):
+            if not arg.startswith('BUILD_VERSION='):
+                sha.update(arg.encode())
+        sha.update(str(self.extra_args).encode())
+        return sha.hexdigest()
+
+    def save_build_state(self, image, fingerprint, image_id, time_tag):
+        """Record the fingerprint of a successful build in the state file"""
+        with self.lock:
+            self.build_state[image] = {
+                'fingerprint': fingerprint,
+                'id': image_id,
+                'time_tag': time_tag,
+            }
+            with open(self.state_file, 'w') as fp:
+                json.dump(self.build_state, fp, indent=2, sort_keys=True)
+
+    def build_image(self, image, time_tag):
+        """Build a single image by calling 'docker build ..'
+
+        With --skip-unchanged, if the inputs of the image have not changed
+        since its last successful build, the image from that build is
+        retagged instead. The retagged image keeps its old BUILD_VERSION.
+
+        Returns:
+        --------
+        True if the image was built, False if it was retagged
 
+        """
+        im_build_args = self.get_build_args(image, time_tag)
+
+        # serialize the arguments
+        cmd_args = ''
+        for arg in im_build_args:
+            name, val = arg.split("=", 1)
+            cmd_args += f" --build-arg {name}={val}"
+
+        # add any line arguments
+        # now add any other line parameters
+        if self.extra_args:
+            cmd_args += f" {self.extra_args}"
+
+        # now handle tags
+        tags = [self.tag, time_tag]
+        tags = [self.get_full_tag(image, tag) for tag in tags]
+        cmd_args += ' '.join([f' --tag {tag}' for tag in tags])
+
+        fingerprint = None
+        if self.skip_unchanged:
+            fingerprint = self.get_fingerprint(image, im_build_args)
+            state = self.build_state.get(image, {})
+            if (
+                fingerprint is not None and
+                state.get('fingerprint') == fingerprint and
+                self.get_image_id(state['id']) is not None
+            ):
+                self.print(f"{image} is unchanged since "
+                           f"{state['time_tag']}; retagging ...",
+                           logging.INFO)
+                for tag in tags:
+                    self.run(f"docker tag {state['id']} {tag}", 1000)
+                return False
+
+        self.print(f"Building {tags[0]} ...")
+        build_cmd = (
+            f"docker build --platform=linux/amd64 {cmd_args} {image}")
+
+        # For fornax-jupyter, extract the kernel files from other images
+        # first. This will create kernels/
+        if image == 'fornax-jupyter':
+            self.extract_kernel_files()
+            # copy common files
+            self.copy_common_files(image)
+
+        if self.step_profile is None:
             self.run(build_cmd, timeout=10000)
+        else:
+            self.profile_build(image, time_tag, build_cmd, tags[0])
 
-            # clean up kernels folder
-            if image == 'fornax-jupyter':
-                self.print("Cleaning kernels folder")
-                self.run(f'rm -rf {image}/kernels', 1000)
+        # clean up kernels folder
+        if image == 'fornax-jupyter':
+            self.print("Cleaning kernels folder")
+            self.run(
+                f'rm -rf {KERNELS_BUILD_DIR} {KERNELS_STAGING_DIR}', 1000)
 
-    def do_push(self, time_tag=None):
-        """Push an image to registry with 'docker push ..'"""
-        to_push = [im for im in IMAGE_ORDER if im in self.images]
+        if fingerprint is not None:
+            image_id = self.get_image_id(tags[0])
+            if image_id is not None:
+                self.save_build_state(image, fingerprint, image_id, time_tag)
+        return True
 
-        for image in to_push:
+    def run_stream(self, command, timeout, on_line):
+        """Run system command {command} with a timeout, and pass each line
+        of its stderr to on_line as soon as it is written
 
-            # add any line arguments
-            # now add any other line parameters
-            cmd_args = ''
+        Args:
+        -----
+        command: str
+            Command to pass to subprocess.Popen()
+        timeout: int
+            Timeout in sec
+        on_line: callable
+            Called with each line of stderr
+        """
+        self.print(command, logging.INFO)
+        if self.dryrun:
+            return
+        proc = subprocess.Popen(command, shell=True, text=True,
+                                stderr=subprocess.PIPE)
+        timer = threading.Timer(timeout, proc.kill)
+        timer.start()
+        try:
+            for line in proc.stderr:
+                on_line(line)
+            proc.wait()
+        finally:
+            timer.cancel()
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, command)
+
+    def profile_build(self, image, time_tag, build_cmd, full_tag):
+        """Run {build_cmd} with BuildKit rawjson progress, and append the
+        duration, cache use and layer size of each step to the
+        --step-profile history file"""
+        profiler = StepProfiler(image, get_onbuild_steps(image), self.print)
+        try:
+            self.run_stream(
+                build_cmd.replace(
+                    'docker build ', 'docker build --progress=rawjson ', 1),
+                10000, profiler.add_line)
+        finally:
+            history = None
+            if not self.dryrun:
+                try:
+                    out = self.run(
+                        "docker history --no-trunc --human=false --format "
+                        f"'{{{{.Size}}}}|{{{{.CreatedBy}}}}' {full_tag}",
+                        100, capture_output=True)
+                    history = out.stdout.split('\n')
+                except subprocess.CalledProcessError:
+                    pass
+            steps = profiler.steps(history)
+
+            if steps:
+                cached = sum(step['cached'] for step in steps)
+                self.print(f'{image}: {cached}/{len(steps)} steps cached; '
+                           'slowest steps:', logging.INFO)
+                for step in sorted(steps, key=lambda st: -st['duration'])[:5]:
+                    self.print(f"  {step['duration']:8.1f}s "
+                               f"{step['step'][:100]}", logging.INFO)
+                with self.lock:
+                    with open(self.step_profile, 'a') as fp:
+                        fp.write(json.dumps({
+                            'image': image, 'time_tag': time_tag,
+                            'steps': steps}) + '\n')
+
+    def do_step_report(self):
+        """Print the slowest and never cached steps in --step-profile"""
+        summary = summarize_step_history(self.step_profile)
+        self.print(f'Slowest steps in {self.step_profile}:', logging.INFO)
+        for stat in summary:
+            size = '' if stat['size'] is None else \
+                f"{stat['size'] / 1024**2:.0f}MB"
+            never = ' NEVER-CACHED' if stat['hit_rate'] == 0 else ''
+            onbuild = ' (ONBUILD)' if stat['onbuild'] else ''
+            self.print(f"{stat['image']:>14}: {stat['duration']:8.1f}s "
+                       f"{stat['hit_rate']:4.0%} cached {size:>7} "
+                       f"{stat['step'][:60]}{onbuild}{never}", logging.INFO)
+
+    def get_bake_definition(self, images, time_tag):
+        """Return a 'docker buildx bake' definition for {images}
+
+        Each image is a target with the same build arguments and tags as
+        in build_image. An image built FROM another target is given that
+        target as a named context, so bake builds it first and uses its
+        result directly. The context is named like the FROM reference of
+        the image, from its REPOSITORY and BASE_TAG build arguments (which
+        --build-vars may change).
+
+        Args:
+        -----
+        images: list
+            Image names to include as targets
+        time_tag: str
+            The time tag of this build
+
+        """
+        targets = {}
+        for image in images:
+            args = dict(
+                arg.split('=', 1)
+                for arg in self.get_build_args(image, time_tag)
+            )
+            target = {
+                'context': image,
+                'dockerfile': 'Dockerfile',
+                'platforms': ['linux/amd64'],
+                'args': args,
+                'tags': [self.get_full_tag(image, tag)
+                         for tag in [self.tag, time_tag]],
+            }
+            repo = args.get('REPOSITORY', self.repo)
+            base_tag = args.get('BASE_TAG', self.tag)
+            contexts = {
+                f'{repo}/{parent}:{base_tag}': f'target:{parent}'
+                for parent in get_image_parents(image) if parent in images
+            }
+            if contexts:
+                target['contexts'] = contexts
+            cache_from, cache_to = self.get_cache_args(image)
+            if cache_from:
+                target['cache-from'] = cache_from
+            if cache_to is not None:
+                target['cache-to'] = [cache_to]
+            targets[image] = target
+
+        return {
+            'group': {'default': {'targets': list(images)}},
+            'target': targets,
+        }
+
+    def do_bake(self, time_tag):
+        """Build the requested images with a single 'docker buildx bake'
+
+        The definition is written to self.bake_file. fornax-jupyter needs
+        the kernel files from the other images, so it is built after the
+        bake with build_image, without the build cache.
+        """
+        to_build = [im for im in IMAGE_ORDER if im in self.images and
+                    not self.is_done('build', im)]
+        to_bake = [im for im in to_build if im != 'fornax-jupyter']
+        self.pending_builds = set(to_build) - set(to_bake)
+
+        if to_bake:
+            definition = self.get_bake_definition(to_bake, time_tag)
+            self.print(f'Writing bake definition to {self.bake_file}')
+            with open(self.bake_file, 'w') as fp:
+                json.dump(definition, fp, indent=2)
+
+            cmd_args = f'--file {self.bake_file} --load'
             if self.extra_args:
-                cmd_args += f" {self.extra_args}"
+                cmd_args += f' {self.extra_args}'
+            self.print(f"Baking {' '.join(to_bake)} ...")
+            with self.phase('bake', images=to_bake):
+                self.run(f'docker buildx bake {cmd_args}', timeout=10000)
+            for image in to_bake:
+                self.mark_done('build', image)
+
+        if 'fornax-jupyter' in to_build:
+            with self.phase('build', 'fornax-jupyter'):
+                self.build_image('fornax-jupyter', time_tag)
+            self.mark_done('build', 'fornax-jupyter')
+
+    def get_push_tags(self, image, time_tag=None):
+        """Return the full tags of {image} to push"""
+        tags = [self.tag]
+        if time_tag is not None:
+            tags.append(time_tag)
+        return [self.get_full_tag(image, tag) for tag in tags]
+
+    def push_tag(self, full_tag):
+        """Push {full_tag} with 'docker push ..', retrying on failure"""
+        if self.is_done('push', full_tag):
+            return
+        self.print(f'Pushing {full_tag} ...')
+        image, tag = full_tag.split('/')[-1].split(':')
+        with self.phase('push', image, tag=tag) as record:
+            self.run_with_retry(f"docker push {full_tag}", timeout=10000)
+            if self.trace is not None and not self.dryrun:
+                # upper limit; layers already in the registry are skipped
+                record['bytes'] = self.get_image_size(full_tag)
+        self.mark_done('push', full_tag)
 
-            tags = [self.tag]
-            if time_tag is not None:
-                tags.append(time_tag)
-            tags = [self.get_full_tag(image, tag) for tag in tags]
+    def do_push(self, time_tag=None):
+        """Push the images to registry with 'docker push ..'
 
-            for tag in tags:
-                push_cmd = f"docker push {tag}"
-                self.print(f'Pushing {tag} ...')
-                self.run(push_cmd, timeout=10000)
+        Up to self.push_jobs tags are pushed at the same time.
+        """
+        to_push = [im for im in IMAGE_ORDER if im in self.images]
+        tags = [tag for image in to_push
+                for tag in self.get_push_tags(image, time_tag)]
+
+        with ThreadPoolExecutor(max_workers=self.push_jobs) as pool:
+            futures = [pool.submit(self.push_tag, tag) for tag in tags]
+        self.wait_all(futures)
 
     def do_retag(self):
         """Release images by retagging them ..'"""
@@ -408,31 +2223,73 @@ class Builder:
         # if images is not given, do all images
         if images in (None, [], ''):
             images = [im for im in IMAGE_ORDER]
-        to_retag = [im for im in IMAGE_ORDER if im in images]
+        to_retag = [im for im in IMAGE_ORDER if im in images and
+                    not self.is_done('retag', im)]
 
-        for image in to_retag:
-            source_tag = self.get_full_tag(image, self.tag)
+        if self.retag_method == 'registry':
+            self.do_registry_retag(to_retag)
+            return
 
-            # pull
-            command = f'docker pull {source_tag}'
-            self.print(f"Pulling {source_tag} ...")
+        for image in to_retag:
+            with self.phase('retag', image):
+                self.retag_image(image)
+            self.mark_done('retag', image)
+
+    def retag_image(self, image):
+        """Retag {image} with 'docker pull', 'docker tag' and 'docker push'"""
+        source_tag = self.get_full_tag(image, self.tag)
+
+        # pull
+        command = f'docker pull {source_tag}'
+        self.print(f"Pulling {source_tag} ...")
+        self.run(command, timeout=3000)
+
+        for retag in self.retag:
+            new_tag = self.get_full_tag(image, retag)
+
+            # tag
+            command = f'docker tag {source_tag} {new_tag}'
+            self.print(f"Tagging {source_tag} with {new_tag}")
+            self.run(command, timeout=1000)
+
+            # push
+            command = f'docker push {new_tag}'
+            self.print(f"Pushing {new_tag} ...")
             self.run(command, timeout=3000)
 
-            for retag in self.retag:
-                new_tag = self.get_full_tag(image, retag)
+    def do_registry_retag(self, images):
+        """Retag {images} in the registry directly, by uploading the
+        manifest of the source tag under each new tag. Up to
+        self.push_jobs images are retagged at the same time."""
+        client = RegistryClient(self.repo)
+        self.check_tags(self.tag, *self.retag)
 
-                # tag
-                command = f'docker tag {source_tag} {new_tag}'
-                self.print(f"Tagging {source_tag} with {new_tag}")
-                self.run(command, timeout=1000)
+        def retag(image):
+            source_tag = self.get_full_tag(image, self.tag)
+            self.print(f"Tagging {source_tag} with {self.retag} "
+                       "in the registry", logging.INFO)
+            with self.phase('retag', image) as record:
+                if not self.dryrun:
+                    record['bytes'] = client.retag(
+                        image, self.tag, self.retag)
+            self.mark_done('retag', image)
 
-                # push
-                command = f'docker push {new_tag}'
-                self.print(f"Pushing {new_tag} ...")
-                self.run(command, timeout=3000)
+        with ThreadPoolExecutor(max_workers=self.push_jobs) as pool:
+            futures = [pool.submit(retag, image) for image in images]
+        self.wait_all(futures)
 
     def do_ecr(self):
-        """Notify ECR endpoint with new images/tags ..'"""
+        """Notify ECR endpoint with new images/tags ..'
+
+        All the (image, tag, endpoint) calls are sent at the same time over
+        keep-alive connections; a failed call does not stop the others.
+
+        Returns:
+        --------
+        {endpoint: {'ok': int, 'not_found': int, 'failed': [(image, tag,
+            error), ...]}}
+
+        """
         # Currently, only fornax-jupyter is in the ECR
         ecr_images = ['fornax-jupyter']
         if self.retag:
@@ -441,7 +2298,7 @@ class Builder:
             images = [im for im in ecr_images if im in self.images]
             if len(images) == 0:
                 self.print('No images for ecr notification!')
-                return
+                return {}
 
         # check the tags
         retag = [] if self.retag is None else self.retag
@@ -458,31 +2315,87 @@ class Builder:
                 for retag in self.retag:
                     params.append([image, retag])
 
-        # now loop through the parameters and make the request
-        for image, tag in params:
-
-            self.print(f"Triggering ecr for {image}, {tag} ...")
-
-            for ipoint, endpoint in enumerate(self.ecr):
-                if not self.dryrun:
-                    url = f'{endpoint}?image={image}&tag={tag}'
-                    request = urllib.request.Request(url)
+        # send all (image, tag, endpoint) calls at the same time
+        calls = [(image, tag, ipoint, endpoint)
+                 for image, tag in params
+                 for ipoint, endpoint in enumerate(self.ecr)
+                 if not self.is_done('ecr', f'{image}:{tag} {ipoint}')]
+        summary = {endpoint: {'ok': 0, 'not_found': 0, 'failed': []}
+                   for endpoint in self.ecr}
+        if self.dryrun:
+            for image, tag, _, _ in calls:
+                self.print(f"Triggering ecr for {image}, {tag} ...")
+            return summary
+
+        pool = ConnectionPool(ECR_TIMEOUT)
+        try:
+            with ThreadPoolExecutor(max_workers=ECR_JOBS) as executor:
+                futures = [executor.submit(self.trigger_ecr, pool, *args)
+                           for args in calls]
+            results = [future.result() for future in futures]
+        finally:
+            pool.close()
+
+        for (image, tag, ipoint, endpoint), (status, error) in zip(
+                calls, results):
+            if error is None:
+                self.mark_done('ecr', f'{image}:{tag} {ipoint}')
+            if status == 404:
+                summary[endpoint]['not_found'] += 1
+            elif error is None:
+                summary[endpoint]['ok'] += 1
+            else:
+                summary[endpoint]['failed'].append((image, tag, error))
+
+        for ipoint, endpoint in enumerate(self.ecr):
+            result = summary[endpoint]
+            self.print(f"ecr endpoint {ipoint + 1}: {result['ok']} ok, "
+                       f"{result['not_found']} not found, "
+                       f"{len(result['failed'])} failed", logging.INFO)
+            for image, tag, error in result['failed']:
+                self.print(f"ecr endpoint {ipoint + 1} failed for "
+                           f"{image}:{tag}: {error}", logging.ERROR)
+        return summary
+
+    def trigger_ecr(self, pool, image, tag, ipoint, endpoint):
+        """Call ecr {endpoint} for {image}:{tag}, retrying with jittered
+        exponential backoff for connection errors and 5xx/429 responses
+
+        Returns:
+        --------
+        (status, error); error is None for a 2xx or 404 status
 
-                    # this will fail if something other than 404 is returned,
-                    # and we want to know about it
-                    try:
-                        resp = urllib.request.urlopen(request)
-                        self.print(f"Trigger returned status: {resp.status}")
-                        self.print(("Trigger returned response: "
-                                    f"{resp.read().decode()}"))
-                        time.sleep(0.1)
-                    except urllib.error.HTTPError as err:
-                        # 404 means the repo does not exist, which is ok
-                        if err.code == 404:
-                            self.print("Trigger returned status: 404")
-                        else:
-                            # raise for any other error
-                            raise
+        """
+        url = f'{endpoint}?image={image}&tag={tag}'
+        self.print(f"Triggering ecr for {image}, {tag} ...")
+        status = error = None
+        with self.phase('ecr', image, tag=tag, endpoint=ipoint) as record:
+            for attempt in range(self.ecr_retries + 1):
+                try:
+                    status, body = pool.request('GET', url)
+                    text = body.decode(errors='replace')
+                    record['bytes'] = len(body)
+                    error = (None if status < 300 or status == 404
+                             else f'status {status}: {text[:200]}')
+                except (OSError, http.client.HTTPException) as err:
+                    status, error = None, str(err) or repr(err)
+                    text = None
+
+                # 404 means the repo does not exist, which is ok
+                self.print(f"Trigger returned status: {status}")
+                if text:
+                    self.print(f"Trigger returned response: {text}")
+                if error is None or (
+                        status is not None and status < 500 and
+                        status != 429) or attempt == self.ecr_retries:
+                    break
+                delay = ECR_RETRY_DELAY * 2**attempt * random.uniform(1, 2)
+                self.print(f'ecr call for {image}:{tag} failed ({error}); '
+                           f'retrying in {delay:.1f} sec ...',
+                           logging.WARNING)
+                time.sleep(delay)
+            record['status'] = 'ok' if error is None else 'error'
+        return status, error
 
 
 def main():
@@ -504,25 +2417,124 @@ def main():
     help = ("Push to registry after build?")
     ap.add_argument("--push", action="store_true", help=help, default=False)
 
+    help = ("Number of tags to push in parallel. Default: 1")
+    ap.add_argument("--push-jobs", type=int, help=help, default=1)
+
+    help = ("Number of times to retry a failed push. Default: 3")
+    ap.add_argument("--push-retries", type=int, help=help, default=3)
+
     help = ("Release an image by retagging to the given tags")
     ap.add_argument("--retag", nargs='+', help=help)
 
+    help = ("How to --retag: 'docker' (pull, tag and push) or 'registry' "
+            "(copy the manifest in the registry). Default: docker. "
+            "'registry' uses REGISTRY_USERNAME/REGISTRY_PASSWORD or the "
+            "credentials from 'docker login'")
+    ap.add_argument("--retag-method", choices=['docker', 'registry'],
+                    help=help, default='docker')
+
     help = ("Export locks")
     ap.add_argument(
         "--export-locks",  action="store_true", help=help, default=False)
 
+    help = ("How to get kernel and lock files from the images: "
+            "'container' (docker run), or by reading the image layers from "
+            "the local 'docker' images (streams the whole image; slower "
+            "than a container for large images) or the 'registry' (reads "
+            "only the top layers that are needed). Default: container")
+    ap.add_argument("--extract-from", help=help, default='container',
+                    choices=['container', 'docker', 'registry'])
+
     help = ("ECR endpoints")
     ap.add_argument("--ecr", action='append', help=help)
 
+    help = ("Number of times to retry a failed ECR call. Default: 3")
+    ap.add_argument("--ecr-retries", type=int, help=help, default=3)
+
     help = ("Extra arugments for docker build/run")
     ap.add_argument("--extra-args", help=help)
 
     help = ("Build variables for docker build, e.g. e.g. 'a=b c=d'")
     ap.add_argument("--build-vars", help=help)
 
+    help = ("Number of images to build in parallel. Default: 1")
+    ap.add_argument("--jobs", type=int, help=help, default=1)
+
+    help = ("JSON file with per-image build costs, e.g. "
+            "'{\"env-sas\": {\"duration\": 3000, \"memory\": 12}}'. "
+            "Updated with the duration and disk size of each build")
+    ap.add_argument("--costs", help=help)
+
+    help = ("Total resources for parallel builds, e.g. "
+            "'memory=32 cpu=8 disk=100'. Use the same units as --costs")
+    ap.add_argument("--budget", help=help)
+
+    help = ("Add the images with files changed since this git ref, and "
+            "all the images that depend on them, e.g. origin/develop")
+    ap.add_argument("--changed-since", help=help)
+
+    help = ("Registry repository for the BuildKit cache of each image, "
+            "e.g. ghcr.io/nasa-fornax/fornax-images. Needs --bake and a "
+            "buildx builder that can export caches (docker-container "
+            "driver)")
+    ap.add_argument("--cache-repo", help=help)
+
+    help = ("Local folder for the BuildKit cache of each image. Needs "
+            "--bake")
+    ap.add_argument("--cache-dir", help=help)
+
+    help = ("Build all the images with one 'docker buildx bake' instead of "
+            "one 'docker build' per image. --extra-args are passed to bake")
+    ap.add_argument("--bake", action="store_true", help=help, default=False)
+
+    help = (f"Where to write the bake definition. Default: "
+            f"{DEFAULT_BAKE_FILE}")
+    ap.add_argument("--bake-file", help=help)
+
+    help = ("Retag instead of rebuilding images whose inputs (files, parent "
+            "images, build arguments) did not change since the last build")
+    ap.add_argument("--skip-unchanged", action="store_true", help=help,
+                    default=False)
+
+    help = ("Record every completed step (build, push, retag, ecr) of each "
+            "image, and the time tag, in this journal file. Default with "
+            f"--resume: {DEFAULT_JOURNAL_FILE}")
+    ap.add_argument("--journal", help=help)
+
+    help = ("Resume a failed run from its --journal: reuse its time tag "
+            "and skip the steps that are already done")
+    ap.add_argument("--resume", action="store_true", help=help,
+                    default=False)
+
+    help = (f"File to keep the state of previous builds for "
+            f"--skip-unchanged. Default: {DEFAULT_STATE_FILE}")
+    ap.add_argument("--state-file", help=help)
+
     help = ("List software images. i.e. those with kernels that need export")
     ap.add_argument("--kernel-images", action='store_true', help=help)
 
+    help = ("Write a timing trace of all the build phases to this JSON "
+            "file, and in the Chrome trace format to {name}.chrome.json")
+    ap.add_argument("--trace", help=help)
+
+    help = ("Report the phases that are slower than in this previous "
+            "--trace file")
+    ap.add_argument("--compare", help=help)
+
+    help = ("Fraction by which a phase has to be slower to be reported "
+            "by --compare. Default: 0.2")
+    ap.add_argument("--compare-threshold", type=float, help=help,
+                    default=0.2)
+
+    help = ("Build with BuildKit rawjson progress, and append the duration, "
+            "cache use and layer size of every Dockerfile step to this "
+            "history file (JSON lines)")
+    ap.add_argument("--step-profile", help=help)
+
+    help = ("Print the slowest and never cached steps in --step-profile")
+    ap.add_argument("--step-report", action="store_true", help=help,
+                    default=False)
+
     help = ("Print debug messages")
     ap.add_argument("--debug", action="store_true", help=help, default=False)
 
@@ -0,0 +1,289 @@
+"""Record the files read when an image starts its jupyter server and
+default kernel, to pre-warm them in the AMI (see ami-builder.py
+--prefetch).
+
+The "after" start times are measured after reading the recorded files in
+a separate container on the same host, so they only show the gain of a
+warm host page cache; they are an estimate of what the AMI prefetch does
+on a new node, and are only meaningful with --cold, where the "before"
+times start from a cold page cache.
+"""
+import argparse
+import logging
+import subprocess
+import urllib.request
+import urllib.error
+import json
+import os
+import time
+import uuid
+
+# logging
+logging.basicConfig(
+    format="%(asctime)s|%(levelname)5s| %(message)s",
+    datefmt="%Y-%m-%d|%H:%M:%S",
+)
+
+logger = logging.getLogger('::Startup-Profile::')
+logger.setLevel(level=logging.DEBUG)
+
+DEFAULT_REPO = 'ghcr.io/nasa-fornax/fornax-images'
+JUPYTER_PORT = 8888
+# the python of the jupyter server in the images
+SAMPLER_PYTHON = '/opt/jupyter/bin/python'
+# where the sampler writes the files it sees, inside the container
+ACCESS_LOG = '/tmp/file-access.log'
+# paths that are not files in the image
+SKIP_PREFIXES = ('/proc/', '/sys/', '/dev/', '/run/', '/tmp/', '/home/')
+
+# Runs inside the container, started before start.sh. It samples the
+# memory maps and open file descriptors of all processes every {interval}
+# sec, and logs each file the first time it is seen: 'sec<TAB>size<TAB>path'
+SAMPLER = '''
+import os, sys, time
+interval = float(sys.argv[1])
+start = time.time()
+seen = set()
+me = str(os.getpid())
+out = open(sys.argv[2], 'w', buffering=1)
+while True:
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit() or pid == me:
+            continue
+        paths = []
+        try:
+            with open(f'/proc/{pid}/maps') as fp:
+                paths += [ln.split(None, 5)[5].strip() for ln in fp
+                          if ln.count(' ') >= 5 and '/' in ln]
+            fds = f'/proc/{pid}/fd'
+            paths += [os.readlink(f'{fds}/{fd}') for fd in os.listdir(fds)]
+        except OSError:
+            pass
+        for path in paths:
+            if path.startswith('/') and path not in seen:
+                seen.add(path)
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    continue
+                out.write(f'{time.time() - start:.3f}\\t{size}\\t{path}\\n')
+    time.sleep(interval)
+'''
+
+
+def parse_access_log(text):
+    """Return the list of (sec, size, path) from the sampler log {text},
+    in the order the files were first seen, without the paths that are
+    not files of the image"""
+    files = []
+    for line in text.split('\n'):
+        parts = line.split('\t')
+        if len(parts) != 3 or not parts[1].isdigit():
+            continue
+        path = parts[2].replace(' (deleted)', '')
+        if path.startswith(SKIP_PREFIXES) or path == ACCESS_LOG:
+            continue
+        files.append((float(parts[0]), int(parts[1]), path))
+    return files
+
+
+def run(command, timeout=600, check=True, **runargs):
+    """Run system command {command} and return its stdout"""
+    logger.debug(command)
+    result = subprocess.run(command, shell=True, check=check, text=True,
+                            capture_output=True, timeout=timeout, **runargs)
+    return result.stdout
+
+
+def call_api(port, token, path, method='GET', timeout=5):
+    """Call the jupyter server api; return the json response"""
+    request = urllib.request.Request(
+        f'http://localhost:{port}/api/{path}', method=method,
+        data=b'{}' if method == 'POST' else None,
+        headers={'Authorization': f'token {token}',
+                 'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request, timeout=timeout) as resp:
+        return json.loads(resp.read().decode())
+
+
+def wait_for(check, timeout, what):
+    """Call check() every 0.1 sec until it returns a true value"""
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            value = check()
+            if value:
+                return value
+        except (urllib.error.URLError, ConnectionError, OSError,
+                ValueError):
+            pass
+        time.sleep(0.1)
+    raise TimeoutError(f'Timeout waiting for {what}')
+
+
+def drop_caches():
+    """Drop the page cache of the host (needs sudo), so reads are cold"""
+    run('sync && echo 3 | sudo tee /proc/sys/vm/drop_caches > /dev/null')
+
+
+def start_session(image, port, sample=None, timeout=600):
+    """Start {image} like a user pod would, and start the default kernel.
+
+    Parameters:
+    ----------
+    image: str
+        full image name with tag
+    port: int
+        local port for the jupyter server
+    sample: float
+        if given, sample the files accessed every {sample} sec
+    timeout: float
+        timeout (sec) for the server and for the kernel
+
+    Returns:
+    -------
+    (name of the container, server start time, kernel start time)
+
+    """
+    name = f'startup-profile-{uuid.uuid4().hex[:8]}'
+    token = uuid.uuid4().hex
+    command = 'start.sh start-notebook.py'
+    if sample is not None:
+        command = (f'{SAMPLER_PYTHON} -c "$SAMPLER" {sample} {ACCESS_LOG} '
+                   f'& exec {command}')
+    env = f'-e JUPYTER_TOKEN={token} -e SAMPLER'
+    start = time.time()
+    run(f"docker run -d --name {name} -p {port}:{JUPYTER_PORT} {env} "
+        f"--entrypoint tini {image} -g -- bash -c '{command}'",
+        timeout=timeout, env={**os.environ, 'SAMPLER': SAMPLER})
+
+    try:
+        wait_for(lambda: call_api(port, token, 'status'), timeout,
+                 f'the jupyter server of {image}')
+        server_time = time.time() - start
+
+        kernel = call_api(port, token, 'kernels', 'POST', timeout)
+        wait_for(lambda: call_api(
+            port, token, f"kernels/{kernel['id']}"
+        )['execution_state'] == 'idle', timeout, 'the kernel')
+        kernel_time = time.time() - start - server_time
+    except BaseException:
+        run(f'docker rm -f {name}', check=False)
+        raise
+    return name, server_time, kernel_time
+
+
+def profile_image(image, port, interval, cold=False, timeout=600):
+    """Record the files read while {image} starts and starts its kernel,
+    then measure the start time again after prefetching them.
+
+    Returns:
+    -------
+    dict with the ordered prefetch list 'files' ([path, size, sec]),
+    and the server and kernel start times 'before' and 'after'
+
+    """
+    if cold:
+        drop_caches()
+    logger.info(f'Profiling {image} ...')
+    name, server_time, kernel_time = start_session(
+        image, port, interval, timeout)
+    try:
+        text = run(f'docker exec {name} cat {ACCESS_LOG}')
+    finally:
+        run(f'docker rm -f {name}', check=False)
+    files = parse_access_log(text)
+    logger.info(f'{image}: {len(files)} files, '
+                f'{sum(size for _, size, _ in files) / 1024**2:.0f} MB; '
+                f'server {server_time:.1f}s, kernel {kernel_time:.1f}s')
+
+    # measure again after prefetching the files
+    if cold:
+        drop_caches()
+    paths = '\n'.join(path for _, _, path in files)
+    run(f"docker run --rm -i --entrypoint xargs {image} -d '\\n' "
+        "cat > /dev/null", timeout=timeout, check=False, input=paths)
+    name, server_after, kernel_after = start_session(
+        image, port, timeout=timeout)
+    run(f'docker rm -f {name}', check=False)
+    logger.info(f'{image} after prefetch: server {server_after:.1f}s, '
+                f'kernel {kernel_after:.1f}s (host page cache warmed by a '
+                f'separate container{"" if cold else "; not a cold start"})')
+
+    return {
+        'files': [[path, size, sec] for sec, size, path in files],
+        'before': {'server': server_time, 'kernel': kernel_time},
+        'after': {'server': server_after, 'kernel': kernel_after},
+    }
+
+
+def main():
+    """Main functions"""
+    ap = argparse.ArgumentParser(
+        description=__doc__.split('\n\n')[0].replace('\n', ' '))
+
+    ap.add_argument(
+        'images', nargs='+',
+        help=("Image names with tag separated by spaces e.g. "
+              "'fornax-main:develop fornax-hea:develop'")
+    )
+
+    ap.add_argument(
+        '--repo', default=DEFAULT_REPO,
+        help=f'Image repository. Default: {DEFAULT_REPO}'
+    )
+
+    ap.add_argument(
+        '--output', default='startup-profile.json',
+        help='Output file. Default: startup-profile.json'
+    )
+
+    ap.add_argument(
+        '--interval', type=float, default=0.02,
+        help='Sampling interval (sec). Default: 0.02'
+    )
+
+    ap.add_argument(
+        '--port', type=int, default=18888,
+        help='Local port for the jupyter server. Default: 18888'
+    )
+
+    ap.add_argument(
+        '--cold', action='store_true', default=False,
+        help=('Drop the page cache (with sudo) before each start, so the '
+              'before/after times compare cold reads with prefetched ones. '
+              'Without it, both may start from a warm page cache. The '
+              'prefetch runs in a separate container on this host, which '
+              'only estimates the AMI prefetch on a new node')
+    )
+
+    args = ap.parse_args()
+
+    for image in args.images:
+        if ':' not in image:
+            raise ValueError(f'image {image} has not tag')
+
+    profiles = {}
+    for image in args.images:
+        profile = profile_image(f'{args.repo}/{image}', args.port,
+                                args.interval, args.cold)
+        profiles[image.split(':')[0]] = profile
+
+    logger.info(f'Writing {args.output}')
+    with open(args.output, 'w') as fp:
+        json.dump(profiles, fp, indent=1)
+
+    if not args.cold:
+        logger.warning('Without --cold, the "before" times may already use '
+                       'a warm page cache')
+    logger.info('image | files | MB | server before/after | kernel before/after')  # noqa E501
+    for image, profile in profiles.items():
+        size = sum(size for _, size, _ in profile['files']) / 1024**2
+        before, after = profile['before'], profile['after']
+        logger.info(f"{image} | {len(profile['files'])} | {size:.0f} | "
+                    f"{before['server']:.1f}/{after['server']:.1f}s | "
+                    f"{before['kernel']:.1f}/{after['kernel']:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
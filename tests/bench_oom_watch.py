@@ -0,0 +1,149 @@
+"""Benchmarks of fornax-jupyter/scripts/oom_watch.py on fake /proc and
+cgroup trees (see oom_fixtures.py):
+- scan time: refresh of the process table (cold and warm) and of the
+  process trees, for a few numbers of processes
+- CPU per idle hour: CPU time of one idle cycle times the wake ups per
+  hour (when polling, and when waiting for pressure events), plus one
+  warm scan every TELEMETRY_SCAN_INTERVAL sec
+- reaction time: from the usage crossing the threshold to the SIGTERM,
+  with the polling waiter
+
+Run it with: python tests/bench_oom_watch.py [--procs 1000 5000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+from oom_fixtures import FakeSystem, load_script, GB  # noqa: E402
+
+oom_watch = load_script('oom_watch')
+LIMIT = 8 * GB
+
+
+class CountingWaiter:
+    """Return at once; stop after {count} wake ups"""
+
+    def __init__(self, stop, count):
+        self.stop = stop
+        self.count = count
+        self.wakeups = 0
+        self.event_driven = False
+
+    def wait(self, interval, idle):
+        self.wakeups += 1
+        if self.wakeups > self.count:
+            self.stop.set()
+        return 'poll'
+
+
+def bench_scan(root, nprocs, repeat=5):
+    """Return the (cold, warm) time (ms) to scan {nprocs} processes"""
+    system = FakeSystem(root, LIMIT)
+    system.populate(nprocs)
+    table = oom_watch.ProcessTable(system.proc, system.cgroup)
+    start = time.perf_counter()
+    table.refresh()
+    table.groups()
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        table.refresh()
+        table.groups()
+    warm = (time.perf_counter() - start) / repeat
+    return cold * 1000, warm * 1000
+
+
+def bench_idle(root, nprocs, cycles=200):
+    """Return the CPU time (ms) of one idle cycle of the watchdog, without
+    the telemetry scan of the processes, and the wake ups per hour when
+    polling and with events"""
+    system = FakeSystem(root, LIMIT)
+    system.populate(nprocs)
+    system.set_memory(2 * GB)
+    policy = oom_watch.Policy(LIMIT, oom_watch.get_buffer(LIMIT))
+    interval, idle = policy.interval(2 * GB)
+
+    # each run scans the processes once, for the telemetry; the
+    # difference between two runs is the cost of the idle cycles only
+    times = []
+    for count in (cycles, 2 * cycles):
+        stop = threading.Event()
+        start = time.process_time()
+        oom_watch.watchdog(f'{root}/telemetry', system.proc, system.cgroup,
+                           home=root, waiter=CountingWaiter(stop, count),
+                           stop=stop)
+        times.append(time.process_time() - start)
+    cycle = max(times[1] - times[0], 0) / cycles
+    polling = 3600 / interval
+    events = 3600 / (oom_watch.IDLE_TIMEOUT if idle else interval)
+    return cycle * 1000, polling, events
+
+
+def bench_reaction(root, nprocs, delay=1):
+    """Return the time (ms) from crossing the threshold to the first
+    SIGTERM, with the memory crossing it {delay} sec after the start"""
+    system = FakeSystem(root, LIMIT)
+    system.populate(nprocs)
+    system.set_memory(4 * GB)
+    stop = threading.Event()
+    crossed = {}
+    killed = []
+
+    def kill(pid, sig):
+        killed.append(time.perf_counter())
+        stop.set()
+
+    def grow():
+        time.sleep(delay)
+        crossed['t'] = time.perf_counter()
+        system.set_memory(int(7.5 * GB))
+
+    waiter = oom_watch.PressureWaiter(system.cgroup)
+    thread = threading.Thread(target=grow)
+    thread.start()
+    oom_watch.watchdog(f'{root}/telemetry', system.proc, system.cgroup,
+                       home=root, waiter=waiter, kill=kill, stop=stop)
+    thread.join()
+    return (killed[0] - crossed['t']) * 1000
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    ap.add_argument('--procs', type=int, nargs='+', default=[1000, 5000],
+                    help='numbers of processes. Default: 1000 5000')
+    args = ap.parse_args()
+
+    # the watchdog prints every cycle; keep only the results
+    out = sys.stdout
+    results = []
+    for nprocs in args.procs:
+        with open(os.devnull, 'w') as devnull:
+            sys.stdout = devnull
+            try:
+                with tempfile.TemporaryDirectory() as root:
+                    cold, warm = bench_scan(root, nprocs)
+                with tempfile.TemporaryDirectory() as root:
+                    cycle, polling, events = bench_idle(root, nprocs)
+                with tempfile.TemporaryDirectory() as root:
+                    reaction = bench_reaction(root, nprocs)
+            finally:
+                sys.stdout = out
+        results.append((nprocs, cold, warm, cycle, polling, events,
+                        reaction))
+
+    print('procs | scan cold/warm (ms) | idle cycle (ms CPU) | '
+          'CPU per idle hour polling/events (s) | reaction (ms)')
+    scans = 3600 / oom_watch.TELEMETRY_SCAN_INTERVAL
+    for nprocs, cold, warm, cycle, polling, events, reaction in results:
+        hour_polling = (cycle * polling + warm * scans) / 1000
+        hour_events = (cycle * events + warm * scans) / 1000
+        print(f'{nprocs} | {cold:.1f}/{warm:.1f} | {cycle:.2f} | '
+              f'{hour_polling:.2f}/{hour_events:.2f} | {reaction:.0f}')
+
+
+if __name__ == '__main__':
+    main()
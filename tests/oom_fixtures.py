@@ -0,0 +1,167 @@
+"""Fake /proc and cgroup trees, and memory trajectories, for the tests and
+benchmarks of fornax-jupyter/scripts/oom_watch.py"""
+import importlib.util
+import os
+import random
+
+SCRIPTS_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'fornax-jupyter', 'scripts')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+MB = 1024**2
+GB = 1024**3
+
+
+def load_script(name):
+    """Import fornax-jupyter/scripts/{name}.py"""
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SCRIPTS_DIR, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def kernel_cmd(kernel_id, runtime_dir='/home/jovyan/.local/share/jupyter'):
+    """Return the command line of a jupyter kernel"""
+    return (f'/opt/envs/python3/bin/python -m ipykernel_launcher -f '
+            f'{runtime_dir}/runtime/kernel-{kernel_id}.json')
+
+
+class FakeSystem:
+    """A fake /proc and cgroup (v2 or v1) tree under {root}.
+
+    The processes are in the cgroup unless added with in_cgroup=False.
+    """
+
+    def __init__(self, root, limit, version=2):
+        self.proc = os.path.join(root, 'proc')
+        self.cgroup = os.path.join(root, 'cgroup')
+        self.version = version
+        self.limit = limit
+        self.processes = {}
+        self.in_cgroup = set()
+        self.starts = 0
+
+        memory_dir = self.memory_dir
+        os.makedirs(os.path.join(self.proc, 'self'))
+        os.makedirs(memory_dir)
+        with open(os.path.join(self.proc, 'self', 'cgroup'), 'w') as fp:
+            fp.write('0::/\n' if version == 2 else '4:memory:/\n')
+        self.write(f'memory.{"max" if version == 2 else "limit_in_bytes"}',
+                   limit)
+        self.set_memory(0)
+
+    @property
+    def memory_dir(self):
+        """Folder of the memory files"""
+        if self.version == 2:
+            return self.cgroup
+        return os.path.join(self.cgroup, 'memory')
+
+    def write(self, name, value):
+        """Write {value} to the cgroup file {name}"""
+        with open(os.path.join(self.memory_dir, name), 'w') as fp:
+            fp.write(f'{value}\n')
+
+    def set_memory(self, used, anon=None, file=0, shmem=0):
+        """Set the memory used by the cgroup"""
+        anon = used - file if anon is None else anon
+        if self.version == 2:
+            self.write('memory.current', used)
+            self.write('memory.stat',
+                       f'anon {anon}\nfile {file}\nshmem {shmem}')
+        else:
+            self.write('memory.usage_in_bytes', used)
+            self.write('memory.stat', f'rss {anon}\ncache {file}\n'
+                       f'shmem {shmem}\ntotal_rss {anon}\n'
+                       f'total_cache {file}\ntotal_shmem {shmem}')
+
+    def write_procs(self):
+        """Update cgroup.procs"""
+        self.write('cgroup.procs', '\n'.join(map(str, sorted(self.in_cgroup))))
+
+    def add_process(self, pid, cmd, rss, ppid=1, pss=None, in_cgroup=True,
+                    update=True):
+        """Add process {pid}, with {rss} and {pss} bytes"""
+        self.starts += 1
+        self.processes[pid] = {'cmd': cmd, 'ppid': ppid,
+                               'start': self.starts}
+        os.makedirs(os.path.join(self.proc, str(pid)), exist_ok=True)
+        with open(os.path.join(self.proc, str(pid), 'cmdline'), 'w') as fp:
+            fp.write(cmd.replace(' ', '\0') + '\0')
+        self.set_rss(pid, rss, pss)
+        if in_cgroup:
+            self.in_cgroup.add(pid)
+            if update:
+                self.write_procs()
+
+    def set_rss(self, pid, rss, pss=None):
+        """Set the memory of process {pid}"""
+        process = self.processes[pid]
+        name = os.path.basename(process['cmd'].split()[0])[:15]
+        # the fields of /proc/pid/stat after the name: 19 is the start
+        # time, 21 is the RSS in pages
+        fields = (['S', str(process['ppid'])] + ['0'] * 17 +
+                  [str(process['start']), '0', str(rss // PAGE_SIZE)] +
+                  ['0'] * 30)
+        folder = os.path.join(self.proc, str(pid))
+        with open(os.path.join(folder, 'stat'), 'w') as fp:
+            fp.write(f"{pid} ({name}) {' '.join(fields)}\n")
+        with open(os.path.join(folder, 'statm'), 'w') as fp:
+            fp.write(f'{2 * rss // PAGE_SIZE} {rss // PAGE_SIZE} 0 0 0 0 0\n')
+        with open(os.path.join(folder, 'smaps_rollup'), 'w') as fp:
+            fp.write(f'Rss: {rss // 1024} kB\n'
+                     f'Pss: {(rss if pss is None else pss) // 1024} kB\n')
+
+    def remove_process(self, pid):
+        """Remove process {pid}, as if it exited"""
+        folder = os.path.join(self.proc, str(pid))
+        for name in os.listdir(folder):
+            os.remove(os.path.join(folder, name))
+        os.rmdir(folder)
+        del self.processes[pid]
+        self.in_cgroup.discard(pid)
+        self.write_procs()
+
+    def populate(self, nprocs, nkernels=4, seed=1):
+        """Add a jupyter server, {nkernels} kernels, and {nprocs} processes
+        in total, most of them workers of the kernels with 1 to 100 MB
+
+        Returns:
+        --------
+        list of the kernel pids
+
+        """
+        rand = random.Random(seed)
+        self.add_process(10, '/opt/jupyter/bin/python /opt/jupyter/bin/'
+                         'jupyterhub-singleuser', 300 * MB, update=False)
+        kernels = list(range(100, 100 + nkernels))
+        for pid in kernels:
+            self.add_process(pid, kernel_cmd(f'k{pid}'), 200 * MB, ppid=10,
+                             update=False)
+        for pid in range(1000, 1000 + nprocs - nkernels - 1):
+            self.add_process(
+                pid, f'/opt/envs/python3/bin/python -c worker {pid}',
+                rand.randint(1, 100) * MB, ppid=rand.choice(kernels),
+                update=False)
+        self.write_procs()
+        return kernels
+
+
+def grow_trace(limit=8 * GB, stable=3.5 * GB, rate=0.5 * GB, start=10,
+               duration=40, step=0.1, base=0.8 * GB):
+    """Return a memory trace (oom_replay.py format) of a kernel that
+    holds {stable} bytes, and of another one that starts growing by {rate}
+    bytes/sec at {start} sec, until the limit is reached"""
+    samples = []
+    for index in range(int(duration / step)):
+        now = index * step
+        grown = int(max(0, now - start) * rate)
+        samples.append({
+            't': now, 'limit': limit, 'used': int(base + stable) + grown,
+            'procs': {
+                '10': [int(base), 'jupyterhub-singleuser'],
+                '100': [int(stable), kernel_cmd('stable')],
+                '101': [grown, kernel_cmd('growing')],
+            }
+        })
+    return samples
@@ -3,10 +3,195 @@ from unittest.mock import patch, MagicMock, call
 from argparse import Namespace
 import sys
 import os
+import threading
+import time
+import tempfile
+import subprocess
+import json
+import io
+import tarfile
+import hashlib
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 
+sys.path.insert(0, os.path.dirname(__file__))
 sys.path.insert(0, f'{os.path.dirname(__file__)}/../scripts/')
+from common import change_dir  # noqa: E402
 from build import Builder, DEFAULT_REPO, IMAGE_ORDER  # noqa: E402
+from build import get_build_graph, get_critical_paths  # noqa: E402
+from build import get_changed_images, get_downstream_images  # noqa: E402
+from build import LayerReader, KERNELS_DIR, KERNELS_STAGING_DIR  # noqa: E402,E501
+from build import read_layer, read_link_targets  # noqa: E402
+from build import SOFTWARE_IMAGES, get_kernel_precedence  # noqa: E402
+from build import BuildTrace, StepProfiler  # noqa: E402
+from build import summarize_step_history  # noqa: E402
+
+
+def make_layer(files, links=None):
+    """Return a layer tarball (bytes) with {files}: {path: content}, and
+    {links}: {path: (tarfile.SYMTYPE or LNKTYPE, target)}"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for path, content in files.items():
+            info = tarfile.TarInfo(path)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        for path, (kind, target) in (links or {}).items():
+            info = tarfile.TarInfo(path)
+            info.type = kind
+            info.linkname = target
+            tar.addfile(info)
+    return buffer.getvalue()
+
+
+class FakeRegistry(BaseHTTPRequestHandler):
+    """A local stand-in for the manifest endpoints of a registry,
+    with token authentication"""
+
+    manifests = {}
+    blobs = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b'', headers=None):
+        self.send_response(code)
+        for key, val in (headers or {}).items():
+            self.send_header(key, val)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        if self.headers.get('Authorization') == 'Bearer fake-token':
+            return True
+        port = self.server.server_address[1]
+        self.reply(401, headers={'WWW-Authenticate': (
+            f'Bearer realm="http://localhost:{port}/token",'
+            'service="fake-registry"')})
+        return False
+
+    def do_GET(self):
+        self.requests.append(('GET', self.path))
+        if self.path.startswith('/token'):
+            token = json.dumps({'token': 'fake-token'}).encode()
+            return self.reply(200, token)
+        if not self.authorized():
+            return
+        if self.path in self.blobs:
+            return self.reply(200, self.blobs[self.path])
+        if self.path not in self.manifests:
+            return self.reply(404)
+        media_type, body = self.manifests[self.path]
+        self.reply(200, body, {'Content-Type': media_type})
+
+    def do_PUT(self):
+        self.requests.append(('PUT', self.path))
+        if not self.authorized():
+            return
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.manifests[self.path] = (self.headers['Content-Type'], body)
+        self.reply(201)
+
+
+class FakeEcr(BaseHTTPRequestHandler):
+    """A local stand-in for the ecr endpoints, replying with the next
+    status in {statuses} for each path (default 200); a status of None
+    replies after {delay} sec, to time out the client"""
+
+    protocol_version = 'HTTP/1.1'
+    statuses = {}
+    requests = []
+    delay = 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.requests.append((self.path, self.client_address))
+        path, _, query = self.path.partition('?')
+        codes = self.statuses.get(path, [])
+        code = codes.pop(0) if codes else 200
+        if code is None:
+            time.sleep(self.delay)
+            code = 200
+        body = b'Success'
+        try:
+            self.send_response(code)
+            if 300 <= code < 400:
+                self.send_header('Location', f'/ok?{query}')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # the client timed out and closed the connection
+            self.close_connection = True
+
+
+class FakePackages(BaseHTTPRequestHandler):
+    """A local stand-in for the GitHub packages API, listing {versions}
+    (lists of tags) {per_page} at a time, with ETags"""
+
+    versions = []
+    per_page = 2
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path, _, query = self.path.partition('?')
+        page = int(dict(
+            item.split('=') for item in query.split('&'))['page'])
+        start = (page - 1) * self.per_page
+        body = json.dumps([
+            {'metadata': {'container': {'tags': tags}}}
+            for tags in self.versions[start:start + self.per_page]
+        ]).encode()
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        cached = self.headers.get('If-None-Match') == etag
+        self.requests.append((page, cached))
+        last = (len(self.versions) - 1) // self.per_page + 1
+        port = self.server.server_address[1]
+        link = (f'<http://localhost:{port}{path}?per_page=100&page={last}>; '
+                'rel="last"')
+        self.send_response(304 if cached else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Link', link)
+        if cached:
+            self.end_headers()
+            return
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeAmiEndpoint(BaseHTTPRequestHandler):
+    """A local stand-in for the AMI builder endpoints, replying with the
+    next status in {statuses} for each path (default 200) after 0.2 sec;
+    a status of None closes the connection without a reply"""
+
+    statuses = {}
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.path, json.loads(body)))
+        time.sleep(0.2)
+        codes = self.statuses.get(self.path, [])
+        code = codes.pop(0) if codes else 200
+        if code is None:
+            self.close_connection = True
+            return
+        self.send_response(code)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
 
 
 class TestBuilder(unittest.TestCase):
@@ -20,12 +205,34 @@ class TestBuilder(unittest.TestCase):
             tag='test-tag',
             build=False,
             push=False,
+            push_jobs=1,
+            push_retries=3,
+            ecr_retries=3,
             retag=None,
+            retag_method='docker',
             ecr=None,
             extra_args=None,
             build_vars=None,
             export_locks=False,
-            repo=None
+            extract_from='container',
+            repo=None,
+            jobs=1,
+            trace=None,
+            compare=None,
+            compare_threshold=0.2,
+            step_profile=None,
+            step_report=False,
+            costs=None,
+            budget=None,
+            changed_since=None,
+            cache_repo=None,
+            cache_dir=None,
+            bake=False,
+            bake_file=None,
+            skip_unchanged=False,
+            state_file=None,
+            journal=None,
+            resume=False,
         )
 
     def test_initialization(self):
@@ -238,6 +445,369 @@ class TestBuilder(unittest.TestCase):
             self.assertIn(
                 f"--tag {DEFAULT_REPO}/{im}:{time_tag}", called_args)
 
+    def test_get_build_graph(self):
+        """Test the dependency graph from the Dockerfiles."""
+        graph = get_build_graph(IMAGE_ORDER)
+        self.assertEqual(graph['jupyter-base'], set())
+        self.assertEqual(graph['fornax-base'], {'jupyter-base'})
+        self.assertEqual(graph['env-ciao'], {'fornax-base'})
+        self.assertEqual(graph['env-sas'], {'fornax-base', 'env-heasoft'})
+        # fornax-jupyter needs the kernels from the software images
+        self.assertIn('env-sas', graph['fornax-jupyter'])
+        self.assertIn('fornax-nb', graph['fornax-jupyter'])
+
+        # only parents that are requested are kept
+        graph = get_build_graph(['env-sas', 'fornax-hea'])
+        self.assertEqual(graph['env-sas'], set())
+        self.assertEqual(graph['fornax-hea'], {'env-sas'})
+
+    @patch('build.Builder.run')
+    @patch('build.Builder.copy_common_files')
+    @patch('build.Builder.extract_kernel_files')
+    def test_do_build_parallel(self, mock_extract, mock_copy, mock_run):
+        """Test parents are built before children with --jobs."""
+        self.default_args.jobs = 4
+        self.default_args.images = list(IMAGE_ORDER)
+        builder = Builder(self.default_args)
+        builder.check_input()
+        builder.do_build("20260512_1200")
+
+        built = [args[0][0].split()[-1] for args in mock_run.call_args_list
+                 if args[0][0].startswith('docker build')]
+        self.assertEqual(sorted(built), sorted(IMAGE_ORDER))
+        graph = get_build_graph(IMAGE_ORDER)
+        for image, parents in graph.items():
+            for parent in parents:
+                self.assertLess(built.index(parent), built.index(image))
+
+    @patch('build.Builder.run')
+    def test_do_build_failure(self, mock_run):
+        """Test a failed build stops its children from building."""
+        def run(cmd, *args, **kwargs):
+            if cmd.endswith(' fornax-base'):
+                raise RuntimeError('build failed')
+        mock_run.side_effect = run
+        self.default_args.jobs = 2
+        self.default_args.images = ['fornax-base', 'env-ciao']
+        builder = Builder(self.default_args)
+        builder.check_input()
+        with self.assertRaises(RuntimeError):
+            builder.do_build("20260512_1200")
+        self.assertEqual(mock_run.call_count, 1)
+
+    def test_changed_images(self):
+        """Test mapping changed files to the affected images."""
+        changed = get_changed_images([
+            'env-ciao/build-ciao.sh', 'scripts/build.py', 'changes.md',
+            'fornax-base/scripts/setup-pip-env', 'tests/common.py'
+        ])
+        self.assertEqual(
+            changed, ['fornax-base', 'env-ciao', 'fornax-jupyter'])
+
+        affected = get_downstream_images(['env-heasoft'])
+        self.assertEqual(
+            affected,
+            ['env-heasoft', 'env-sas', 'fornax-hea', 'fornax-jupyter'])
+        affected = get_downstream_images(['archive-nb'])
+        self.assertEqual(
+            affected, ['archive-nb', 'fornax-main', 'fornax-jupyter'])
+        affected = get_downstream_images(['fornax-base'])
+        self.assertEqual(affected, list(IMAGE_ORDER[1:]))
+
+    @patch('build.Builder.get_changed_files')
+    def test_check_input_changed_since(self, mock_changed):
+        """Test --changed-since selects the affected images."""
+        mock_changed.return_value = ['env-ciao/build-ciao.sh']
+        self.default_args.build = True
+        self.default_args.images = []
+        self.default_args.changed_since = 'origin/develop'
+        builder = Builder(self.default_args)
+        builder.check_input()
+        mock_changed.assert_called_once_with('origin/develop')
+        self.assertEqual(
+            builder.images, ['env-ciao', 'fornax-hea', 'fornax-jupyter'])
+
+    def test_critical_paths(self):
+        """Test the longest remaining path of each image."""
+        graph = get_build_graph(['fornax-base', 'env-heasoft', 'env-sas',
+                                 'env-ciao'])
+        costs = {'fornax-base': {'duration': 10},
+                 'env-heasoft': {'duration': 50},
+                 'env-sas': {'duration': 30},
+                 'env-ciao': {'duration': 40}}
+        paths = get_critical_paths(graph, costs)
+        self.assertEqual(paths['env-sas'], 30)
+        self.assertEqual(paths['env-heasoft'], 80)
+        self.assertEqual(paths['env-ciao'], 40)
+        self.assertEqual(paths['fornax-base'], 90)
+
+    def test_schedule_budget(self):
+        """Test the builds stay within the budget, critical path first."""
+        self.default_args.jobs = 4
+        self.default_args.budget = 'memory=16'
+        builder = Builder(self.default_args)
+        builder.check_input()
+        self.assertEqual(builder.budget, {'memory': 16})
+        builder.costs = {
+            'env-heasoft': {'duration': 50, 'memory': 12},
+            'env-ciao': {'duration': 40, 'memory': 8},
+            'env-fermi': {'duration': 10, 'memory': 4},
+        }
+
+        started = []
+        usage = []
+        lock = threading.Lock()
+
+        def task(image):
+            with lock:
+                started.append(image)
+                usage.append(sum(builder.get_cost(im)['memory']
+                                 for im in started if im not in finished))
+            time.sleep(0.05)
+            with lock:
+                finished.append(image)
+
+        finished = []
+        graph = get_build_graph(['env-heasoft', 'env-ciao', 'env-fermi'])
+        builder.schedule(graph, task)
+        self.assertEqual(started[0], 'env-heasoft')
+        self.assertEqual(sorted(started),
+                         ['env-ciao', 'env-fermi', 'env-heasoft'])
+        self.assertLessEqual(max(usage), 16)
+
+        # wrong format
+        self.default_args.budget = 'ram=16'
+        builder = Builder(self.default_args)
+        with self.assertRaises(ValueError):
+            builder.check_input()
+
+    @patch('build.Builder.run')
+    def test_fingerprint(self, mock_run):
+        """Test the build fingerprint follows the inputs."""
+        mock_run.return_value = MagicMock(stdout='sha256:parent\n')
+        builder = Builder(self.default_args)
+        builder.check_input()
+        args = builder.get_build_args('env-ciao', '20260512_1200')
+        fp1 = builder.get_fingerprint('env-ciao', args)
+        self.assertIsNotNone(fp1)
+
+        # BUILD_VERSION changes every build and is ignored
+        args2 = builder.get_build_args('env-ciao', '20260513_1200')
+        self.assertEqual(fp1, builder.get_fingerprint('env-ciao', args2))
+
+        # other arguments are not
+        args2 = args + ['VAR=1']
+        self.assertNotEqual(fp1, builder.get_fingerprint('env-ciao', args2))
+
+        # a new parent image
+        mock_run.return_value = MagicMock(stdout='sha256:new-parent\n')
+        self.assertNotEqual(fp1, builder.get_fingerprint('env-ciao', args))
+
+    @patch('build.Builder.run')
+    def test_skip_unchanged(self, mock_run):
+        """Test unchanged images are retagged rather than rebuilt."""
+        mock_run.return_value = MagicMock(stdout='sha256:abc\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.default_args.skip_unchanged = True
+            self.default_args.state_file = f'{tmpdir}/state.json'
+            self.default_args.costs = f'{tmpdir}/costs.json'
+            self.default_args.images = ['env-ciao']
+            builder = Builder(self.default_args)
+            builder.check_input()
+            builder.do_build('20260512_1200')
+            commands = [c[0][0] for c in mock_run.call_args_list]
+            self.assertTrue(
+                any(cmd.startswith('docker build') for cmd in commands))
+            self.assertTrue(os.path.exists(self.default_args.state_file))
+
+            # second build; same inputs
+            mock_run.reset_mock()
+            builder = Builder(self.default_args)
+            builder.check_input()
+            with patch('build.Builder.update_cost') as mock_cost:
+                builder.do_build('20260513_1200')
+            commands = [c[0][0] for c in mock_run.call_args_list]
+            self.assertFalse(
+                any(cmd.startswith('docker build') for cmd in commands))
+            self.assertIn(
+                f'docker tag sha256:abc {DEFAULT_REPO}/env-ciao:20260513_1200',
+                commands
+            )
+            # a retag does not pull the learned build time to 0
+            mock_cost.assert_not_called()
+            with open(self.default_args.costs) as fp:
+                self.assertIn('env-ciao', json.load(fp))
+
+    def test_bake_definition(self):
+        """Test the bake definition of a set of images."""
+        builder = Builder(self.default_args)
+        builder.check_input()
+        time_tag = "20260512_1200"
+        images = ['fornax-base', 'env-heasoft', 'env-sas']
+        definition = builder.get_bake_definition(images, time_tag)
+
+        self.assertEqual(definition['group']['default']['targets'], images)
+        target = definition['target']['env-sas']
+        self.assertEqual(target['context'], 'env-sas')
+        self.assertEqual(target['args']['BASE_TAG'], 'test-tag')
+        self.assertEqual(target['args']['BUILD_VERSION'],
+                         f'env-sas:{time_tag}')
+        self.assertEqual(target['tags'], [
+            f'{DEFAULT_REPO}/env-sas:test-tag',
+            f'{DEFAULT_REPO}/env-sas:{time_tag}'])
+        self.assertEqual(target['contexts'], {
+            f'{DEFAULT_REPO}/env-heasoft:test-tag': 'target:env-heasoft',
+            f'{DEFAULT_REPO}/fornax-base:test-tag': 'target:fornax-base',
+        })
+        # parents outside the definition come from the registry
+        self.assertNotIn('contexts', definition['target']['fornax-base'])
+
+        # the contexts match the FROM references changed by --build-vars
+        self.default_args.build_vars = 'REPOSITORY=localhost:5000/fornax'
+        builder = Builder(self.default_args)
+        builder.check_input()
+        definition = builder.get_bake_definition(images, time_tag)
+        self.assertEqual(definition['target']['env-sas']['contexts'], {
+            'localhost:5000/fornax/env-heasoft:test-tag':
+                'target:env-heasoft',
+            'localhost:5000/fornax/fornax-base:test-tag':
+                'target:fornax-base',
+        })
+
+    @patch('build.Builder.run')
+    @patch('build.Builder.build_image')
+    def test_do_bake(self, mock_build_image, mock_run):
+        """Test building with bake."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.default_args.bake_file = f'{tmpdir}/bake.json'
+            self.default_args.images = ['fornax-base', 'fornax-jupyter']
+            builder = Builder(self.default_args)
+            builder.check_input()
+            builder.do_bake("20260512_1200")
+            self.assertTrue(os.path.exists(self.default_args.bake_file))
+
+        mock_run.assert_called_once_with(
+            f'docker buildx bake --file {tmpdir}/bake.json --load',
+            timeout=10000)
+        mock_build_image.assert_called_once_with(
+            'fornax-jupyter', "20260512_1200")
+
+    def test_cache_args(self):
+        """Test the build cache options."""
+        builder = Builder(self.default_args)
+        self.assertEqual(builder.get_cache_args('env-ciao'), ([], None))
+
+        self.default_args.cache_repo = 'localhost:5000/cache'
+        builder = Builder(self.default_args)
+        cache_from, cache_to = builder.get_cache_args('env-ciao')
+        self.assertEqual(cache_from, [
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-test-tag',  # noqa E501
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-develop',  # noqa E501
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-main',  # noqa E501
+        ])
+        self.assertEqual(
+            cache_to,
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-test-tag,mode=max'  # noqa E501
+        )
+
+        # local cache; only existing folders are read
+        self.default_args.cache_repo = None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(f'{tmpdir}/env-ciao/develop')
+            self.default_args.cache_dir = tmpdir
+            builder = Builder(self.default_args)
+            cache_from, cache_to = builder.get_cache_args('env-ciao')
+        self.assertEqual(cache_from,
+                         [f'type=local,src={tmpdir}/env-ciao/develop'])
+        self.assertEqual(
+            cache_to, f'type=local,dest={tmpdir}/env-ciao/test-tag,mode=max')
+
+        # both is an error
+        self.default_args.bake = True
+        self.default_args.cache_repo = 'localhost:5000/cache'
+        builder = Builder(self.default_args)
+        with self.assertRaises(ValueError):
+            builder.check_input()
+
+    @patch('build.Builder.run')
+    def test_do_build_cache(self, mock_run):
+        """Test the cache options are only passed to bake."""
+        self.default_args.cache_repo = 'localhost:5000/cache'
+        self.default_args.images = ['fornax-base', 'env-ciao']
+        builder = Builder(self.default_args)
+        with self.assertRaises(ValueError):
+            builder.check_input()
+
+        self.default_args.bake = True
+        builder = Builder(self.default_args)
+        builder.check_input()
+        definition = builder.get_bake_definition(
+            ['fornax-base', 'env-ciao'], '20260512_1200')
+        target = definition['target']['env-ciao']
+        self.assertIn(
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-main',  # noqa E501
+            target['cache-from'])
+        self.assertEqual(target['cache-to'], [
+            'type=registry,ref=localhost:5000/cache/env-ciao:buildcache-test-tag,mode=max'])  # noqa E501
+        # the parent built in the same run is used, not the registry copy
+        self.assertEqual(list(target['contexts'].values()),
+                         ['target:fornax-base'])
+
+        # docker build (fornax-jupyter after the bake) has no cache
+        builder.build_image('env-ciao', '20260512_1200')
+        self.assertNotIn('--cache', mock_run.call_args_list[0][0][0])
+
+    def test_kernel_precedence(self):
+        """Test the order the kernels are merged in."""
+        order = get_kernel_precedence(SOFTWARE_IMAGES)
+        self.assertEqual(order[-1], 'env-core')
+        self.assertEqual(sorted(order), sorted(SOFTWARE_IMAGES))
+        self.assertEqual(order, get_kernel_precedence(reversed(order)))
+        # SOFTWARE_IMAGES is not changed
+        self.assertEqual(SOFTWARE_IMAGES, [
+            im for im in IMAGE_ORDER if im.startswith('env-') or '-nb' in im])
+
+    @patch('build.Builder.run')
+    def test_extract_kernel_files(self, mock_run):
+        """Test kernels are harvested per image and merged."""
+        def harvest(image):
+            kernel = f'{KERNELS_STAGING_DIR}/{image}/python3'
+            os.makedirs(kernel)
+            with open(f'{kernel}/kernel.json', 'w') as fp:
+                fp.write(image)
+            os.makedirs(f'{KERNELS_STAGING_DIR}/{image}/{image}')
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with change_dir(tmpdir):
+                os.mkdir('fornax-jupyter')
+                builder = Builder(self.default_args)
+                with patch('build.Builder.harvest_kernels') as mock_harvest:
+                    mock_harvest.side_effect = harvest
+                    builder.extract_kernel_files()
+                self.assertEqual(mock_harvest.call_count,
+                                 len(SOFTWARE_IMAGES))
+                kernels = sorted(os.listdir('fornax-jupyter/kernels'))
+                with open('fornax-jupyter/kernels/python3/kernel.json') as fp:
+                    python3 = fp.read()
+        self.assertEqual(kernels, sorted(SOFTWARE_IMAGES + ['python3']))
+        self.assertEqual(python3, 'env-core')
+
+    @patch('build.Builder.run')
+    @patch('build.Builder.copy_common_files')
+    @patch('build.Builder.extract_kernel_files')
+    @patch('build.Builder.harvest_kernels')
+    def test_harvest_while_building(self, mock_harvest, mock_extract,
+                                    mock_copy, mock_run):
+        """Test kernels are harvested as soon as an image is built."""
+        self.default_args.images = ['env-ciao', 'fornax-main',
+                                    'fornax-jupyter']
+        builder = Builder(self.default_args)
+        builder.check_input()
+        builder.do_build("20260512_1200")
+        mock_harvest.assert_called_once_with('env-ciao')
+        self.assertEqual(list(builder.harvests), ['env-ciao'])
+        mock_extract.assert_called_once()
+
     @patch('build.Builder.run')
     def test_do_push(self, mock_run):
         """Test docker push command generation."""
@@ -258,6 +828,86 @@ class TestBuilder(unittest.TestCase):
             called_args
         )
 
+    @patch('build.PUSH_RETRY_DELAY', 0)
+    @patch('build.Builder.run')
+    def test_do_push_retry(self, mock_run):
+        """Test failed pushes are retried."""
+        error = subprocess.CalledProcessError(1, 'docker push')
+        mock_run.side_effect = [error, None, error, error, error, error]
+        self.default_args.images = ['fornax-main', 'fornax-hea']
+        builder = Builder(self.default_args)
+        builder.check_input()
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            builder.do_push()
+        # 2 for fornax-main, and 1 + 3 retries for fornax-hea
+        self.assertEqual(mock_run.call_count, 6)
+
+    @patch('build.Builder.run')
+    def test_build_and_push(self, mock_run):
+        """Test images are pushed as they are built."""
+        self.default_args.build = True
+        self.default_args.push = True
+        self.default_args.push_jobs = 2
+        self.default_args.images = ['fornax-base', 'env-ciao']
+        builder = Builder(self.default_args)
+        builder.run_with_args()
+
+        commands = [c[0][0] for c in mock_run.call_args_list]
+        self.assertEqual(len(commands), 6)
+        for image in self.default_args.images:
+            build = [i for i, cmd in enumerate(commands)
+                     if cmd.startswith('docker build') and
+                     cmd.endswith(f' {image}')]
+            push_cmd = f'docker push {DEFAULT_REPO}/{image}:'
+            pushes = [i for i, cmd in enumerate(commands)
+                      if cmd.startswith(push_cmd)]
+            self.assertEqual(len(build), 1)
+            self.assertEqual(len(pushes), 2)
+            self.assertLess(build[0], min(pushes))
+
+    @patch('build.Builder.run')
+    def test_resume(self, mock_run):
+        """Test resuming a failed run from its journal."""
+        def run(command, timeout, **kwargs):
+            if command.startswith('docker push') and 'env-ciao' in command:
+                raise subprocess.CalledProcessError(1, command)
+        mock_run.side_effect = run
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.default_args.journal = f'{tmpdir}/journal.json'
+            self.default_args.build = True
+            self.default_args.push = True
+            self.default_args.push_retries = 0
+            self.default_args.images = ['fornax-base', 'env-ciao']
+            builder = Builder(self.default_args)
+            with self.assertRaises(subprocess.CalledProcessError):
+                builder.run_with_args()
+            with open(f'{tmpdir}/journal.json') as fp:
+                journal = json.load(fp)
+            time_tag = journal['time_tag']
+            self.assertIn('build env-ciao', journal['done'])
+            self.assertIn(f'push {DEFAULT_REPO}/fornax-base:{time_tag}',
+                          journal['done'])
+
+            # the journal is for a different run
+            self.default_args.resume = True
+            self.default_args.images = ['fornax-base']
+            with self.assertRaises(ValueError):
+                Builder(self.default_args).run_with_args()
+
+            mock_run.reset_mock()
+            mock_run.side_effect = None
+            self.default_args.images = ['fornax-base', 'env-ciao']
+            with patch('build.datetime') as mock_datetime:
+                mock_datetime.now.return_value.strftime.return_value = 'new'
+                Builder(self.default_args).run_with_args()
+
+        commands = sorted(c[0][0] for c in mock_run.call_args_list)
+        self.assertEqual(commands, [
+            f'docker push {DEFAULT_REPO}/env-ciao:{time_tag}',
+            f'docker push {DEFAULT_REPO}/env-ciao:test-tag',
+        ])
+
     @patch('build.Builder.run')
     def test_do_retag(self, mock_run):
         """Test docker retag command generation."""
@@ -300,41 +950,333 @@ class TestBuilder(unittest.TestCase):
             ]
         mock_run.assert_has_calls(expected_calls, any_order=False)
 
-    @patch('build.urllib.request.urlopen')
-    def test_do_ecr(self, mock_urlopen):
-        """Test triggering ECR endpoint."""
-        self.default_args.ecr = ['https://fake.endpoint.com']
-        self.default_args.images = ['fornax-jupyter']
+    def test_do_registry_retag(self):
+        """Test retagging through the registry API."""
+        FakeRegistry.requests = []
+        server = ThreadingHTTPServer(('localhost', 0), FakeRegistry)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+        manifest = b'{"schemaVersion": 2, "manifests": []}'
+        media_type = 'application/vnd.oci.image.index.v1+json'
+        for image in ['fornax-main', 'fornax-hea']:
+            FakeRegistry.manifests[
+                f'/v2/fornax/{image}/manifests/test-tag'] = (
+                media_type, manifest)
+
+        self.default_args.repo = f'localhost:{port}/fornax'
+        self.default_args.retag = ['main', 'stable']
+        self.default_args.retag_method = 'registry'
+        self.default_args.images = ['fornax-main', 'fornax-hea']
         builder = Builder(self.default_args)
+        builder.check_input()
+        with patch('build.Builder.run') as mock_run:
+            builder.do_retag()
+            mock_run.assert_not_called()
+        server.shutdown()
 
-        # Setup mock response
-        mock_resp = MagicMock()
-        mock_resp.status = 200
-        mock_resp.read.return_value = b"Success"
-        mock_urlopen.return_value = mock_resp
+        for image in ['fornax-main', 'fornax-hea']:
+            for tag in ['main', 'stable']:
+                self.assertEqual(
+                    FakeRegistry.manifests[
+                        f'/v2/fornax/{image}/manifests/{tag}'],
+                    (media_type, manifest)
+                )
+        # no blobs are transferred
+        self.assertFalse(
+            any('/blobs/' in path for _, path in FakeRegistry.requests))
 
-        builder.do_ecr()
+    def test_layer_reader(self):
+        """Test merging layers top-down with whiteouts."""
+        kernels = KERNELS_DIR.strip('/')
+        layers = [
+            make_layer({
+                f'{kernels}/python3/kernel.json': b'old',
+                f'{kernels}/heasoft/kernel.json': b'heasoft',
+                f'{kernels}/ciao/kernel.json': b'ciao',
+                'opt/other/file.txt': b'other',
+            }),
+            make_layer({
+                f'{kernels}/python3/kernel.json': b'new',
+                f'{kernels}/.wh.ciao': b'',
+            }),
+        ]
+        reader = LayerReader([KERNELS_DIR])
+        for layer in reversed(layers):
+            reader.add_layer(io.BytesIO(layer))
 
-        # Verify urlopen was called
-        mock_urlopen.assert_called_once()
-        called_request = mock_urlopen.call_args[0][0]
-        self.assertEqual(
-            called_request.full_url,
-            f"{self.default_args.ecr[0]}?image=fornax-jupyter&tag=test-tag"
-        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reader.write(KERNELS_DIR, tmpdir)
+            with open(f'{tmpdir}/python3/kernel.json') as fp:
+                self.assertEqual(fp.read(), 'new')
+            self.assertTrue(os.path.exists(f'{tmpdir}/heasoft/kernel.json'))
+            self.assertFalse(os.path.exists(f'{tmpdir}/ciao'))
+            self.assertFalse(os.path.exists(f'{tmpdir}/file.txt'))
 
-    @patch('build.urllib.request.urlopen')
+        # links: hardlinks outside the folder are read again, symlinks
+        # are kept inside the destination
+        layer = make_layer({'opt/envs/python3/logo.png': b'png'}, {
+            f'{kernels}/python3/logo.png': (
+                tarfile.LNKTYPE, 'opt/envs/python3/logo.png'),
+            f'{kernels}/python3/icon.png': (
+                tarfile.SYMTYPE, f'/{kernels}/python3/logo.png'),
+            f'{kernels}/python3/env': (tarfile.SYMTYPE, '/opt/envs/python3'),
+            f'{kernels}/python3/up': (tarfile.SYMTYPE, '../../../../..'),
+        })
+        reader = LayerReader([KERNELS_DIR])
+        reader.add_layer(io.BytesIO(layer))
+        self.assertEqual(reader.dropped, [f'{kernels}/python3/logo.png'])
+        content = read_layer(io.BytesIO(layer), reader.prefixes)
+        read_link_targets(io.BytesIO(layer), content)
+        self.assertEqual(content['links'], {})
+        reader = LayerReader([KERNELS_DIR])
+        reader.merge(content)
+        self.assertEqual(reader.dropped, [])
+        with tempfile.TemporaryDirectory() as tmpdir:
+            skipped = reader.write(KERNELS_DIR, tmpdir)
+            self.assertEqual(skipped, [f'{kernels}/python3/env',
+                                       f'{kernels}/python3/up'])
+            with open(f'{tmpdir}/python3/logo.png') as fp:
+                self.assertEqual(fp.read(), 'png')
+            self.assertEqual(os.readlink(f'{tmpdir}/python3/icon.png'),
+                             'logo.png')
+
+        # an opaque folder hides everything below
+        reader = LayerReader([KERNELS_DIR])
+        reader.add_layer(io.BytesIO(make_layer({
+            f'{kernels}/.wh..wh..opq': b''})))
+        self.assertTrue(reader.done)
+
+    def test_do_export_locks_registry(self):
+        """Test exporting lock files from the layers in a registry."""
+        server = ThreadingHTTPServer(('localhost', 0), FakeRegistry)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        port = server.server_address[1]
+
+        layers = [
+            make_layer({'opt/envs/lock/requirements-a.txt': b'a==1'}),
+            make_layer({'opt/envs/lock/requirements-b.txt': b'b==1'}),
+        ]
+        config = json.dumps(
+            {'config': {'Env': ['LOCK_DIR=/opt/envs/lock']}}).encode()
+        manifest = {'config': {}, 'layers': []}
+        for blob in [config] + layers:
+            digest = f'sha256:{hashlib.sha256(blob).hexdigest()}'
+            FakeRegistry.blobs[f'/v2/fornax/env-sas/blobs/{digest}'] = blob
+            if blob is config:
+                manifest['config']['digest'] = digest
+            else:
+                manifest['layers'].append({'digest': digest})
+        FakeRegistry.manifests['/v2/fornax/env-sas/manifests/test-tag'] = (
+            'application/vnd.oci.image.manifest.v1+json',
+            json.dumps(manifest).encode())
+
+        self.default_args.repo = f'localhost:{port}/fornax'
+        self.default_args.images = ['env-sas']
+        self.default_args.export_locks = True
+        self.default_args.extract_from = 'registry'
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with change_dir(tmpdir):
+                builder = Builder(self.default_args)
+                builder.check_input()
+                with patch('build.Builder.run') as mock_run:
+                    builder.do_export_locks()
+                    mock_run.assert_not_called()
+                files = sorted(os.listdir('env-sas_locks'))
+        server.shutdown()
+        self.assertEqual(files, ['requirements-a.txt', 'requirements-b.txt'])
+
+    @patch('build.Builder.run')
+    def test_trace(self, mock_run):
+        """Test the build trace files."""
+        mock_run.return_value = MagicMock(stdout='1000\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.default_args.trace = f'{tmpdir}/trace.json'
+            self.default_args.build = True
+            self.default_args.push = True
+            self.default_args.images = ['fornax-base', 'env-ciao']
+            builder = Builder(self.default_args)
+            builder.run_with_args()
+
+            with open(f'{tmpdir}/trace.json') as fp:
+                phases = json.load(fp)['phases']
+            with open(f'{tmpdir}/trace.chrome.json') as fp:
+                events = json.load(fp)['traceEvents']
+
+        names = sorted((rec['name'], rec['image']) for rec in phases)
+        self.assertEqual(names, [
+            ('build', 'env-ciao'), ('build', 'fornax-base'),
+            ('push', 'env-ciao'), ('push', 'env-ciao'),
+            ('push', 'fornax-base'), ('push', 'fornax-base'),
+        ])
+        for rec in phases:
+            self.assertEqual(rec['status'], 'ok')
+            self.assertEqual(rec['bytes'], 1000)
+            self.assertGreaterEqual(rec['end'], rec['start'])
+        self.assertEqual(len(events), len(phases))
+        self.assertEqual(events[0]['ph'], 'X')
+
+    def test_trace_compare(self):
+        """Test reporting slower phases."""
+        previous = [
+            {'name': 'build', 'image': 'env-sas', 'duration': 1000},
+            {'name': 'build', 'image': 'fornax-nb', 'duration': 1000},
+            {'name': 'push', 'image': 'env-sas', 'duration': 10},
+        ]
+        trace = BuildTrace()
+        with trace.phase('build', 'env-sas') as record:
+            pass
+        with trace.phase('build', 'fornax-nb'):
+            pass
+        with self.assertRaises(ValueError):
+            with trace.phase('push', 'env-sas'):
+                raise ValueError('push failed')
+        self.assertEqual(trace.phases[-1]['status'], 'error')
+        trace.phases[0]['duration'] = 1500
+        trace.phases[1]['duration'] = 1100
+        trace.phases[2]['duration'] = 30
+        self.assertEqual(trace.compare(previous, 0.2),
+                         [('build', 'env-sas', 1000, 1500)])
+        self.assertEqual(record['name'], 'build')
+
+    def test_step_profiler(self):
+        """Test parsing the BuildKit rawjson progress."""
+        lines = [
+            {'vertexes': [{
+                'digest': 'sha256:a', 'name': '[internal] load .dockerignore',
+                'started': '2025-06-01T10:00:00.1Z',
+                'completed': '2025-06-01T10:00:00.2Z'}]},
+            {'vertexes': [{
+                'digest': 'sha256:b', 'name': '[1/3] FROM fornax-base:main',
+                'started': '2025-06-01T10:00:01.000000000Z',
+                'completed': '2025-06-01T10:00:01.500000000Z',
+                'cached': True}]},
+            {'vertexes': [{
+                'digest': 'sha256:c',
+                'name': '[2/3] RUN  mkdir -p $HOME/build',
+                'started': '2025-06-01T10:00:02.123456789Z'}]},
+            {'vertexes': [{
+                'digest': 'sha256:c',
+                'name': '[2/3] RUN  mkdir -p $HOME/build',
+                'started': '2025-06-01T10:00:02.123456789Z',
+                'completed': '2025-06-01T10:00:12.123456789Z'}]},
+            'not json',
+            {'vertexes': [{
+                'digest': 'sha256:d', 'name': '[3/3] COPY . /tmp',
+                'started': '2025-06-01T10:00:13Z',
+                'completed': '2025-06-01T10:01:13Z'}]},
+        ]
+        printed = []
+        profiler = StepProfiler('env-sas', ['RUN mkdir -p $HOME/build'],
+                                printed.append)
+        for line in lines:
+            profiler.add_line(line if isinstance(line, str)
+                              else json.dumps(line))
+        history = ['1000|COPY dir:abc in /tmp', '0|RUN /bin/sh -c mkdir -p '
+                   '$HOME/build # buildkit', 'bad line']
+        steps = profiler.steps(history)
+
+        self.assertEqual(len(printed), 3)
+        self.assertEqual([step['step'] for step in steps], [
+            'FROM fornax-base:main', 'RUN mkdir -p $HOME/build',
+            'COPY . /tmp'])
+        self.assertEqual([step['cached'] for step in steps],
+                         [True, False, False])
+        self.assertEqual([step['onbuild'] for step in steps],
+                         [False, True, False])
+        self.assertAlmostEqual(steps[0]['duration'], 0.5)
+        self.assertAlmostEqual(steps[1]['duration'], 10)
+        self.assertAlmostEqual(steps[2]['duration'], 60)
+        self.assertEqual([step['size'] for step in steps], [None, 0, None])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/steps.jsonl', 'w') as fp:
+                for cached in [True, False]:
+                    steps[2]['cached'] = cached
+                    fp.write(json.dumps(
+                        {'image': 'env-sas', 'steps': steps}) + '\n')
+            summary = summarize_step_history(f'{tmpdir}/steps.jsonl')
+        self.assertEqual([stat['step'] for stat in summary], [
+            'COPY . /tmp', 'RUN mkdir -p $HOME/build',
+            'FROM fornax-base:main'])
+        self.assertEqual([stat['hit_rate'] for stat in summary],
+                         [0.5, 0, 1])
+
+    @patch('build.Builder.run')
+    @patch('build.Builder.run_stream')
+    def test_build_step_profile(self, mock_stream, mock_run):
+        """Test building with --step-profile."""
+        def stream(command, timeout, on_line):
+            on_line(json.dumps({'vertexes': [{
+                'digest': 'sha256:a', 'name': '[1/2] RUN make',
+                'started': '2025-06-01T10:00:00Z',
+                'completed': '2025-06-01T10:00:05Z'}]}))
+        mock_stream.side_effect = stream
+        mock_run.return_value = MagicMock(stdout='2048|RUN /bin/sh -c make\n')
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.default_args.step_profile = f'{tmpdir}/steps.jsonl'
+            self.default_args.step_report = True
+            self.default_args.build = True
+            self.default_args.images = ['env-sas']
+            builder = Builder(self.default_args)
+            builder.run_with_args()
+            with open(f'{tmpdir}/steps.jsonl') as fp:
+                records = [json.loads(line) for line in fp]
+        self.assertIn('--progress=rawjson', mock_stream.call_args[0][0])
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['image'], 'env-sas')
+        self.assertEqual(records[0]['steps'][0]['size'], 2048)
+
+    @patch('build.ECR_RETRY_DELAY', 0)
+    @patch('build.ECR_TIMEOUT', 0.2)
+    def test_do_ecr(self):
+        """Test triggering ECR endpoints."""
+        FakeEcr.requests = []
+        FakeEcr.statuses = {'/retry': [503], '/missing': [404],
+                            '/bad': [400], '/moved': [302],
+                            '/slow': [None]}
+        server = ThreadingHTTPServer(('localhost', 0), FakeEcr)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://localhost:{server.server_address[1]}'
+        self.default_args.ecr = [f'{url}/ok', f'{url}/retry',
+                                 f'{url}/missing', f'{url}/bad',
+                                 f'{url}/moved', f'{url}/slow']
+        self.default_args.images = ['fornax-jupyter']
+        self.default_args.retag = ['main', 'stable']
+        # the ecr calls have their own retries
+        self.default_args.push_retries = 0
+        builder = Builder(self.default_args)
+        summary = builder.do_ecr()
+        server.shutdown()
+
+        self.assertIn(('/ok?image=fornax-jupyter&tag=test-tag'),
+                      [path for path, _ in FakeEcr.requests])
+        # 3 tags x 6 endpoints, one retry, one redirect, and one retry
+        # after a timeout, on a new connection
+        self.assertEqual(len(FakeEcr.requests), 21)
+        self.assertEqual(summary[f'{url}/ok'],
+                         {'ok': 3, 'not_found': 0, 'failed': []})
+        self.assertEqual(summary[f'{url}/retry']['ok'], 3)
+        self.assertEqual(summary[f'{url}/missing']['not_found'], 1)
+        failed = summary[f'{url}/bad']['failed']
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(failed[0][2], 'status 400: Success')
+        self.assertEqual(summary[f'{url}/moved']['ok'], 3)
+        self.assertEqual(summary[f'{url}/slow']['ok'], 3)
+        # kept-alive connections are reused
+        clients = {client for _, client in FakeEcr.requests}
+        self.assertLess(len(clients), len(FakeEcr.requests))
+
+    @patch('build.ConnectionPool.request')
     @patch('build.Builder.run')
-    def test_release(self, mock_run, mock_urlopen):
+    def test_release(self, mock_run, mock_request):
         """Test release flow; retag, ecr but no build."""
         self.default_args.retag = ['main']
         self.default_args.ecr = ['https://fake.endpoint.com']
         self.default_args.images = None
 
-        mock_resp = MagicMock()
-        mock_resp.status = 200
-        mock_resp.read.return_value = b"Success"
-        mock_urlopen.return_value = mock_resp
+        mock_request.return_value = (200, b"Success")
 
         builder = Builder(self.default_args)
         builder.run_with_args()
@@ -351,16 +1293,160 @@ class TestBuilder(unittest.TestCase):
         mock_run.assert_has_calls(expected_calls, any_order=False)
 
         # we also expect ecr to be called
-        # Verify urlopen was called twice, 1 for original tag
+        # Verify the endpoint was called twice, 1 for original tag
         # and 1 for new tag
-        self.assertEqual(mock_urlopen.call_count, 2)
-        called_request = mock_urlopen.call_args_list[0][0][0]
-        self.assertEqual(
-            called_request.full_url,
+        self.assertEqual(mock_request.call_count, 2)
+        urls = sorted(args[0][1] for args in mock_request.call_args_list)
+        self.assertEqual(urls, [
+            f"{self.default_args.ecr[0]}?image=fornax-jupyter&tag=main",
             f"{self.default_args.ecr[0]}?image=fornax-jupyter&tag=test-tag"
-        )
-        called_request = mock_urlopen.call_args_list[1][0][0]
-        self.assertEqual(
-            called_request.full_url,
-            f"{self.default_args.ecr[0]}?image=fornax-jupyter&tag=main"
-        )
+        ])
+
+
+@unittest.skipIf(importlib.util.find_spec('requests') is None,
+                 'requests is not installed')
+class TestAmiBuilder(unittest.TestCase):
+
+    def setUp(self):
+        """Load scripts/ami-builder.py, and start a fake packages API"""
+        path = f'{os.path.dirname(__file__)}/../scripts/ami-builder.py'
+        spec = importlib.util.spec_from_file_location('ami_builder', path)
+        self.ami_builder = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.ami_builder)
+
+        FakePackages.requests = []
+        FakePackages.versions = [
+            ['develop', '20250601_1000'], ['20250501_1000'],
+            ['main', '20250401_1000'], ['20250301_1000'],
+            ['stable', 'v1.0', '20250201_1000'],
+        ]
+        self.server = ThreadingHTTPServer(('localhost', 0), FakePackages)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.api_url = f'http://localhost:{self.server.server_address[1]}'
+
+    def tearDown(self):
+        self.server.shutdown()
+
+    def test_resolve(self):
+        """Test resolving date tags of several images at once."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            resolver = self.ami_builder.DateTagResolver(
+                'fake-token', self.api_url, tmpdir)
+            resolved = resolver.resolve(
+                ['fornax-main:develop', 'fornax-main:stable',
+                 'fornax-main:missing'])
+            self.assertEqual(resolved, {
+                'fornax-main:develop': 'fornax-main:20250601_1000',
+                'fornax-main:stable': 'fornax-main:20250201_1000',
+                'fornax-main:missing': None,
+            })
+            # all 3 pages, each once
+            self.assertEqual(sorted(FakePackages.requests),
+                             [(1, False), (2, False), (3, False)])
+
+            # a repeat run costs one conditional request
+            FakePackages.requests = []
+            resolver = self.ami_builder.DateTagResolver(
+                'fake-token', self.api_url, tmpdir)
+            resolved = resolver.resolve(['fornax-main:develop'])
+            self.assertEqual(resolved['fornax-main:develop'],
+                             'fornax-main:20250601_1000')
+            self.assertEqual(FakePackages.requests, [(1, True)])
+
+            # a new version changes the first page only
+            FakePackages.requests = []
+            FakePackages.versions[0] = ['20250601_1000']
+            FakePackages.versions.insert(0, ['develop', '20250701_1000'])
+            resolved = resolver.resolve(['fornax-main:develop'])
+            self.assertEqual(resolved['fornax-main:develop'],
+                             'fornax-main:20250701_1000')
+            self.assertEqual(FakePackages.requests, [(1, False)])
+
+    def test_resolve_early_exit(self):
+        """Test that pages stop being fetched once the tags are found."""
+        resolver = self.ami_builder.DateTagResolver(
+            'fake-token', self.api_url, None, jobs=1)
+        resolved = resolver.resolve(['fornax-main:main'])
+        self.assertEqual(resolved['fornax-main:main'],
+                         'fornax-main:20250401_1000')
+        self.assertEqual(sorted(FakePackages.requests),
+                         [(1, False), (2, False)])
+
+        # the newest version with the tag has no unique date tag
+        FakePackages.requests = []
+        FakePackages.versions[0].append('20250602_1000')
+        resolved = resolver.resolve(['fornax-main:develop'])
+        self.assertIsNone(resolved['fornax-main:develop'])
+        self.assertEqual(FakePackages.requests, [(1, False)])
+
+    def test_bad_image(self):
+        """Test images without a tag."""
+        resolver = self.ami_builder.DateTagResolver(
+            'fake-token', self.api_url, None)
+        with self.assertRaises(ValueError):
+            resolver.resolve(['fornax-main'])
+
+    def test_trigger_endpoints(self):
+        """Test calling the AMI endpoints at the same time."""
+        FakeAmiEndpoint.requests = []
+        FakeAmiEndpoint.statuses = {'/busy': [503], '/bad': [500],
+                                    '/gateway': [504], '/drop': [None]}
+        server = ThreadingHTTPServer(('localhost', 0), FakeAmiEndpoint)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://localhost:{server.server_address[1]}'
+        # a port nobody listens on
+        closed = ThreadingHTTPServer(('localhost', 0), FakeAmiEndpoint)
+        refused = f'http://localhost:{closed.server_address[1]}/refused'
+        closed.server_close()
+        params = {'images': ['fornax-main:20250601_1000'], 'launch': False}
+        start = time.time()
+        results = self.ami_builder.trigger_endpoints(
+            [f'{url}/ok', f'{url}/busy', f'{url}/bad', f'{url}/gateway',
+             f'{url}/drop', refused],
+            params, timeout=10, retries=1, retry_delay=0)
+        elapsed = time.time() - start
+        server.shutdown()
+
+        # a 504 or a connection dropped after the post is not retried:
+        # the build may have started; a refused connection is
+        self.assertEqual([res['status'] for res in results],
+                         [200, 200, 500, 504, None, None])
+        self.assertEqual([res['attempts'] for res in results],
+                         [1, 2, 1, 1, 1, 2])
+        self.assertEqual([res['error'] for res in results][:4],
+                         [None, None, 'status 500', 'status 504'])
+        self.assertTrue(results[4]['error'].startswith('connection error'))
+        self.assertEqual(len(FakeAmiEndpoint.requests), 6)
+        self.assertEqual(FakeAmiEndpoint.requests[0][1], params)
+        # the calls overlap: 5 calls of 0.2 sec in about 2 rounds
+        self.assertLess(elapsed, 0.8)
+
+    def test_prefetch(self):
+        """Test turning a startup profile into prefetch params."""
+        path = f'{os.path.dirname(__file__)}/../scripts/startup-profile.py'
+        spec = importlib.util.spec_from_file_location('startup', path)
+        startup = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(startup)
+
+        log = ('0.010\t100\t/opt/jupyter/lib/libpython3.so\n'
+               '0.020\t10\t/proc/12/maps\n'
+               'truncated line\n'
+               '1.500\t20\t/opt/envs/python3/bin/python (deleted)\n'
+               '1.600\t5\t/tmp/file-access.log\n')
+        files = startup.parse_access_log(log)
+        self.assertEqual(files, [
+            (0.01, 100, '/opt/jupyter/lib/libpython3.so'),
+            (1.5, 20, '/opt/envs/python3/bin/python'),
+        ])
+        profile = {'fornax-main': {
+            'files': [[path, size, sec] for sec, size, path in files]}}
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(f'{tmpdir}/profile.json', 'w') as fp:
+                json.dump(profile, fp)
+            prefetch = self.ami_builder.load_prefetch(
+                f'{tmpdir}/profile.json',
+                ['fornax-main:20250601_1000', 'fornax-hea:develop'])
+        self.assertEqual(prefetch, {'fornax-main': [
+            '/opt/jupyter/lib/libpython3.so', '/opt/envs/python3/bin/python'
+        ]})
@@ -38,3 +38,14 @@ def test_notebooks_folder():
     assert os.path.exists(f'{notebook_dir}/irsa-tutorials')
     assert os.path.exists(f'{notebook_dir}/heasarc-tutorials')
     assert os.path.exists(f'{notebook_dir}/mast-tutorials')
+
+
+def test_kernel_culling_config():
+    python = f'{jupyter_root}/{jupyter_env}/bin/python'
+    result = CommonTests.run_cmd(
+        f'{python} -c "from traitlets.config.loader import '
+        'PyFileConfigLoader as L; c = L(\'jupyter_server_config.py\', '
+        'path=\'/etc/jupyter\').load_config(); '
+        'print(c.ServerApp.kernel_manager_class.__name__)"'
+    )
+    assert result.stdout.strip() == 'MemoryCullingKernelManager'
@@ -0,0 +1,113 @@
+import unittest
+import asyncio
+import sys
+import os
+import tempfile
+from unittest import mock
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(__file__))
+from oom_fixtures import FakeSystem, kernel_cmd, MB, GB  # noqa: E402
+
+try:
+    from traitlets.config.loader import PyFileConfigLoader
+    import jupyter_server  # noqa: F401
+except ImportError:
+    PyFileConfigLoader = None
+
+CONFIG_DIR = os.path.join(os.path.dirname(__file__), '..', 'fornax-jupyter')
+
+
+class FakeKernel:
+    """A kernel with a process {pid}, idle for {idle} sec"""
+
+    def __init__(self, pid, idle, state='idle'):
+        self.provisioner = type('Provisioner', (), {'pid': pid})()
+        self.execution_state = state
+        self.last_activity = (datetime.now(timezone.utc) -
+                              timedelta(seconds=idle))
+
+
+@unittest.skipIf(PyFileConfigLoader is None, 'jupyter_server is missing')
+class TestKernelCulling(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.system = FakeSystem(self.tmpdir.name, 8 * GB)
+        config = PyFileConfigLoader(
+            'jupyter_server_config.py', path=CONFIG_DIR).load_config()
+        self.manager = config.ServerApp.kernel_manager_class(config=config)
+        self.manager.proc_root = self.system.proc
+        self.manager.cgroup_root = self.system.cgroup
+        self.culled = []
+
+        async def shutdown_kernel(kernel_id, **kwargs):
+            self.culled.append(kernel_id)
+            self.manager._kernels.pop(kernel_id)
+
+        self.manager.shutdown_kernel = shutdown_kernel
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def add_kernel(self, kernel_id, pid, rss, idle, state='idle'):
+        self.system.add_process(pid, kernel_cmd(kernel_id), rss)
+        self.manager._kernels[kernel_id] = FakeKernel(pid, idle, state)
+
+    def test_config(self):
+        self.assertEqual(self.manager.cull_idle_timeout, 12 * 3600)
+        self.assertEqual(self.manager.cull_interval, 60)
+
+    def test_idle_kernels(self):
+        """Test ranking the idle kernels by memory and idle time."""
+        self.add_kernel('small', 100, GB, 3600)
+        self.add_kernel('big', 101, GB, 600)
+        self.system.add_process(1000, 'python -c worker', 2 * GB, ppid=101)
+        self.add_kernel('recent', 102, 3 * GB, 60)
+        self.add_kernel('busy', 103, 3 * GB, 3600, 'busy')
+        self.manager._kernels['starting'] = FakeKernel(None, 3600)
+        self.manager._kernels['starting'].provisioner = None
+        ranked = self.manager.get_idle_kernels(300)
+        self.assertEqual([(kid, rss) for _, kid, rss, _ in ranked],
+                         [('small', GB), ('big', 3 * GB)])
+
+    def test_cull_kernels(self):
+        """Test culling by memory until below the threshold."""
+        self.add_kernel('a', 100, 2 * GB, 3600)
+        self.add_kernel('b', 101, GB, 3600)
+        self.add_kernel('c', 102, 500 * MB, 3600)
+        self.add_kernel('d', 103, 3 * GB, 60)
+
+        # below the threshold: nothing idle for 12 hours, and no scan
+        self.system.set_memory(6 * GB)
+        with mock.patch.object(self.manager, 'get_idle_kernels') as scan:
+            asyncio.run(self.manager.cull_kernels())
+        scan.assert_not_called()
+        self.assertEqual(self.culled, [])
+
+        # above: cull the most expensive until below 0.8 * 8 GB
+        self.system.set_memory(int(7.5 * GB))
+        asyncio.run(self.manager.cull_kernels())
+        self.assertEqual(self.culled, ['a'])
+
+    def test_page_cache(self):
+        """Test that the clean page cache does not trigger culling."""
+        self.add_kernel('a', 100, 2 * GB, 3600)
+        self.system.set_memory(int(7.5 * GB), anon=3 * GB,
+                               file=int(4.5 * GB), shmem=GB // 2)
+        self.assertEqual(self.manager.get_memory(),
+                         (8 * GB, int(3.5 * GB)))
+        asyncio.run(self.manager.cull_kernels())
+        self.assertEqual(self.culled, [])
+
+        # the same on cgroup v1
+        system = FakeSystem(f'{self.tmpdir.name}/v1', 8 * GB, version=1)
+        system.set_memory(int(7.5 * GB), anon=3 * GB, file=int(4.5 * GB),
+                          shmem=GB // 2)
+        self.manager.cgroup_root = system.cgroup
+        self.assertEqual(self.manager.get_memory(),
+                         (8 * GB, int(3.5 * GB)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,305 @@
+import unittest
+import sys
+import os
+import io
+import json
+import signal
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(__file__))
+from oom_fixtures import FakeSystem, load_script, grow_trace  # noqa: E402
+from oom_fixtures import kernel_cmd, MB, GB  # noqa: E402
+
+oom_watch = load_script('oom_watch')
+oom_replay = load_script('oom_replay')
+
+
+class FakeWaiter:
+    """Wait without sleeping; stop after {count} wake ups"""
+
+    def __init__(self, stop, count=10):
+        self.stop = stop
+        self.count = count
+        self.wakeups = 0
+        self.event_driven = False
+        self.waits = []
+
+    def wait(self, interval, idle):
+        self.wakeups += 1
+        self.waits.append((interval, idle))
+        if self.wakeups >= self.count:
+            self.stop.set()
+        return 'poll'
+
+
+class TestOomWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.root = self.tmpdir.name
+        self.system = FakeSystem(self.root, 8 * GB)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_process_table(self):
+        """Test the cgroup scope and the cached command lines."""
+        self.system.add_process(10, 'jupyter-lab', 300 * MB)
+        self.system.add_process(11, kernel_cmd('a'), 2 * GB, ppid=10)
+        self.system.add_process(12, 'python big.py', 3 * GB,
+                                in_cgroup=False)
+        table = oom_watch.ProcessTable(self.system.proc, self.system.cgroup)
+        table.refresh()
+        self.assertEqual(sorted(table.entries), [10, 11])
+        self.assertTrue(table.entries[10]['protected'])
+        self.assertFalse(table.entries[11]['protected'])
+        self.assertEqual(table.candidates(GB),
+                         [(11, 2 * GB, kernel_cmd('a'))])
+
+        # only the memory is refreshed; exited pids are dropped
+        table.entries[11]['cmd'] = 'cached'
+        self.system.set_rss(11, 3 * GB)
+        self.system.remove_process(10)
+        table.refresh()
+        self.assertEqual(sorted(table.entries), [11])
+        self.assertEqual(table.entries[11]['cmd'], 'cached')
+        self.assertEqual(table.entries[11]['rss'], 3 * GB)
+
+        # a reused pid is found before stopping it, and read again
+        self.system.remove_process(11)
+        self.system.add_process(11, 'python other.py', GB)
+        table.refresh()
+        self.assertEqual(table.verify([11]), [])
+        table.refresh()
+        self.assertEqual(table.entries[11]['cmd'], 'python other.py')
+        self.assertEqual(table.verify([11]), [11])
+
+        # the trees are cached until a process starts or exits
+        groups = table.groups()
+        table.refresh()
+        self.assertIs(table.groups(), groups)
+        self.system.add_process(13, 'python new.py', GB)
+        table.refresh()
+        self.assertEqual(sorted(table.groups()), [11, 13])
+
+    def test_process_groups(self):
+        """Test summing the PSS of the workers of a kernel."""
+        self.system.add_process(10, 'jupyter-lab', 300 * MB)
+        self.system.add_process(11, kernel_cmd('a'), 500 * MB, ppid=10)
+        for pid in range(100, 132):
+            self.system.add_process(pid, 'python -c worker', 800 * MB,
+                                    ppid=11, pss=600 * MB)
+        self.system.add_process(12, 'bash', 10 * MB, ppid=10)
+        self.system.add_process(13, 'python small.py', 900 * MB, ppid=12)
+        table = oom_watch.ProcessTable(self.system.proc, self.system.cgroup)
+        table.refresh()
+        groups = table.groups()
+        self.assertEqual(sorted(groups), [11, 12])
+        self.assertEqual(len(groups[11]), 33)
+        self.assertEqual(sorted(groups[12]), [12, 13])
+        self.assertEqual(table.candidates(GB, groups), [
+            (11, 500 * MB + 32 * 600 * MB, kernel_cmd('a'))])
+
+        # forked workers keep the command line of their kernel
+        self.system.add_process(14, kernel_cmd('b'), 500 * MB, ppid=10)
+        for pid in range(200, 216):
+            self.system.add_process(pid, kernel_cmd('b'), 800 * MB,
+                                    ppid=14)
+        # a kernel started by another kernel is a tree of its own
+        self.system.add_process(15, kernel_cmd('c'), 500 * MB, ppid=14)
+        table.refresh()
+        groups = table.groups()
+        self.assertEqual(sorted(groups), [11, 12, 14, 15])
+        self.assertEqual(len(groups[14]), 17)
+        self.assertIn((14, 500 * MB + 16 * 800 * MB, kernel_cmd('b')),
+                      table.candidates(GB, groups))
+
+    def test_orphan(self):
+        """Test that pid 1 is never stopped for its orphans."""
+        self.system.add_process(1, 'tini -g -- start.sh start-notebook.py',
+                                10 * MB, ppid=0)
+        self.system.add_process(10, 'jupyterhub-singleuser', 300 * MB)
+        self.system.add_process(30, 'python orphan.py', int(6.5 * GB))
+        self.system.add_process(31, 'python -c worker', 100 * MB, ppid=30)
+        self.system.set_memory(int(7.5 * GB))
+        killed = []
+        stop = threading.Event()
+        oom_watch.watchdog(
+            f'{self.root}/telemetry', self.system.proc, self.system.cgroup,
+            home=self.root, waiter=FakeWaiter(stop, 1),
+            kill=lambda pid, sig: killed.append(pid), stop=stop)
+        self.assertEqual(killed, [31, 30])
+
+    def test_pressure_waiter(self):
+        """Test polling when the PSI trigger cannot be registered."""
+        self.system.write('memory.pressure', '')
+        self.system.write('memory.events', 'high 0\nmax 0\noom 0')
+        write = os.write
+
+        def fail(fd, data):
+            if data.startswith(b'some'):
+                raise PermissionError('read-only file system')
+            return write(fd, data)
+
+        with mock.patch.object(oom_watch.os, 'write', fail):
+            waiter = oom_watch.PressureWaiter(self.system.cgroup)
+        self.assertFalse(waiter.event_driven)
+        self.assertEqual(list(waiter.fds.values()), ['events'])
+        # an idle wait still polls at the interval, not IDLE_TIMEOUT
+        start = time.monotonic()
+        self.assertEqual(waiter.wait(0.05, True), 'poll')
+        self.assertLess(time.monotonic() - start, 1)
+
+        waiter = oom_watch.PressureWaiter(self.system.cgroup)
+        self.assertTrue(waiter.event_driven)
+
+    def test_memory_stat(self):
+        """Test reading memory.stat and writing memory.reclaim."""
+        self.system.set_memory(4 * GB, anon=GB, file=3 * GB, shmem=GB // 2)
+        self.assertEqual(oom_watch.read_memory_stat(self.system.cgroup), {
+            'anon': GB, 'file': 3 * GB, 'shmem': GB // 2})
+        self.assertFalse(oom_watch.reclaim(GB, self.system.cgroup))
+        self.system.write('memory.reclaim', '')
+        self.assertTrue(oom_watch.reclaim(GB, self.system.cgroup))
+        with open(f'{self.system.cgroup}/memory.reclaim') as fp:
+            self.assertEqual(fp.read(), str(GB))
+
+        system = FakeSystem(f'{self.root}/v1', 8 * GB, version=1)
+        system.set_memory(4 * GB, anon=GB, file=3 * GB)
+        self.assertEqual(oom_watch.read_memory_stat(system.cgroup), {
+            'anon': GB, 'file': 3 * GB, 'shmem': 0})
+
+    def test_policy(self):
+        """Test acting early, and stopping the growing process."""
+        policy = oom_watch.Policy(8 * GB, GB)
+        self.assertFalse(policy.should_act(4 * GB))
+        interval, idle = policy.interval(4 * GB)
+        self.assertTrue(idle)
+        self.assertGreater(interval, 1)
+        for now in range(5):
+            used = 4 * GB + now * GB // 2
+            policy.update_usage(now, used)
+            policy.update_processes(now, {1: 3 * GB, 2: GB + now * GB // 2})
+        self.assertAlmostEqual(policy.rate, GB / 2, delta=GB / 10)
+        interval, idle = policy.interval(used)
+        self.assertFalse(idle)
+        self.assertLess(interval, oom_watch.MAX_INTERVAL)
+        self.assertTrue(policy.should_act(used))
+        self.assertEqual(policy.choose([(1, 3 * GB, 'a'), (2, 3 * GB, 'b')]),
+                         (2, 3 * GB, 'b'))
+
+    def test_watchdog(self):
+        """Test stopping the tree of a kernel, with telemetry."""
+        self.system.add_process(10, 'jupyterhub-singleuser', 300 * MB)
+        self.system.add_process(11, kernel_cmd('a'), 3 * GB, ppid=10)
+        self.system.add_process(12, 'python -c worker', 2 * GB, ppid=11)
+        self.system.add_process(13, kernel_cmd('b'), GB // 2, ppid=10)
+        self.system.set_memory(int(7.5 * GB))
+        killed = []
+        stop = threading.Event()
+
+        def kill(pid, sig):
+            killed.append((pid, sig))
+            if pid == 11:
+                stop.set()
+
+        # the notebook is looked up (over http) after the SIGTERM
+        looked_up = []
+        with mock.patch.object(oom_watch, 'find_notebook',
+                               lambda cmd: looked_up.append(len(killed))):
+            oom_watch.watchdog(
+                f'{self.root}/telemetry', self.system.proc,
+                self.system.cgroup, home=self.root, waiter=FakeWaiter(stop),
+                kill=kill, stop=stop)
+
+        self.assertEqual(killed, [(12, signal.SIGTERM),
+                                  (11, signal.SIGTERM)])
+        self.assertEqual(looked_up, [2])
+        with open(f'{self.root}/_PROCESS_STOPPED_DUE_TO_MEMORY.txt') as fp:
+            self.assertIn('Child processes: 1', fp.read())
+        files = os.listdir(f'{self.root}/telemetry')
+        self.assertIn('metrics.prom', files)
+        dumps = [name for name in files if name.startswith('kill-')]
+        self.assertEqual(len(dumps), 1)
+        with open(f'{self.root}/telemetry/{dumps[0]}') as fp:
+            sample = json.loads(fp.readline())
+        self.assertEqual(sample['used'], int(7.5 * GB))
+        self.assertEqual(sample['procs']['11'][0], 5 * GB)
+
+    def test_watchdog_page_cache(self):
+        """Test reclaiming the page cache instead of killing."""
+        self.system.add_process(11, kernel_cmd('a'), 3 * GB)
+        self.system.set_memory(int(7.5 * GB), anon=3 * GB,
+                               file=int(4.5 * GB))
+        self.system.write('memory.reclaim', '')
+        killed = []
+        stop = threading.Event()
+        oom_watch.watchdog(
+            f'{self.root}/telemetry', self.system.proc, self.system.cgroup,
+            home=self.root, waiter=FakeWaiter(stop, 2),
+            kill=lambda pid, sig: killed.append(pid), stop=stop)
+        self.assertEqual(killed, [])
+        with open(f'{self.system.cgroup}/memory.reclaim') as fp:
+            reclaimed = int(fp.read())
+        self.assertEqual(reclaimed, GB // 2 + oom_watch.RECLAIM_MARGIN)
+
+    def test_watchdog_idle_page_cache(self):
+        """Test an idle server whose page cache fills the cgroup, without
+        memory.reclaim."""
+        self.system.add_process(11, kernel_cmd('a'), int(2.6 * GB))
+        self.system.set_memory(int(7.5 * GB), anon=int(2.6 * GB),
+                               file=int(4.9 * GB))
+        killed = []
+        scans = []
+        refresh = oom_watch.ProcessTable.refresh
+
+        def count_refresh(table):
+            scans.append(1)
+            return refresh(table)
+
+        stop = threading.Event()
+        waiter = FakeWaiter(stop, 20)
+        out = io.StringIO()
+        with mock.patch.object(oom_watch.ProcessTable, 'refresh',
+                               count_refresh), redirect_stdout(out):
+            oom_watch.watchdog(
+                f'{self.root}/telemetry', self.system.proc,
+                self.system.cgroup, home=self.root, waiter=waiter,
+                kill=lambda pid, sig: killed.append(pid), stop=stop)
+        self.assertEqual(killed, [])
+        # the working set is far from the limit: idle waits, one scan
+        # for the telemetry, and one failed reclaim before backing off
+        self.assertTrue(all(idle for _, idle in waiter.waits))
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(out.getvalue().count('unavailable'), 1)
+
+    def test_telemetry(self):
+        """Test the Prometheus text, with an odd command line."""
+        telemetry = oom_watch.Telemetry(f'{self.root}/telemetry')
+        telemetry.add({'t': 0, 'limit': 8 * GB, 'used': 4 * GB,
+                       'procs': {'11': [GB, 'python -c "a\\b\nc"']}})
+        text = telemetry.to_prometheus()
+        self.assertIn('oom_watch_process_tree_bytes{pid="11",'
+                      'cmd="python -c \\"a\\\\b\\nc\\""} 1073741824', text)
+        for line in text.splitlines():
+            self.assertTrue(line.startswith(('# ', 'oom_watch_')), line)
+
+    def test_replay(self):
+        """Test that the growth-aware policy stops the growing kernel."""
+        samples = grow_trace()
+        result = oom_replay.replay(samples, oom_replay.POLICIES['ewma'])
+        self.assertIsNone(result['oom'])
+        self.assertEqual([kill['pid'] for kill in result['kills']], [101])
+        self.assertGreater(result['kills'][0]['lead'], 0)
+
+        result = oom_replay.replay(samples, oom_replay.POLICIES['largest'])
+        self.assertEqual(result['kills'][0]['pid'], 100)
+        self.assertIsNotNone(result['oom'])
+
+
+if __name__ == '__main__':
+    unittest.main()